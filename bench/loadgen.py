@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import string
+import subprocess
+import sys
+import time
+from collections import deque
+from client.connection import GameConnection, EVENT_DISCONNECTED
+from shared.common import *
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SENT_EXPIRY_SECONDS = 10  # Batches not received by then count as lost and are forgotten
+
+class Stats:
+    """Counters shared by every bot of a run"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Start a new measurement window"""
+        self.started = time.perf_counter()
+        self.sent_at = {}  # Stroke batch key -> time the drawer sent it
+        self.sent_order = deque()  # (time, key) of the sent batches, oldest first
+        self.latencies = []  # Seconds from a drawer sending a batch to a bot receiving it
+        self.received_by_type = {}
+        self.guesses = 0
+        self.rounds = 0
+        self.disconnects = 0
+
+    def sent(self, key):
+        """Note the time a batch was sent, forgetting batches older than SENT_EXPIRY_SECONDS"""
+        now = time.perf_counter()
+        self.sent_at[key] = now
+        self.sent_order.append((now, key))
+        while self.sent_order[0][0] < now - SENT_EXPIRY_SECONDS:
+            sent_at, old_key = self.sent_order.popleft()
+            if self.sent_at.get(old_key) == sent_at:
+                del self.sent_at[old_key]
+
+def stroke_key(points):
+    """Identify a stroke batch by its ends and length, cheap enough for every receiver"""
+    return points[0], points[1], points[-2], points[-1], len(points)
+
+def random_guess():
+    """A guess that is unlikely to end the round"""
+    return "".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(4, 9)))
+
+class Bot:
+    """A headless player that draws when it is the drawer and guesses otherwise"""
+
+    def __init__(self, stats, options, host, port):
+        self.stats = stats
+        self.options = options
+        compression = [] if options.compression == "none" else [options.compression]
+        self.connection = GameConnection(host, port, [options.format], compression, reconnect=False)
+        self.is_drawer = False
+        self.game_state = STATE_WAITING
+        self.drawer_task = None
+
+    async def run(self):
+        """Play until cancelled or disconnected"""
+        guesser_task = asyncio.ensure_future(self.guess_loop())
+        try:
+            async for event in self.connection:
+                self.handle_event(event)
+        finally:
+            guesser_task.cancel()
+            self.stop_drawing()
+            self.connection.close()
+
+    def handle_event(self, event):
+        """Update the bot from one server message"""
+        msg_type = event.type
+        data = event.data
+        now = time.perf_counter()
+        stats = self.stats
+        stats.received_by_type[msg_type] = stats.received_by_type.get(msg_type, 0) + 1
+
+        if msg_type == MSG_DRAW:
+            if "points" in data:
+                sent_at = stats.sent_at.get(stroke_key(data["points"]))
+                if sent_at is not None:
+                    stats.latencies.append(now - sent_at)
+        elif msg_type == EVENT_DISCONNECTED:
+            stats.disconnects += 1
+        elif msg_type == MSG_STATE:
+            self.game_state = data["state"]
+            # Only the drawer's own state carries the word
+            is_drawer = data.get("is_drawer", False) and "word" in data
+            if is_drawer and not self.is_drawer:
+                stats.rounds += 1
+                self.drawer_task = asyncio.ensure_future(self.draw_loop())
+            elif not is_drawer:
+                self.stop_drawing()
+            self.is_drawer = is_drawer
+
+    def stop_drawing(self):
+        """Stop producing strokes"""
+        if self.drawer_task is not None:
+            self.drawer_task.cancel()
+            self.drawer_task = None
+
+    async def draw_loop(self):
+        """Send random-walk strokes as batched polylines, like a drawing player"""
+        options = self.options
+        interval = 1 / options.stroke_rate
+        margin = 20
+        while True:
+            x = random.randint(margin, CANVAS_SIZE - margin)
+            y = random.randint(margin, CANVAS_SIZE - margin)
+            heading_x, heading_y = random.uniform(-3, 3), random.uniform(-3, 3)
+            for batch in range(options.batches_per_stroke):
+                # Each batch starts at the last point of the previous one, like the GUI client
+                points = [x, y]
+                for _ in range(options.points_per_batch):
+                    heading_x = max(-6, min(6, heading_x + random.uniform(-1, 1)))
+                    heading_y = max(-6, min(6, heading_y + random.uniform(-1, 1)))
+                    x = min(max(int(x + heading_x), margin), CANVAS_SIZE - margin)
+                    y = min(max(int(y + heading_y), margin), CANVAS_SIZE - margin)
+                    points += (x, y)
+
+                self.stats.sent(stroke_key(points))
+                self.connection.send(MSG_DRAW, {"points": points, "end": batch == options.batches_per_stroke - 1})
+                await asyncio.sleep(interval)
+
+    async def guess_loop(self):
+        """Send guesses at random intervals averaging the configured rate"""
+        if self.options.guess_rate <= 0:
+            return
+        while True:
+            await asyncio.sleep(random.expovariate(self.options.guess_rate))
+            if self.game_state == STATE_PLAYING and not self.is_drawer:
+                self.connection.send(MSG_GUESS, {"guess": random_guess()})
+                self.stats.guesses += 1
+
+def free_port(host):
+    """Ask the OS for a port nobody listens on"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+def start_server(engine, host, port, log_path, room_size=ROOM_SIZE, workers=WORKERS):
+    """Run the server in a child process and wait until it accepts connections"""
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, "-m", "server.server", "--engine", engine, "--host", host, "--port", str(port),
+         "--room-size", str(room_size), "--workers", str(workers)],
+        cwd=REPO_ROOT, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Server did not start listening in time")
+
+def process_tree(pid):
+    """A process and its descendants, such as the workers of a supervisor"""
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as children_file:
+            for child in children_file.read().split():
+                pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+def cpu_seconds(pid):
+    """User and system CPU time of a process and its descendants, None where /proc is not available"""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat") as stat_file:
+                # Skip the command name, it may contain spaces
+                fields = stat_file.read().rpartition(")")[2].split()
+        except OSError:
+            return None
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+def resident_bytes(pid):
+    """Resident memory of a process and its descendants, None where /proc is not available"""
+    total = 0
+    for member in process_tree(pid):
+        try:
+            with open(f"/proc/{member}/statm") as statm_file:
+                total += int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return None
+    return total
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def traffic(bots):
+    """Messages and bytes sent and received by all bots so far"""
+    connections = [bot.connection for bot in bots]
+    return {
+        "messages_sent": sum(connection.messages_sent for connection in connections),
+        "messages_received": sum(connection.messages_received for connection in connections),
+        "bytes_sent": sum(connection.bytes_sent for connection in connections),
+        "bytes_received": sum(connection.bytes_received for connection in connections),
+    }
+
+def summarize(stats, counts, elapsed, cpu):
+    """Turn the counters of a measurement window into the reported results"""
+    latencies = sorted(stats.latencies)
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "fanout_latency_ms": {
+            "samples": len(latencies),
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p90": to_ms(percentile(latencies, 0.90)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+            "mean": to_ms(sum(latencies) / len(latencies) if latencies else None),
+        },
+        "messages_sent_per_second": round(counts["messages_sent"] / elapsed, 1),
+        "messages_received_per_second": round(counts["messages_received"] / elapsed, 1),
+        "bytes_sent_per_second": round(counts["bytes_sent"] / elapsed, 1),
+        "bytes_received_per_second": round(counts["bytes_received"] / elapsed, 1),
+        "received_by_type": stats.received_by_type,
+        "guesses": stats.guesses,
+        "rounds": stats.rounds,
+        "disconnects": stats.disconnects,
+        "server_cpu_percent": None if cpu is None else round(cpu / elapsed * 100, 1),
+    }
+
+async def connect_bots(stats, options, host, port):
+    """Start every bot, a few at a time so the listen backlog never overflows"""
+    bots = []
+    tasks = []
+    for i in range(options.bots):
+        bot = Bot(stats, options, host, port)
+        bots.append(bot)
+        tasks.append(asyncio.ensure_future(bot.run()))
+        if i % 50 == 49:
+            await asyncio.sleep(0.05)
+    return bots, tasks
+
+async def measure(options, host, port, pid):
+    """Run the bots, wait for a round to start and measure for the configured duration"""
+    stats = Stats()
+    bots, tasks = await connect_bots(stats, options, host, port)
+
+    # Measure only while a round is being drawn
+    deadline = time.monotonic() + COUNTDOWN_SECONDS + options.warmup + 10
+    while not any(bot.is_drawer for bot in bots):
+        if time.monotonic() > deadline:
+            raise RuntimeError("No round started, are there at least MIN_PLAYERS bots?")
+        failed = [task for task in tasks if task.done() and task.exception()]
+        if failed:
+            raise RuntimeError(f"Bot failed: {failed[0].exception()}")
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(options.warmup)
+
+    cpu_before = cpu_seconds(pid) if pid else None
+    before = traffic(bots)
+    stats.reset()
+    await asyncio.sleep(options.duration)
+    elapsed = time.perf_counter() - stats.started
+    after = traffic(bots)
+    cpu_after = cpu_seconds(pid) if pid else None
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+    counts = {key: after[key] - before[key] for key in after}
+    return summarize(stats, counts, elapsed, cpu)
+
+def git_revision():
+    """Commit of the code under test, so results can be compared between versions"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a Pictionary server with headless bots")
+    parser.add_argument("--bots", type=int, default=100, help="Number of bot players")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds to measure")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds to wait after the round starts")
+    parser.add_argument("--engine", choices=["select", "asyncio"], default=SERVER_ENGINE,
+                        help="Network engine of the server under test")
+    parser.add_argument("--format", choices=WIRE_FORMATS, default=WIRE_FORMATS[0],
+                        help="Wire format the bots ask for")
+    parser.add_argument("--compression", choices=["none"] + COMPRESSION_METHODS, default="none",
+                        help="Frame compression the bots ask for")
+    parser.add_argument("--stroke-rate", type=float, default=1000 / STROKE_FLUSH_MS,
+                        help="Stroke batches the drawer sends per second")
+    parser.add_argument("--points-per-batch", type=int, default=8, help="New points in each stroke batch")
+    parser.add_argument("--batches-per-stroke", type=int, default=20, help="Batches before a stroke ends")
+    parser.add_argument("--guess-rate", type=float, default=0.2, help="Guesses per second of each guesser")
+    parser.add_argument("--room-size", type=int, default=ROOM_SIZE,
+                        help="Players per room of the started server, the bots fill as many rooms as needed")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Worker processes of the started server, 0 for one per CPU core")
+    parser.add_argument("--host", default=HOST, help="Address of the server")
+    parser.add_argument("--port", type=int, help="Port of the server, a free one when it is started here")
+    parser.add_argument("--external", action="store_true",
+                        help="Test an already running server instead of starting one (no CPU figures)")
+    parser.add_argument("--server-log", help="File for the output of the started server")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    options = parser.parse_args()
+
+    if options.bots < MIN_PLAYERS:
+        parser.error(f"At least {MIN_PLAYERS} bots are needed to start a round")
+
+    port = options.port or (PORT if options.external else free_port(options.host))
+    server = None if options.external else start_server(options.engine, options.host, port, options.server_log,
+                                                                 options.room_size, options.workers)
+    try:
+        results = asyncio.run(measure(options, options.host, port, server and server.pid))
+        if server is not None:
+            results["server_rss_bytes"] = resident_bytes(server.pid)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(options).items() if key not in ("output", "server_log")},
+        "results": results,
+    }
+
+    latency = results["fanout_latency_ms"]
+    target = "an external server" if options.external else f"the {options.engine} engine"
+    print(f"{options.bots} bots on {target}, {options.format} format, "
+          f"{options.compression} compression, {options.duration:g}s")
+    print(f"  fan-out latency  p50 {latency['p50']} ms  p99 {latency['p99']} ms  ({latency['samples']} samples)")
+    print(f"  messages         {results['messages_sent_per_second']}/s sent  "
+          f"{results['messages_received_per_second']}/s received")
+    print(f"  bytes            {results['bytes_sent_per_second']}/s sent  "
+          f"{results['bytes_received_per_second']}/s received")
+    print(f"  server CPU       {results['server_cpu_percent']} %")
+
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {options.output}")
+
+if __name__ == "__main__":
+    main()
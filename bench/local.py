@@ -0,0 +1,41 @@
+import socket
+from server.server import PictionaryServer
+from shared.common import *
+
+class LocalServer:
+    """A select engine server whose clients are connected through socketpairs
+
+    Used by the micro benchmarks and the tests to drive a real server and its
+    rooms without a network or an event loop.
+    """
+
+    def __init__(self, players, room_size=ROOM_SIZE):
+        listener, self.listener_peer = socket.socketpair()
+        self.server = PictionaryServer(room_size=room_size, listener=listener)
+        self.peers = {}  # Server side socket -> client side socket
+        for i in range(players):
+            self.connect(("local", i))
+        self.server.match_players()
+        self.room = next(iter(self.server.rooms))
+
+    def connect(self, address, join=None):
+        """Connect and join a new client, with extra JOIN fields if given, returns its server side socket"""
+        ours, theirs = socket.socketpair()
+        theirs.setblocking(False)
+        self.server.add_connection(ours, address)
+        self.peers[ours] = theirs
+        self.server.process_message(ours, {"type": MSG_JOIN, "data": {"formats": [FORMAT_BINARY], **(join or {})}})
+        return ours
+
+    def leave(self, client):
+        """Drop a client for good, as if its resume grace period ran out"""
+        self.server.close_client(client)
+        self.server.remove_client(client)
+        self.peers.pop(client).close()
+
+    def close(self):
+        for ours, theirs in self.peers.items():
+            ours.close()
+            theirs.close()
+        self.server.server_socket.close()
+        self.listener_peer.close()
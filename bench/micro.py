@@ -0,0 +1,363 @@
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+from bench.loadgen import REPO_ROOT, git_revision
+from bench.local import LocalServer
+from server.limits import make_buckets
+from server.strokes import StrokeStore
+from shared.common import *
+
+BASELINE_PATH = os.path.join(REPO_ROOT, "bench", "micro_baseline.json")
+THRESHOLD = 0.25  # Fraction a benchmark may be slower than its baseline before the run fails
+REPEAT = 15  # Samples per benchmark, the best one counts
+SAMPLE_SECONDS = 0.005  # Shortest sample, fast functions are called in a loop until it takes this long
+BATCH_FRAMES = 32  # Frames a client sends in one batch to handle_client_message
+BROADCAST_BATCH = 16  # Broadcasts between two flushes of the outbound buffers
+BROADCAST_MEMBERS = (2, 16, 128)
+
+def measure(run, prepare=None, finish=None, operations=1, repeat=None):
+    """Best and median nanoseconds per operation of run, prepare and finish are left out of the timing"""
+    repeat = repeat or REPEAT
+    number = 1
+    samples = []
+    while len(samples) < repeat:
+        elapsed = 0
+        for _ in range(number):
+            if prepare is not None:
+                prepare()
+            started = time.perf_counter_ns()
+            run()
+            elapsed += time.perf_counter_ns() - started
+            if finish is not None:
+                finish()
+        if elapsed < SAMPLE_SECONDS * 1e9 and not samples:
+            number *= 2  # Still calibrating, the sample is too short to trust
+            continue
+        samples.append(elapsed / number / operations)
+    return {"best_ns": round(min(samples), 1), "median_ns": round(statistics.median(samples), 1)}
+
+def stroke_points(start, count, step=3):
+    """Points of a diagonal stroke, flat, as the drawer sends them"""
+    points = []
+    for i in range(start, start + count):
+        points += [(i * step) % CANVAS_SIZE, (i * step * 2) % CANVAS_SIZE]
+    return points
+
+def sample_messages():
+    """One typical message of every type the game sends often, by name"""
+    players = [{"id": i, "name": f"Player_{1000 + i}", "score": i * 10, "is_drawer": i == 0, "away": False}
+               for i in range(8)]
+    store = StrokeStore()
+    for stroke in range(40):
+        store.add({"points": stroke_points(stroke * 50, 50), "end": True})
+    return {
+        "draw_segment": (MSG_DRAW, {"x1": 120, "y1": 240, "x2": 123, "y2": 246}),
+        "draw_polyline": (MSG_DRAW, {"points": stroke_points(0, 8)}),
+        "guess": (MSG_GUESS, {"player": "Player_1234", "guess": "elephant"}),
+        "guess_digest": (MSG_GUESS, {"guesses": [{"player": f"Player_{1000 + i}", "guess": "giraffe"}
+                                                 for i in range(6)]}),
+        "state": (MSG_STATE, {"state": STATE_PLAYING, "room": 1, "spectators": 0, "category": "animals",
+                              "is_drawer": False, "players": players, "roster": 12}),
+        "roster": (MSG_ROSTER, {"version": 13, "changes": [{"op": "update", "id": 3, "score": 40}]}),
+        "countdown": (MSG_COUNTDOWN, {"seconds": 3}),
+        "result": (MSG_RESULT, {"winner": "Player_1234", "word": "elephant"}),
+        "snapshot": (MSG_SNAPSHOT, {"version": 2000, "drawing": store.pack()}),
+    }
+
+def protocol_benchmarks():
+    """encode_message and decode_message for every sample message, wire format and compression"""
+    contexts = {"json": (FORMAT_JSON, None), "binary": (FORMAT_BINARY, None),
+                "binary+deflate": (FORMAT_BINARY, COMPRESSION_DEFLATE)}
+    for name, (msg_type, data) in sample_messages().items():
+        for context_name, (wire_format, compression) in contexts.items():
+            encoded = encode_message(msg_type, data, wire_format, compression)
+            frame = encoded.rstrip(b"\n") if wire_format == FORMAT_JSON else encoded
+            yield (f"encode/{name}/{context_name}",
+                   lambda msg_type=msg_type, data=data, context=(wire_format, compression):
+                       measure(lambda: encode_message(msg_type, data, *context)))
+            yield f"decode/{name}/{context_name}", lambda frame=frame: measure(lambda: decode_message(frame))
+
+class BenchServer(LocalServer):
+    """A local server with one room of members and a round going on
+
+    Rate limits are lifted, the benchmarks measure the work of a message and
+    not how quickly the limits turn it away.
+    """
+
+    def __init__(self, members):
+        super().__init__(members, room_size=max(members, MIN_PLAYERS))
+        self.room.buckets = make_buckets({msg_type: (1e9, 1e9) for msg_type in ROOM_RATE_LIMITS})
+        for info in self.server.clients.values():
+            info["buckets"] = make_buckets({msg_type: (1e9, 1e9) for msg_type in CLIENT_RATE_LIMITS})
+        self.room.start_new_round()
+        self.drawer = self.room.drawer
+        self.guessers = [client for client in self.room.players() if client is not self.drawer]
+        self.finish()
+
+    def finish(self):
+        """Run due timers, write out everything queued and throw away what the clients received"""
+        self.server.scheduler.run_due()
+        self.server.flush_outbound()
+        for peer in self.peers.values():
+            try:
+                while peer.recv(1 << 16):
+                    pass
+            except BlockingIOError:
+                pass
+        if self.room.strokes.nbytes > self.room.strokes.budget // 2:
+            self.room.reset_drawing()
+
+def server_benchmarks():
+    """handle_client_message on batches of frames, and the broadcasts of a room"""
+    def handle_draws():
+        bench = BenchServer(8)
+        peer = bench.peers[bench.drawer]
+        position = [0]
+
+        def prepare():
+            frames = []
+            for _ in range(BATCH_FRAMES):
+                frames.append(encode_message(MSG_DRAW, {"points": stroke_points(position[0], 9)}, FORMAT_BINARY))
+                position[0] += 8  # The next batch continues the stroke
+            peer.sendall(b"".join(frames))
+
+        try:
+            return measure(lambda: bench.server.handle_client_message(bench.drawer), prepare, bench.finish,
+                           BATCH_FRAMES)
+        finally:
+            bench.close()
+
+    def handle_guesses():
+        bench = BenchServer(8)
+        count = [0]
+
+        def prepare():
+            # Wrong guesses, each new so that none is ignored as a repeat
+            for guesser in bench.guessers:
+                frames = []
+                for _ in range(BATCH_FRAMES):
+                    count[0] += 1
+                    frames.append(encode_message(MSG_GUESS, {"guess": f"guess{count[0]}"}, FORMAT_BINARY))
+                bench.peers[guesser].sendall(b"".join(frames))
+
+        def run():
+            for guesser in bench.guessers:
+                bench.server.handle_client_message(guesser)
+
+        try:
+            return measure(run, prepare, bench.finish, BATCH_FRAMES * len(bench.guessers))
+        finally:
+            bench.close()
+
+    yield "server/handle_client_message/draw", handle_draws
+    yield "server/handle_client_message/guess", handle_guesses
+
+    for members in BROADCAST_MEMBERS:
+        def broadcast_draws(members=members):
+            bench = BenchServer(members)
+            draw_data = {"points": stroke_points(0, 8)}
+
+            def run():
+                for _ in range(BROADCAST_BATCH):
+                    bench.room.broadcast(MSG_DRAW, draw_data, droppable=True)
+
+            try:
+                return measure(run, None, bench.finish, BROADCAST_BATCH)
+            finally:
+                bench.close()
+
+        def broadcast_states(members=members):
+            bench = BenchServer(members)
+            players = bench.room.players()
+
+            def run():
+                # A score changes, so the roster update and the game state both go out
+                for i in range(BROADCAST_BATCH):
+                    bench.room.clients[players[i % len(players)]]["score"] += 1
+                    bench.room.state_sent = None
+                    bench.room.broadcast_game_state()
+                    bench.room.flush_game_state()
+
+            try:
+                return measure(run, None, bench.finish, BROADCAST_BATCH)
+            finally:
+                bench.close()
+
+        yield f"server/broadcast/draw/{members}", broadcast_draws
+        yield f"server/broadcast_game_state/{members}", broadcast_states
+
+def client_benchmarks():
+    """The client's handle_message drawing path, on a stub canvas instead of a window"""
+    try:
+        from client.client import PictionaryClient
+        from client.connection import Event
+        from client.render import CanvasRenderer
+    except ImportError as e:
+        print(f"Skipping the client benchmarks: {e}", file=sys.stderr)
+        return
+
+    class StubCanvas:
+        """Just enough of a Tk canvas for the renderer"""
+
+        def __init__(self):
+            self.items = 0
+
+        def create_line(self, *coords, **options):
+            self.items += 1
+            return self.items
+
+        create_image = create_line
+
+        def coords(self, item, *coords):
+            pass
+
+        def delete(self, *items):
+            pass
+
+        def tag_lower(self, item):
+            pass
+
+        def winfo_width(self):
+            return CANVAS_SIZE
+
+        winfo_height = winfo_width
+
+    class HeadlessRenderer(CanvasRenderer):
+        def update_layer(self):
+            self.bitmap.to_png()  # Everything but handing the image to Tk
+
+    def headless_client():
+        client = PictionaryClient.__new__(PictionaryClient)  # No window
+        client.is_drawer = False
+        client.renderer = HeadlessRenderer(StubCanvas())
+        return client
+
+    def draws():
+        client = headless_client()
+        position = [0]
+
+        def run():
+            # One frame's worth of polylines continuing a stroke, then the commit of the frame
+            for _ in range(4):
+                client.handle_message(Event(MSG_DRAW, {"points": stroke_points(position[0], 9)}))
+                position[0] += 8
+            client.renderer.commit()
+
+        return measure(run, operations=4)
+
+    def snapshots():
+        client = headless_client()
+        event = Event(MSG_SNAPSHOT, sample_messages()["snapshot"][1])
+        return measure(lambda: client.handle_message(event))
+
+    yield "client/handle_message/draw", draws
+    yield "client/handle_message/snapshot", snapshots
+
+def compare(results, baseline, threshold):
+    """Names of the benchmarks slower than their baseline by more than the threshold"""
+    regressions = []
+    thresholds = baseline.get("thresholds", {})
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        limit = base["best_ns"] * (1 + thresholds.get(name, threshold))
+        if result["best_ns"] > limit:
+            regressions.append(name)
+    return regressions
+
+def format_time(nanoseconds):
+    if nanoseconds >= 1e6:
+        return f"{nanoseconds / 1e6:.2f} ms"
+    if nanoseconds >= 1e3:
+        return f"{nanoseconds / 1e3:.2f} us"
+    return f"{nanoseconds:.0f} ns"
+
+def main():
+    global REPEAT
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the protocol and the hot server and client paths")
+    parser.add_argument("--filter", help="Only run benchmarks whose name matches this regular expression")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="Samples per benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Baseline file to compare with or save to")
+    parser.add_argument("--save-baseline", action="store_true", help="Record the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="Fraction a benchmark may be slower than its baseline, unless the baseline sets its own")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    options = parser.parse_args()
+
+    REPEAT = options.repeat
+    pattern = re.compile(options.filter) if options.filter else None
+    benchmarks = [(name, run) for group in (protocol_benchmarks, server_benchmarks, client_benchmarks)
+                  for name, run in group() if pattern is None or pattern.search(name)]
+    if options.list:
+        for name, _ in benchmarks:
+            print(name)
+        return
+
+    baseline = None
+    if not options.save_baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = {}
+    width = max(len(name) for name, _ in benchmarks)
+    for name, run in benchmarks:
+        result = results[name] = run()
+        line = f"{name:<{width}}  {format_time(result['best_ns']):>10}  {format_time(result['median_ns']):>10}"
+        base = baseline and baseline["results"].get(name)
+        if base:
+            line += f"  {(result['best_ns'] / base['best_ns'] - 1) * 100:+6.1f} %"
+        print(line, flush=True)
+
+    regressions = []
+    if baseline is not None:
+        regressions = compare(results, baseline, options.threshold)
+        if regressions:
+            # Measure the suspects again, one unlucky run should not fail the gate
+            runs = dict(benchmarks)
+            for name in regressions:
+                retry = runs[name]()
+                if retry["best_ns"] < results[name]["best_ns"]:
+                    results[name] = retry
+            regressions = compare({name: results[name] for name in regressions}, baseline, options.threshold)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {options.output}")
+
+    if options.save_baseline:
+        # Keep the hand-tuned thresholds of the previous baseline, and its results of benchmarks not run now
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as baseline_file:
+                previous = json.load(baseline_file)
+            report["thresholds"] = previous.get("thresholds", {})
+            report["results"] = dict(previous["results"], **results)
+        with open(options.baseline, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline written to {options.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {options.baseline}, run with --save-baseline to record one")
+    elif regressions:
+        print(f"{len(regressions)} benchmarks slower than the baseline of {baseline.get('revision')}:")
+        for name in regressions:
+            print(f"  {name}")
+        sys.exit(1)
+    else:
+        print(f"No regressions against the baseline of {baseline.get('revision')}")
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,33 @@
-import socket
-import json
+import argparse
+import asyncio
 import tkinter as tk
 from tkinter import messagebox, simpledialog
 import threading
+import queue
+from client.connection import GameConnection, Event, EVENT_CONNECTED, EVENT_DISCONNECTED
+from client.render import CanvasRenderer
 from shared.common import *
+from shared.roster import Roster, ROSTER_ADD, ROSTER_REMOVE
+from shared.trace import tracer
 
 class PictionaryClient:
-    def __init__(self, master):
+    def __init__(self, master, host=HOST, port=PORT, spectate=False, room=None):
         self.master = master
-        master.title("Pictionary Game")
+        master.title("Pictionary Game (Spectating)" if spectate else "Pictionary Game")
         master.resizable(False, False)
         master.protocol("WM_DELETE_WINDOW", self.on_closing)
         
-        # Network
-        self.socket = None
-        self.connected = False
-        self.receiver_thread = None
+        # Network, run by an asyncio loop on a background thread
+        self.spectating = spectate  # Spectators watch without guessing or drawing
+        self.connection = GameConnection(host, port, role=ROLE_SPECTATOR if spectate else ROLE_PLAYER, room=room)
+        self.loop = asyncio.new_event_loop()
+        self.network_thread = None
+        self.incoming = queue.SimpleQueue()  # Events from the network thread, drained once per frame
         
         # Game state
         self.is_drawer = False
-        self.players = []
+        self.room = None  # Room the server seated us in
+        self.roster = Roster()
         self.word = None
         self.game_state = STATE_WAITING
         
@@ -27,14 +35,24 @@ class PictionaryClient:
         self.drawing = False
         self.last_x = 0
         self.last_y = 0
-        self.line_width = 2
+        self.line_width = LINE_WIDTH
         self.line_color = "black"
         
+        # Stroke batching, points are sent as one polyline per flush interval
+        self.stroke_points = []  # Points not sent yet, starting with the last sent point
+        self.stroke_started = False
+        self.stroke_id = 0  # Id of our latest stroke, new strokes count up from it
+        self.flush_pending = False
+        self.batch_started = 0  # Tracer time the first point of the batch was collected
+        
         # Build the UI
         self.setup_ui()
         
         # Connect to server
         self.connect_to_server()
+        
+        # Start handling incoming messages on the UI thread
+        self.master.after(RENDER_FRAME_MS, self.process_incoming)
     
     def setup_ui(self):
         """Create the user interface to match the C# app layout"""
@@ -65,11 +83,14 @@ class PictionaryClient:
         
         self.canvas = tk.Canvas(self.canvas_frame, bg="white", cursor="pencil")
         self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.renderer = CanvasRenderer(self.canvas, self.line_width, self.line_color)
         
         # Canvas bindings for drawing
         self.canvas.bind("<Button-1>", self.start_draw)
         self.canvas.bind("<B1-Motion>", self.draw)
         self.canvas.bind("<ButtonRelease-1>", self.stop_draw)
+        self.canvas.bind("<Button-3>", self.erase_stroke)
+        self.master.bind("<Control-z>", self.undo_stroke)
         
         # Players list and controls (right side)
         self.sidebar_frame = tk.Frame(self.middle_frame, width=200, padx=10)
@@ -84,9 +105,20 @@ class PictionaryClient:
         # Clear button (only for drawer)
         self.clear_button = tk.Button(self.sidebar_frame, text="Clear Canvas", 
                                     command=self.clear_canvas)
-        self.clear_button.pack(fill=tk.X, pady=10)
+        self.clear_button.pack(fill=tk.X, pady=(10, 0))
         self.clear_button["state"] = tk.DISABLED
         
+        # Undo button (only for drawer), right-clicking a stroke erases it
+        self.undo_button = tk.Button(self.sidebar_frame, text="Undo Stroke",
+                                   command=self.undo_stroke)
+        self.undo_button.pack(fill=tk.X, pady=(5, 10))
+        self.undo_button["state"] = tk.DISABLED
+        
+        # Replay button (between rounds, if the server records them)
+        self.replay_button = tk.Button(self.sidebar_frame, text="Replay Last Round",
+                                     command=self.replay_last_round)
+        self.replay_button.pack(fill=tk.X)
+        
         # Chat display
         tk.Label(self.sidebar_frame, text="Chat:", font=("Arial", 10, "bold")).pack(anchor=tk.W, pady=(10, 5))
         self.chat_display = tk.Text(self.sidebar_frame, width=25, height=12, state=tk.DISABLED)
@@ -113,72 +145,85 @@ class PictionaryClient:
         self.update_controls()
     
     def connect_to_server(self):
-        """Connect to the game server"""
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((HOST, PORT))
-            self.connected = True
-            self.status_label.config(text="Connected to server")
-            
-            # Start thread to receive messages
-            self.receiver_thread = threading.Thread(target=self.receive_messages)
-            self.receiver_thread.daemon = True
-            self.receiver_thread.start()
-            
-        except Exception as e:
-            self.status_label.config(text=f"Connection error: {e}")
-            messagebox.showerror("Connection Error", 
-                               f"Could not connect to server at {HOST}:{PORT}\n{str(e)}")
+        """Start the network thread, which connects and keeps reconnecting to the server"""
+        self.network_thread = threading.Thread(target=self.run_network)
+        self.network_thread.daemon = True
+        self.network_thread.start()
     
-    def receive_messages(self):
-        """Receive and process messages from the server"""
+    def run_network(self):
+        """Run the connection on the network thread's event loop"""
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.receive_events())
+    
+    async def receive_events(self):
+        """Hand every event of the connection to the UI thread"""
         try:
-            buffer = ""
-            while self.connected:
-                data = self.socket.recv(4096)
-                if not data:
-                    break
-                
-                buffer += data.decode('utf-8')
-                
-                # Process complete messages
-                while "\n" in buffer:
-                    # Split at the newline
-                    message_str, buffer = buffer.split("\n", 1)
-                    try:
-                        message = json.loads(message_str)
-                        # Process the message in the main thread
-                        self.master.after(0, lambda m=message: self.handle_message(m))
-                    except json.JSONDecodeError as e:
-                        print(f"JSON decode error: {e}")
-                    except Exception as e:
-                        print(f"Error processing message: {e}")
+            async for event in self.connection:
+                # Process the event in the main thread on its next frame
+                self.incoming.put(event)
         except Exception as e:
-            if self.connected:  # Only show error if we didn't disconnect intentionally
-                print(f"Connection error: {e}")
-                self.master.after(0, lambda: self.status_label.config(
-                    text=f"Connection lost: {e}"))
-        finally:
-            self.connected = False
-            self.master.after(0, lambda: self.status_label.config(
-                text="Disconnected from server"))
-        
-    def handle_message(self, message):
-        """Process a message from the server"""
-        msg_type = message["type"]
-        msg_data = message["data"]
-        
-        if msg_type == MSG_STATE:
+            print(f"Connection error: {e}")
+            self.incoming.put(Event(EVENT_DISCONNECTED, {"error": str(e)}))
+        
+    def process_incoming(self):
+        """Handle every event received since the last frame, then update the canvas once"""
+        try:
+            while True:
+                event = self.incoming.get_nowait()
+                if event.received:
+                    # Time the event waited for the UI thread
+                    tracer.span("queued", event.received,
+                                event.data.get("trace") if event.type == MSG_DRAW else None)
+                self.handle_message(event)
+        except queue.Empty:
+            pass
+        
+        if tracer.enabled:
+            started = tracer.now()
+            self.renderer.commit()
+            tracer.span("commit", started)
+        else:
+            self.renderer.commit()
+        self.master.after(RENDER_FRAME_MS, self.process_incoming)
+    
+    def handle_message(self, event):
+        """Process an event of the connection"""
+        msg_type = event.type
+        msg_data = event.data
+        
+        if msg_type == EVENT_CONNECTED:
+            self.status_label.config(text="Connected to server")
+        
+        elif msg_type == EVENT_DISCONNECTED:
+            # The connection retries on its own and resumes our session once it is back
+            error = msg_data.get("error")
+            self.status_label.config(text=f"Connection lost: {error}, reconnecting..." if error
+                                     else "Disconnected from server, reconnecting...")
+            self.is_drawer = False
+            self.game_state = STATE_WAITING
+            self.update_controls()
+        
+        elif msg_type == MSG_JOIN:
+            if "error" in msg_data:
+                self.status_label.config(text=f"Could not join: {msg_data['error']}")
+        
+        elif msg_type == MSG_STATE:
             # Update game state
             self.game_state = msg_data.get("state", STATE_WAITING)
-            self.players = msg_data.get("players", [])
+            if msg_data.get("room") != self.room:
+                self.room = msg_data.get("room")
+                title = "Pictionary Game (Spectating)" if self.spectating else "Pictionary Game"
+                self.master.title(f"{title} - Room {self.room}" if self.room is not None else title)
+            if "players" in msg_data:
+                # The full roster, ROSTER updates keep it current from here on
+                self.roster.reset(msg_data["players"], msg_data["roster"])
+                self.update_players_display()
             self.is_drawer = msg_data.get("is_drawer", False)
             
             if "word" in msg_data:
                 self.word = msg_data["word"]
                 self.word_label.config(text=f"Word to draw: {self.word}")
             
-            self.update_players_display()
             self.update_controls()
             
             # Update status message
@@ -189,27 +234,69 @@ class PictionaryClient:
             elif self.game_state == STATE_PLAYING:
                 if self.is_drawer:
                     self.status_label.config(text="Game Status: Your turn to draw!")
+                elif self.spectating:
+                    self.status_label.config(text="Game Status: Spectating")
                 else:
-                    self.status_label.config(text="Game Status: Guess the word!")
+                    category = msg_data.get("category")
+                    if category:
+                        self.status_label.config(text=f"Game Status: Guess the word! (Category: {category})")
+                    else:
+                        self.status_label.config(text="Game Status: Guess the word!")
             elif self.game_state == STATE_ROUND_END:
                 self.status_label.config(text="Game Status: Round ended!")
                 
         elif msg_type == MSG_DRAW:
             # Draw on canvas
             if not self.is_drawer:  # Only process draw messages if we're not the drawer
-                x1, y1, x2, y2 = msg_data["x1"], msg_data["y1"], msg_data["x2"], msg_data["y2"]
-                self.canvas.create_line(x1, y1, x2, y2, width=self.line_width, 
-                                       fill=self.line_color, capstyle=tk.ROUND, smooth=True)
+                if tracer.enabled:
+                    started = tracer.now()
+                    self.renderer.draw(msg_data)
+                    tracer.span("render", started, msg_data.get("trace"))
+                else:
+                    self.renderer.draw(msg_data)
+        
+        elif msg_type == MSG_SNAPSHOT:
+            # Replace the canvas with the server's copy of the drawing
+            raster, draws = unpack_drawing(msg_data["drawing"])
+            self.renderer.clear()
+            self.renderer.draw_flat(draws, raster)
+        
+        elif msg_type == MSG_ROSTER:
+            changes = self.roster.apply(msg_data)
+            if changes is None:
+                # An update went missing, ask for the whole roster again
+                self.send_message(MSG_SYNC, {"version": self.connection.drawing_version,
+                                             "roster": self.roster.version})
+            else:
+                self.apply_roster_changes(changes)
         
         elif msg_type == MSG_CLEAR:
             # Clear the canvas
-            self.canvas.delete("all")
+            self.renderer.clear()
+        
+        elif msg_type == MSG_ERASE:
+            # Take erased strokes off the canvas, those only in a snapshot's raster need a fresh snapshot
+            if not self.renderer.erase(msg_data["strokes"]):
+                self.send_message(MSG_SYNC, {"version": self.connection.drawing_version})
         
         elif msg_type == MSG_GUESS:
-            # Display guess in chat
-            player = msg_data["player"]
-            guess = msg_data["guess"]
-            self.add_to_chat(f"{player}: {guess}")
+            # Display a guess, or a digest of several, in chat
+            for guess in msg_data.get("guesses", [msg_data]):
+                self.add_to_chat(f"{guess['player']}: {guess['guess']}")
+        
+        elif msg_type == MSG_HINT:
+            # Private feedback on our own guess
+            if msg_data.get("hint") == "close":
+                self.add_to_chat(f"*** {msg_data['guess']} is close! ***")
+        
+        elif msg_type == MSG_REPLAY:
+            # Progress of a replay we asked for
+            if "error" in msg_data:
+                self.add_to_chat(f"*** Replay unavailable: {msg_data['error']} ***")
+            elif msg_data.get("replay") == "started":
+                self.add_to_chat(f"*** Replaying {msg_data['drawer']}'s drawing of {msg_data['word']} ***")
+            elif msg_data.get("replay") == "finished":
+                self.add_to_chat("*** Replay finished ***")
         
         elif msg_type == MSG_COUNTDOWN:
             # Update countdown display
@@ -233,26 +320,38 @@ class PictionaryClient:
                     self.add_to_chat(f"*** Round ended: {error} ***")
     
     def update_players_display(self):
-        """Update the players listbox"""
+        """Fill the players listbox from the whole roster"""
         self.players_listbox.delete(0, tk.END)
         
-        for player in self.players:
-            name = player["name"]
-            score = player["score"]
-            is_drawer = player["is_drawer"]
-            
-            player_info = f"{name} ({score})"
-            if is_drawer:
-                player_info += " (Drawing)"
-            
-            self.players_listbox.insert(tk.END, player_info)
+        for player in self.roster:
+            self.players_listbox.insert(tk.END, self.player_info(player))
+    
+    def apply_roster_changes(self, changes):
+        """Update only the rows of the players listbox that changed"""
+        for op, position, player in changes:
+            if op != ROSTER_ADD:
+                self.players_listbox.delete(position)
+            if op != ROSTER_REMOVE:
+                self.players_listbox.insert(position, self.player_info(player))
+    
+    def player_info(self, player):
+        """A player's line in the players listbox"""
+        player_info = f"{player['name']} ({player['score']})"
+        if player["is_drawer"]:
+            player_info += " (Drawing)"
+        if player.get("away"):
+            player_info += " (Reconnecting)"
+        return player_info
     
     def update_controls(self):
         """Update control states based on game state and player role"""
+        self.replay_button["state"] = tk.DISABLED if self.game_state == STATE_PLAYING else tk.NORMAL
+        
         if self.is_drawer and self.game_state == STATE_PLAYING:
             # Drawer can draw and clear
             self.canvas.config(cursor="pencil")
             self.clear_button["state"] = tk.NORMAL
+            self.undo_button["state"] = tk.NORMAL
             self.guess_entry["state"] = tk.DISABLED
             self.guess_button["state"] = tk.DISABLED
             self.word_label.pack(fill=tk.X)
@@ -260,8 +359,9 @@ class PictionaryClient:
             # Non-drawer or not playing
             self.canvas.config(cursor="arrow")
             self.clear_button["state"] = tk.DISABLED
+            self.undo_button["state"] = tk.DISABLED
             
-            if self.game_state == STATE_PLAYING and not self.is_drawer:
+            if self.game_state == STATE_PLAYING and not self.is_drawer and not self.spectating:
                 # Guesser can guess during play
                 self.guess_entry["state"] = tk.NORMAL
                 self.guess_button["state"] = tk.NORMAL
@@ -280,24 +380,27 @@ class PictionaryClient:
             self.drawing = True
             self.last_x = event.x
             self.last_y = event.y
+            self.stroke_points = [event.x, event.y]
+            self.stroke_started = False
+            self.stroke_id += 1
     
     def draw(self, event):
         """Handle mouse drag event for drawing"""
         if self.drawing and self.is_drawer and self.game_state == STATE_PLAYING:
             x, y = event.x, event.y
-            # Draw line on canvas
-            self.canvas.create_line(self.last_x, self.last_y, x, y, 
-                                   width=self.line_width, fill=self.line_color, 
-                                   capstyle=tk.ROUND, smooth=True)
+            # Draw line on canvas right away
+            self.renderer.draw({"x1": self.last_x, "y1": self.last_y, "x2": x, "y2": y, "stroke": self.stroke_id})
+            self.renderer.commit()
             
-            # Send drawing data to server
-            draw_data = {
-                "x1": self.last_x,
-                "y1": self.last_y,
-                "x2": x,
-                "y2": y
-            }
-            self.send_message(MSG_DRAW, draw_data)
+            # Collect the point, it is sent with the rest of the batch
+            self.stroke_points += (x, y)
+            if len(self.stroke_points) >= MAX_DRAW_POINTS * 2:
+                self.flush_stroke()
+            if not self.flush_pending:
+                self.flush_pending = True
+                if tracer.enabled:
+                    self.batch_started = tracer.now()
+                self.master.after(STROKE_FLUSH_MS, self.flush_stroke)
             
             # Update last position
             self.last_x = x
@@ -305,17 +408,61 @@ class PictionaryClient:
     
     def stop_draw(self, event):
         """Handle mouse up event for drawing"""
+        if self.drawing:
+            self.flush_stroke(end=True)
         self.drawing = False
     
+    def flush_stroke(self, end=False):
+        """Send the points collected since the last flush as one polyline"""
+        self.flush_pending = False
+        if not self.is_drawer or self.game_state != STATE_PLAYING:
+            self.stroke_points = []
+            return
+        
+        # A stroke that was never sent has nothing to end
+        if len(self.stroke_points) < 4 and not (end and self.stroke_started):
+            return
+        
+        draw_data = {"points": self.stroke_points, "stroke": self.stroke_id}
+        if end:
+            draw_data["end"] = True
+        if tracer.enabled:
+            # Follow this polyline through the server to the other clients
+            draw_data["trace"] = tracer.new_id()
+            tracer.span("stroke", self.batch_started or tracer.now(), draw_data["trace"])
+            self.batch_started = 0
+        self.send_message(MSG_DRAW, draw_data)
+        self.stroke_started = True
+        
+        # The next polyline continues from the last point sent
+        self.stroke_points = self.stroke_points[-2:]
+    
     def clear_canvas(self):
         """Clear the drawing canvas"""
         if self.is_drawer and self.game_state == STATE_PLAYING:
-            self.canvas.delete("all")
+            self.renderer.clear()
             self.send_message(MSG_CLEAR, {})
     
+    def undo_stroke(self, event=None):
+        """Ask the server to erase the newest stroke, for everyone"""
+        if self.is_drawer and self.game_state == STATE_PLAYING and not self.drawing:
+            self.send_message(MSG_UNDO, {})
+    
+    def erase_stroke(self, event):
+        """Ask the server to erase the stroke under the pointer, for everyone"""
+        if self.is_drawer and self.game_state == STATE_PLAYING and not self.drawing:
+            stroke_id = self.renderer.stroke_at(event.x, event.y)
+            if stroke_id is not None:
+                self.send_message(MSG_ERASE, {"strokes": [stroke_id]})
+    
+    def replay_last_round(self):
+        """Ask the server to play back the last recorded round"""
+        if self.game_state != STATE_PLAYING:
+            self.send_message(MSG_REPLAY, {"id": "latest", "speed": REPLAY_SPEED})
+    
     def send_guess(self, event=None):
         """Send a word guess to the server"""
-        if not self.is_drawer and self.game_state == STATE_PLAYING:
+        if not self.is_drawer and not self.spectating and self.game_state == STATE_PLAYING:
             guess = self.guess_entry.get().strip()
             if guess:
                 self.send_message(MSG_GUESS, {"guess": guess})
@@ -329,27 +476,34 @@ class PictionaryClient:
         self.chat_display.config(state=tk.DISABLED)
     
     def send_message(self, msg_type, data):
-        """Send a message to the server"""
-        if self.connected:
-            try:
-                message = encode_message(msg_type, data)
-                self.socket.send(message)
-            except Exception as e:
-                print(f"Error sending message: {e}")
-                self.status_label.config(text=f"Error sending message: {e}")
+        """Send a message to the server from the network thread, without waiting for it"""
+        self.loop.call_soon_threadsafe(self.connection.send, msg_type, data)
+    
+    def dump_trace(self, event=None):
+        """Write the recorded trace to a file"""
+        if tracer.enabled:
+            tracer.dump_in_background(lambda path: print(f"Trace written to {path}"))
     
     def on_closing(self):
         """Handle window close event"""
         # Clean disconnect
-        self.connected = False
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
+        self.loop.call_soon_threadsafe(self.connection.close)
         self.master.destroy()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play Pictionary")
+    parser.add_argument("--host", default=HOST, help="Address of the game server or relay")
+    parser.add_argument("--port", type=int, default=PORT, help="Port of the game server or relay")
+    parser.add_argument("--spectate", action="store_true", help="Watch the game without taking part")
+    parser.add_argument("--room", type=int, help="Room to join, one with a free seat if not given")
+    parser.add_argument("--trace", action="store_true",
+                        help="Record message handling spans, dumped with F12 or on SIGUSR1")
+    args = parser.parse_args()
+    if args.trace:
+        tracer.enable("client")
+        tracer.install_signal_handler(lambda path: print(f"Trace written to {path}"))
+
     root = tk.Tk()
-    client = PictionaryClient(root)
+    client = PictionaryClient(root, args.host, args.port, args.spectate, args.room)
+    root.bind("<F12>", client.dump_trace)
     root.mainloop()
\ No newline at end of file
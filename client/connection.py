@@ -0,0 +1,197 @@
+import asyncio
+import json
+import logging
+import struct
+from shared.common import *
+from shared.trace import tracer
+
+logger = logging.getLogger(__name__)
+
+# Connection events, delivered alongside the server's message types
+EVENT_CONNECTED = "CONNECTED"
+EVENT_DISCONNECTED = "DISCONNECTED"
+
+class Event:
+    """A message from the server or a change of the connection"""
+    __slots__ = ("type", "data", "received")
+
+    def __init__(self, type, data, received=0):
+        self.type = type
+        self.data = data
+        self.received = received  # Tracer time the message was decoded, 0 when not tracing
+
+    def __repr__(self):
+        return f"Event({self.type!r}, {self.data!r})"
+
+class GameConnection:
+    """Asyncio connection to a Pictionary server, independent of any user interface
+
+    Iterating over the connection connects and yields an Event for every
+    server message. Sends never block: everything sent during one event loop
+    iteration goes out in a single write. With reconnect enabled a lost
+    connection is retried with exponential backoff, and iteration continues
+    with a DISCONNECTED and, once back, a CONNECTED event. A reconnected client
+    resumes its session: the server keeps its seat for a while and sends only
+    the broadcasts it missed.
+    """
+
+    def __init__(self, host=HOST, port=PORT, formats=WIRE_FORMATS, compression=COMPRESSION_METHODS,
+                 reconnect=True, role=ROLE_PLAYER, room=None):
+        self.host = host
+        self.port = port
+        self.formats = formats
+        self.compression_methods = compression
+        self.role = role
+        self.room = room  # Room to join, None to be matched into one
+        self.reconnect = reconnect
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.wire_format = FORMAT_JSON  # Until the server confirms another one
+        self.compression = None
+        self.drawing_version = None  # Version of the last snapshot, sent back when asking for a resync
+        self.resume_token = None  # Issued by the server when we join, sent back to resume after a reconnect
+        self.sequence = None  # Number of the last broadcast received
+        self.pending = []  # Encoded messages waiting for the next flush
+        self.flush_scheduled = False
+        self.closed = False
+
+        # Traffic counters, kept over reconnects
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+        self.bytes_received = 0
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    def __aiter__(self):
+        return self.events()
+
+    async def connect(self):
+        """Open the connection, offer our wire formats and compression methods, and state our role and room or resume our session"""
+        self.loop = asyncio.get_running_loop()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.wire_format = FORMAT_JSON
+        self.compression = None
+        join = {"formats": self.formats, "compression": self.compression_methods, "role": self.role}
+        if self.room is not None:
+            join["room"] = self.room
+        if self.resume_token is not None:
+            join["resume"] = {"token": self.resume_token, "seq": self.sequence}
+        self.send(MSG_JOIN, join)
+
+    async def events(self):
+        """Yield connection events and server messages until the connection is closed"""
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            try:
+                await self.connect()
+            except OSError as e:
+                if not self.reconnect:
+                    raise
+                yield Event(EVENT_DISCONNECTED, {"error": str(e)})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+
+            delay = RECONNECT_DELAY
+            yield Event(EVENT_CONNECTED, {"host": self.host, "port": self.port})
+
+            error = None
+            try:
+                async for event in self.read_messages():
+                    yield event
+            except OSError as e:
+                error = str(e)
+            finally:
+                self.drop_connection()
+
+            if self.closed:
+                break
+            yield Event(EVENT_DISCONNECTED, {"error": error} if error else {})
+            if not self.reconnect:
+                break
+            await asyncio.sleep(delay)
+
+    async def read_messages(self):
+        """Yield the messages of the current connection until the server closes it"""
+        decoder = FrameDecoder()
+        while True:
+            data = await self.reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return
+            self.bytes_received += len(data)
+            decoder.feed(data)
+
+            # Frames point into the decoder's buffer, each is decoded before the next read
+            for frame in decoder.frames():
+                started = tracer.now() if tracer.enabled else 0
+                try:
+                    message = decode_message(frame)
+                except (json.JSONDecodeError, struct.error, ValueError) as e:
+                    logger.warning("Message decode error: %s", e)
+                    # The drawing may have missed an update, ask for a fresh snapshot
+                    self.send(MSG_SYNC, {"version": self.drawing_version})
+                    continue
+
+                self.messages_received += 1
+                msg_type, data = message["type"], message["data"]
+                if "seq" in message:
+                    self.sequence = message["seq"]
+                if msg_type == MSG_JOIN:
+                    # The server confirmed the wire format and compression for the rest of the session
+                    self.wire_format = data.get("format", FORMAT_JSON)
+                    self.compression = data.get("compression")
+                    self.resume_token = data.get("token")
+                    self.sequence = data.get("seq")
+                elif msg_type == MSG_SNAPSHOT:
+                    self.drawing_version = data["version"]
+                if started:
+                    tracer.span(f"decode {msg_type}", started, data.get("trace") if msg_type == MSG_DRAW else None)
+                    yield Event(msg_type, data, tracer.now())
+                else:
+                    yield Event(msg_type, data)
+
+    def send(self, msg_type, data):
+        """Queue a message for the next write, False while disconnected"""
+        if self.writer is None:
+            return False
+        started = tracer.now() if tracer.enabled else 0
+        message = encode_message(msg_type, data, self.wire_format, self.compression)
+        if started:
+            tracer.span(f"encode {msg_type}", started, data.get("trace") if msg_type == MSG_DRAW else None)
+        self.pending.append(message)
+        self.messages_sent += 1
+        self.bytes_sent += len(message)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+        return True
+
+    def flush(self):
+        """Write every queued message at once"""
+        self.flush_scheduled = False
+        if self.pending and self.writer is not None:
+            self.writer.write(b"".join(self.pending))
+        self.pending = []
+
+    async def drain(self):
+        """Write queued messages and wait until the socket accepted them"""
+        self.flush()
+        if self.writer is not None:
+            await self.writer.drain()
+
+    def close(self):
+        """Close the connection for good, ending the event iteration"""
+        self.closed = True
+        self.drop_connection()
+
+    def drop_connection(self):
+        """Close the current socket, queued messages are lost"""
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None
+        self.pending = []
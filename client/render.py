@@ -0,0 +1,207 @@
+import base64
+import tkinter as tk
+from itertools import islice
+from shared.common import *
+from shared.raster import Bitmap
+
+class RenderedStroke:
+    """A canvas line item and the points it shows, all or part of one stroke"""
+    __slots__ = ("id", "item", "points", "dirty")
+
+    def __init__(self, stroke_id, points):
+        self.id = stroke_id
+        self.item = None
+        self.points = points
+        self.dirty = True
+
+def stroke_tag(stroke_id):
+    """Canvas tag of the line items of a stroke"""
+    return f"stroke-{stroke_id}"
+
+def near_polyline(points, x, y, distance):
+    """Check whether a point lies within a distance of a flat polyline"""
+    limit = distance * distance
+    for i in range(0, len(points) - 2, 2):
+        x1, y1, x2, y2 = points[i:i + 4]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = 0 if length == 0 else max(0, min(1, ((x - x1) * dx + (y - y1) * dy) / length))
+        px, py = x1 + t * dx - x, y1 + t * dy - y
+        if px * px + py * py <= limit:
+            return True
+    return len(points) == 2 and (points[0] - x) ** 2 + (points[1] - y) ** 2 <= limit
+
+class CanvasRenderer:
+    """Draws strokes on a Tk canvas with as few canvas items as possible
+
+    Draw data that continues the newest stroke extends its line item instead of
+    creating a new one, changes are pushed to the canvas once per commit, and
+    once too many line items pile up the older ones are flattened into a single
+    image layer. Line items are tagged with their stroke id, so erasing a stroke
+    deletes its items without touching the rest of the drawing; only erasing a
+    flattened stroke redraws the image layer.
+    """
+
+    def __init__(self, canvas, line_width=LINE_WIDTH, line_color="black"):
+        self.canvas = canvas
+        self.line_width = line_width
+        self.line_color = line_color
+        self.strokes = {}  # Key -> RenderedStroke still drawn as a line item, oldest first
+        self.flat = {}  # Key -> points of a stroke flattened into the image layer
+        self.parts = {}  # Stroke id -> keys of its line items and flattened points
+        self.next_key = 0
+        self.newest_key = None  # Key of the line item new points may continue
+        self.base = None  # (width, height, pixels) raster of a snapshot, under every stroke
+        self.bitmap = None
+        self.layer = None  # PhotoImage holding the flattened strokes
+        self.layer_item = None
+
+    def add_part(self, stroke_id):
+        """Key for new points of a stroke, remembered under the stroke id so they can be erased"""
+        key = self.next_key
+        self.next_key += 1
+        if stroke_id is not None:
+            self.parts.setdefault(stroke_id, []).append(key)
+        return key
+
+    def draw(self, draw_data):
+        """Queue a segment or polyline for the next commit"""
+        if "points" in draw_data:
+            points = list(draw_data["points"])
+        else:
+            points = [draw_data["x1"], draw_data["y1"], draw_data["x2"], draw_data["y2"]]
+        if len(points) < 2:
+            return
+        stroke_id = draw_data.get("stroke")
+
+        newest = self.strokes.get(self.newest_key)
+        if (newest is not None and newest.id == stroke_id and newest.points[-2:] == points[:2]
+                and len(newest.points) < MAX_ITEM_POINTS * 2):
+            newest.points.extend(points[2:])
+            newest.dirty = True
+        else:
+            self.newest_key = self.add_part(stroke_id)
+            self.strokes[self.newest_key] = RenderedStroke(stroke_id, points)
+
+    def commit(self):
+        """Push queued strokes to the canvas"""
+        for stroke in reversed(self.strokes.values()):
+            if not stroke.dirty:
+                break  # Only the newest strokes can have changed
+            stroke.dirty = False
+            if len(stroke.points) < 4:
+                stroke.dirty = True  # A single point, wait for the stroke to continue
+                continue
+            if stroke.item is None:
+                tags = () if stroke.id is None else stroke_tag(stroke.id)
+                stroke.item = self.canvas.create_line(*stroke.points, width=self.line_width,
+                                                      fill=self.line_color, capstyle=tk.ROUND,
+                                                      joinstyle=tk.ROUND, tags=tags)
+            else:
+                self.canvas.coords(stroke.item, *stroke.points)
+
+        if len(self.strokes) > FLATTEN_ITEM_LIMIT:
+            # Keep the newest stroke as a line item, it may still be extended
+            self.flatten(len(self.strokes) - 1)
+
+    def draw_flat(self, draws, raster=None):
+        """Draw straight into the image layer, on top of a (width, height, pixels) raster if given
+
+        For bulk drawing such as snapshots, which become a single image.
+        """
+        bitmap = self.get_bitmap()
+        if raster is not None:
+            self.base = raster
+            bitmap.paste(*raster)
+        polylines = []
+        for draw_data in draws:
+            points = draw_data["points"] if "points" in draw_data else [
+                draw_data["x1"], draw_data["y1"], draw_data["x2"], draw_data["y2"]]
+            self.flat[self.add_part(draw_data.get("stroke"))] = points
+            polylines.append(points)
+        bitmap.draw_polylines(polylines, self.line_width)
+        self.update_layer()
+
+    def flatten(self, count):
+        """Move the oldest strokes from line items into the image layer"""
+        oldest = list(islice(self.strokes, count))
+        polylines = []
+        for key in oldest:
+            stroke = self.strokes.pop(key)
+            if stroke.item is not None:
+                self.canvas.delete(stroke.item)
+            self.flat[key] = stroke.points
+            polylines.append(stroke.points)
+        self.get_bitmap().draw_polylines(polylines, self.line_width)
+        self.update_layer()
+
+    def erase(self, stroke_ids):
+        """Remove strokes by id, False if some may be part of a snapshot's raster and need a fresh snapshot"""
+        missing = False
+        redraw = False
+        for stroke_id in stroke_ids:
+            keys = self.parts.pop(stroke_id, None)
+            if keys is None:
+                missing = True
+                continue
+            self.canvas.delete(stroke_tag(stroke_id))
+            for key in keys:
+                if self.strokes.pop(key, None) is None and self.flat.pop(key, None) is not None:
+                    redraw = True
+        if redraw:
+            # The image layer cannot take a stroke out, draw it again from the strokes that are left
+            bitmap = self.get_bitmap()
+            bitmap.clear()
+            if self.base is not None:
+                bitmap.paste(*self.base)
+            bitmap.draw_polylines(list(self.flat.values()), self.line_width)
+            self.update_layer()
+        return not (missing and self.base is not None)
+
+    def stroke_at(self, x, y, halo=4):
+        """Id of the topmost stroke near a point, None if there is none"""
+        for item in reversed(self.canvas.find_overlapping(x - halo, y - halo, x + halo, y + halo)):
+            for tag in self.canvas.gettags(item):
+                if tag.startswith("stroke-"):
+                    return int(tag[len("stroke-"):])
+
+        # Flattened strokes are pixels of the image layer, test their points instead, newest first
+        distance = halo + self.line_width / 2
+        found, found_key = None, -1
+        for stroke_id, keys in self.parts.items():
+            for key in keys:
+                if key > found_key and key in self.flat and near_polyline(self.flat[key], x, y, distance):
+                    found, found_key = stroke_id, key
+        return found
+
+    def clear(self):
+        """Remove everything from the canvas"""
+        self.canvas.delete("all")
+        self.strokes = {}
+        self.flat = {}
+        self.parts = {}
+        self.newest_key = None
+        self.base = None
+        self.layer_item = None
+        if self.bitmap is not None:
+            self.bitmap.clear()
+
+    def get_bitmap(self):
+        """Bitmap covering the canvas, created on first use"""
+        if self.bitmap is None:
+            width = max(self.canvas.winfo_width(), CANVAS_SIZE)
+            height = max(self.canvas.winfo_height(), CANVAS_SIZE)
+            self.bitmap = Bitmap(width, height)
+        return self.bitmap
+
+    def update_layer(self):
+        """Show the current bitmap as the bottom-most canvas item"""
+        data = base64.b64encode(self.bitmap.to_png())
+        if self.layer is None:
+            self.layer = tk.PhotoImage(data=data, format="png")
+        else:
+            self.layer.configure(data=data, format="png")
+
+        if self.layer_item is None:
+            self.layer_item = self.canvas.create_image(0, 0, image=self.layer, anchor=tk.NW)
+            self.canvas.tag_lower(self.layer_item)
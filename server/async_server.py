@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+from server.server import PictionaryServer
+from shared.common import *
+
+logger = logging.getLogger(__name__)
+
+class ClientConnection:
+    """A client connection with its own bounded outbound queue and writer task"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self.queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.writer.transport.set_write_buffer_limits(high=TRANSPORT_HIGH_WATER)
+        self.closed = False
+        self.decoder = FrameDecoder()
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+
+    def send(self, message):
+        """Queue an encoded message without waiting for the socket"""
+        if self.closed or self.writer.transport.is_closing():
+            return  # The connection is gone, its reader will disconnect it
+        if self.queue.empty() and self.writer.transport.get_write_buffer_size() < TRANSPORT_HIGH_WATER:
+            # The transport still has room, hand the message over right away
+            self.writer.write(message)
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The client cannot keep up, drop it instead of stalling the room
+            logger.warning("Outbound queue full for %s, dropping client", self.address)
+            self.closed = True
+            self.server.loop.call_soon(self.server.handle_disconnect, self)
+
+    async def write_loop(self):
+        """Write queued messages to the socket, one drain per batch"""
+        try:
+            while True:
+                message = await self.queue.get()
+                self.writer.write(message)
+
+                # Write everything else that is already queued before draining
+                while not self.queue.empty():
+                    self.writer.write(self.queue.get_nowait())
+
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.info("Error writing to %s: %s", self.address, e)
+            self.closed = True
+            self.server.loop.call_soon(self.server.handle_disconnect, self)
+
+    def close(self):
+        """Stop the writer task and close the transport"""
+        self.closed = True
+        self.writer_task.cancel()
+        self.writer.close()
+
+class AsyncPictionaryServer(PictionaryServer):
+    """Pictionary server driven by an asyncio event loop"""
+
+    def __init__(self, host=HOST, port=PORT, recording_dir=RECORDING_DIR, room_size=ROOM_SIZE, listener=None):
+        super().__init__(host, port, recording_dir, room_size, listener)
+        self.loop = None
+
+    def run(self):
+        """Main server loop"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Accept connections on the listening socket until cancelled"""
+        self.loop = asyncio.get_running_loop()
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer, data=b""):
+        """Read messages from one client until it disconnects, starting with data already received"""
+        connection = ClientConnection(self, reader, writer)
+        logger.info("New connection from %s", connection.address)
+        self.register_client(connection, connection.address)
+
+        try:
+            decoder = connection.decoder
+            while not connection.closed:
+                if not data:
+                    data = await reader.read(RECV_BUFFER_SIZE)
+                    if not data:
+                        break  # Client disconnected
+                started = time.perf_counter()
+                decoder.feed(data)
+                data = b""
+
+                for frame in decoder.frames():
+                    self.handle_frame(connection, frame)
+
+                self.metrics.handle_time.observe(time.perf_counter() - started)
+        except OSError as e:
+            logger.info("Lost connection to %s: %s", connection.address, e)
+        except Exception as e:
+            logger.warning("Error handling client message: %s", e)
+        finally:
+            self.handle_disconnect(connection)
+
+    def close_client(self, client):
+        """Release the transport of a client that left the game"""
+        client.close()
+
+    def send_to_client(self, client, message, droppable=False):
+        """Queue an encoded message for a single client"""
+        client.send(message)
+
+    def queue_depths(self):
+        """Name and number of queued messages of every client, for the metrics endpoint"""
+        return [(info["name"], client.queue.qsize()) for client, info in list(self.clients.items())]
+
+    def schedule(self, delay, callback):
+        """Run a callback on the event loop after the given delay in seconds"""
+        return self.loop.call_later(delay, callback)
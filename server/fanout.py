@@ -0,0 +1,96 @@
+import os
+import socket
+from collections import deque
+
+# Largest number of buffers handed to a single sendmsg call
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+class OutboundBuffer:
+    """Frames waiting to be written to one client socket
+
+    Frames are kept as memoryviews so a broadcast frame is shared by every
+    recipient instead of being copied into each client's buffer.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.frames = deque()
+        self.pending_bytes = 0
+        self.lagging = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def depth(self):
+        """Number of frames waiting to be written"""
+        return len(self.frames)
+
+    def push(self, frame):
+        """Queue an encoded frame for sending"""
+        view = frame if isinstance(frame, memoryview) else memoryview(frame)
+        if view.nbytes:
+            self.frames.append(view)
+            self.pending_bytes += view.nbytes
+
+    def flush(self):
+        """Write as much as the socket accepts, return True once drained
+
+        Raises OSError when the connection is broken.
+        """
+        while self.frames:
+            try:
+                if HAS_SENDMSG:
+                    batch = [self.frames[i] for i in range(min(len(self.frames), IOV_MAX))]
+                    sent = self.sock.sendmsg(batch)
+                else:
+                    sent = self.sock.send(self.frames[0])
+            except (BlockingIOError, InterruptedError):
+                return False
+
+            if sent == 0:
+                return False
+            self.consume(sent)
+        return True
+
+    def consume(self, sent):
+        """Drop the first sent bytes from the queue, keeping partial frames"""
+        self.pending_bytes -= sent
+        while sent:
+            frame = self.frames[0]
+            if sent < frame.nbytes:
+                self.frames[0] = frame[sent:]
+                return
+            sent -= frame.nbytes
+            self.frames.popleft()
+
+class BroadcastHistory:
+    """The most recent broadcasts of the game, numbered in the order they were sent
+
+    A client that lost its connection reports the last number it received when
+    it resumes, and gets the broadcasts after it instead of a full resync.
+    """
+
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)  # (sequence, message type, data)
+        self.sequence = 0  # Number of the last broadcast
+
+    def append(self, msg_type, data):
+        """Number a broadcast and keep it, returns its sequence number"""
+        self.sequence += 1
+        self.messages.append((self.sequence, msg_type, data))
+        return self.sequence
+
+    def since(self, sequence):
+        """Broadcasts after the given sequence number, None if some of them are no longer kept"""
+        if not isinstance(sequence, int) or sequence > self.sequence:
+            return None
+        first = self.messages[0][0] if self.messages else self.sequence + 1
+        if sequence < first - 1:
+            return None
+        return list(self.messages)[sequence - first + 1:]
@@ -0,0 +1,44 @@
+import time
+
+class TokenBucket:
+    """Allows rate messages per second on average and bursts of up to burst messages"""
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self):
+        """Add the tokens earned since the last refill, up to the burst size"""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self):
+        """True if a message may pass right now"""
+        self.refill()
+        return self.tokens >= 1
+
+    def consume(self, count=1):
+        """Take tokens, going into debt if there are not enough"""
+        self.tokens -= count
+
+    def time_until_ready(self):
+        """Seconds until a message may pass"""
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+def take_token(buckets):
+    """Take a token from every bucket, or from none if any of them is empty"""
+    if all(bucket.ready() for bucket in buckets):
+        for bucket in buckets:
+            bucket.consume()
+        return True
+    return False
+
+def make_buckets(limits):
+    """A token bucket per message type from a {type: (rate, burst)} mapping"""
+    return {msg_type: TokenBucket(rate, burst) for msg_type, (rate, burst) in limits.items()}
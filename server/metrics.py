@@ -0,0 +1,169 @@
+import bisect
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from shared.trace import tracer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from 10 microseconds to about 1.3 seconds
+LATENCY_BUCKETS = tuple(0.00001 * 2 ** i for i in range(18))
+
+class Histogram:
+    """Counts of observed values per bucket, rendered as a Prometheus histogram"""
+    __slots__ = ("bounds", "counts", "total", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # The last slot is the +Inf bucket
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        """Text exposition lines of the histogram"""
+        separator = "," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound:.6g}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.total}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class ServerMetrics:
+    """Counters and timings of one server, updated by the thread that runs the game
+
+    Updates are plain dict and attribute increments so they stay cheap on the
+    hot path. Rendering happens on the HTTP thread and only reads snapshots
+    of the dicts.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.messages_received = {}  # Message type -> count
+        self.bytes_received = {}
+        self.messages_sent = {}
+        self.bytes_sent = {}
+        self.messages_limited = {}  # Message type -> messages over a rate limit
+        self.handle_time = Histogram()
+        self.broadcast_time = Histogram()
+        self.loop_time = Histogram()
+        self.connections = 0
+        self.rounds = 0
+        self.guesses = 0
+        self.correct_guesses = 0
+
+    def received(self, msg_type, size):
+        """Count a message received from a client"""
+        self.messages_received[msg_type] = self.messages_received.get(msg_type, 0) + 1
+        self.bytes_received[msg_type] = self.bytes_received.get(msg_type, 0) + size
+
+    def sent(self, msg_type, size, recipients=1):
+        """Count a message sent to one or more clients, size being the total of all copies"""
+        self.messages_sent[msg_type] = self.messages_sent.get(msg_type, 0) + recipients
+        self.bytes_sent[msg_type] = self.bytes_sent.get(msg_type, 0) + size
+
+    def limited(self, msg_type):
+        """Count a message that exceeded a rate limit"""
+        self.messages_limited[msg_type] = self.messages_limited.get(msg_type, 0) + 1
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for name, counts, help_text in (
+                ("pictionary_messages_received_total", self.messages_received, "Messages received from clients"),
+                ("pictionary_bytes_received_total", self.bytes_received, "Bytes of messages received from clients"),
+                ("pictionary_messages_sent_total", self.messages_sent, "Messages queued for clients"),
+                ("pictionary_bytes_sent_total", self.bytes_sent, "Bytes of messages queued for clients"),
+                ("pictionary_messages_limited_total", self.messages_limited,
+                 "Messages over a rate limit, dropped or merged into later ones")):
+            family(name, "counter", help_text)
+            for msg_type, value in sorted(dict(counts).items()):
+                lines.append(f'{name}{{type="{msg_type}"}} {value}')
+
+        for name, histogram, help_text in (
+                ("pictionary_handle_message_seconds", self.handle_time, "Time to handle the data of one read"),
+                ("pictionary_broadcast_seconds", self.broadcast_time, "Time to encode and queue one broadcast"),
+                ("pictionary_loop_iteration_seconds", self.loop_time,
+                 "Time spent in one server loop iteration, not counting the wait for activity")):
+            family(name, "histogram", help_text)
+            lines.extend(histogram.render(name))
+
+        family("pictionary_client_queue_messages", "gauge", "Messages waiting to be written to each client")
+        depths = self.server.queue_depths()
+        for name, depth in depths:
+            lines.append(f'pictionary_client_queue_messages{{client="{name}"}} {depth}')
+
+        for name, kind, value, help_text in (
+                ("pictionary_clients", "gauge", len(self.server.clients), "Connected clients"),
+                ("pictionary_rooms", "gauge", len(self.server.rooms), "Open rooms"),
+                ("pictionary_connections_total", "counter", self.connections, "Connections accepted"),
+                ("pictionary_rounds_total", "counter", self.rounds, "Rounds started"),
+                ("pictionary_guesses_total", "counter", self.guesses, "Guesses received during rounds"),
+                ("pictionary_correct_guesses_total", "counter", self.correct_guesses, "Guesses that won a round")):
+            family(name, kind, help_text)
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics of the server attached to the HTTP server"""
+
+    def do_GET(self):
+        if self.path == "/trace":
+            self.send_trace()
+            return
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.metrics.render().encode("utf-8")
+        except Exception as e:
+            # The game thread may change the server while we read it, try again on the next scrape
+            logger.warning("Error rendering metrics: %s", e)
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_trace(self):
+        """Send the tracer's spans as a Chrome trace"""
+        if not tracer.enabled:
+            self.send_error(404, "Tracing is off")
+            return
+        body = json.dumps(tracer.chrome_trace()).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+def start_metrics_server(metrics, host, port):
+    """Serve metrics over HTTP from a daemon thread"""
+    http_server = ThreadingHTTPServer((host, port), MetricsHandler)
+    http_server.daemon_threads = True
+    http_server.metrics = metrics
+    thread = threading.Thread(target=http_server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info("Metrics available on http://%s:%d/metrics", host, port)
+    return http_server
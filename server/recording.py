@@ -0,0 +1,286 @@
+import bisect
+import logging
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from array import array
+from shared.common import *
+
+logger = logging.getLogger(__name__)
+
+FILE_MAGIC = b"PICTREC1"
+RECORD_TIME = struct.Struct("!I")  # Milliseconds since the round started, followed by a binary frame
+RECORDING_SUFFIX = ".rec"
+INDEX_SUFFIX = ".idx"  # Written when a recording is complete
+THUMBNAIL_SUFFIX = ".png"  # PNG of the final drawing, for galleries of the recorded rounds
+MSG_ROUND = "ROUND"  # First record of a recording, describes the round
+PLAYBACK_MIN_DELAY = 0.001  # Seconds between two playback steps at least, so a playback never spins the loop
+
+class RecordingWriter(threading.Thread):
+    """Writes recordings on its own thread so the server loop never waits for the disk
+
+    One writer serves every recorder of the server, each with its own open file.
+    """
+
+    def __init__(self):
+        super().__init__(name="recording-writer", daemon=True)
+        self.commands = queue.SimpleQueue()
+        self.files = {}  # Path -> open recording
+
+    def run(self):
+        while True:
+            command, path, data = self.commands.get()
+            try:
+                if command == "open":
+                    self.files[path] = open(path, "wb")
+                    self.files[path].write(data)
+                elif command == "write" and path in self.files:
+                    self.files[path].write(data)
+                elif command == "thumbnail":
+                    with open(path, "wb") as thumbnail_file:
+                        thumbnail_file.write(data.scaled(THUMBNAIL_SCALE).to_png())
+                elif command == "close" and path in self.files:
+                    self.files.pop(path).close()
+                    # The index goes last, it marks the recording as complete
+                    with open(path + INDEX_SUFFIX, "wb") as index_file:
+                        index_file.write(data)
+            except OSError as e:
+                logger.error("Error writing recording %s: %s", path, e)
+                recording_file = self.files.pop(path, None)
+                if recording_file is not None:
+                    recording_file.close()
+
+class RoundRecorder:
+    """Records every round as an append-only log of timestamped binary frames
+
+    Records are collected in a buffer on the server thread and handed to the
+    writer thread in bulk. Every RECORDING_INDEX_MS of round time the offset
+    of the next record goes into a sparse index, so replay can start anywhere
+    without reading the recording from the beginning.
+    """
+
+    def __init__(self, directory, flush_bytes=RECORDING_FLUSH_BYTES, index_ms=RECORDING_INDEX_MS, writer=None):
+        self.directory = directory
+        self.flush_bytes = flush_bytes
+        self.index_ms = index_ms
+        self.writer = writer
+        self.path = None  # Recording of the current round, None between rounds
+        self.buffer = bytearray()
+        self.offset = 0  # File offset of the end of the buffer
+        self.started = 0.0
+        self.index = array('I')  # Pairs of round time and file offset
+        self.next_index_ms = 0
+        self.count = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recordings = self.scan()  # Ids of the complete recordings, oldest first
+        self.known = set(self.recordings)
+        if self.writer is None:
+            self.writer = RecordingWriter()
+            self.writer.start()
+
+    @property
+    def recording(self):
+        return self.path is not None
+
+    def start_round(self, word, category, drawer):
+        """Begin the recording of a new round"""
+        self.end_round()
+        self.count += 1
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self.count}"
+        self.path = os.path.join(self.directory, name + RECORDING_SUFFIX)
+        self.started = time.monotonic()
+        self.index = array('I')
+        self.next_index_ms = 0
+        self.writer.commands.put(("open", self.path, FILE_MAGIC))
+        self.offset = len(FILE_MAGIC)
+        self.record(MSG_ROUND, {"word": word, "category": category, "drawer": drawer,
+                                "started": time.time()})
+
+    def record(self, msg_type, data):
+        """Append a message of the current round"""
+        if self.path is None:
+            return
+        elapsed_ms = int((time.monotonic() - self.started) * 1000)
+        if elapsed_ms >= self.next_index_ms:
+            self.index.extend((elapsed_ms, self.offset + len(self.buffer)))
+            self.next_index_ms = elapsed_ms - elapsed_ms % self.index_ms + self.index_ms
+
+        self.buffer += RECORD_TIME.pack(elapsed_ms)
+        self.buffer += encode_binary_message(msg_type, data)
+        if len(self.buffer) >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered records to the writer thread"""
+        if self.buffer and self.path is not None:
+            self.writer.commands.put(("write", self.path, bytes(self.buffer)))
+            self.offset += len(self.buffer)
+            self.buffer.clear()
+
+    def save_thumbnail(self, drawing):
+        """Save a bitmap of the final drawing next to the current recording, scaled and encoded on the writer thread"""
+        if self.path is not None:
+            path = self.path[:-len(RECORDING_SUFFIX)] + THUMBNAIL_SUFFIX
+            self.writer.commands.put(("thumbnail", path, drawing))
+
+    def end_round(self):
+        """Finish the current recording, if any"""
+        if self.path is None:
+            return
+        self.flush()
+        index = array('I', self.index)
+        if sys.byteorder == "little":
+            index.byteswap()
+        self.writer.commands.put(("close", self.path, index.tobytes()))
+        logger.info("Recorded round to %s", self.path)
+        recording_id = os.path.basename(self.path)[:-len(RECORDING_SUFFIX)]
+        self.recordings.append(recording_id)
+        self.known.add(recording_id)
+        self.path = None
+
+    def list(self):
+        """Ids of the complete recordings, oldest first"""
+        return self.recordings
+
+    def scan(self):
+        """Ids of the complete recordings in the directory, oldest first, read once when the recorder starts"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        ids = [name[:-len(RECORDING_SUFFIX)] for name in names if name.endswith(RECORDING_SUFFIX)
+               and name + INDEX_SUFFIX in names]
+        return sorted(ids, key=lambda recording_id: os.path.getmtime(self.path_of(recording_id)))
+
+    def path_of(self, recording_id):
+        return os.path.join(self.directory, recording_id + RECORDING_SUFFIX)
+
+    def open(self, recording_id):
+        """Open a complete recording by id, None if there is no such recording"""
+        if not isinstance(recording_id, str) or recording_id not in self.known:
+            return None
+        return Recording(self.path_of(recording_id))
+
+class Recording:
+    """A recorded round, read through a memory map"""
+
+    def __init__(self, path):
+        self.path = path
+        self.id = os.path.basename(path)[:-len(RECORDING_SUFFIX)]
+        with open(path, "rb") as recording_file:
+            size = os.fstat(recording_file.fileno()).st_size
+            if size <= len(FILE_MAGIC):
+                raise ValueError(f"Empty recording {path}")
+            self.map = mmap.mmap(recording_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self.map.close()
+            raise ValueError(f"Not a recording: {path}")
+        self.index_times, self.index_offsets = self.load_index()
+
+        first = next(self.records(), None)
+        self.info = decode_message(first[1])["data"] if first else {}
+
+    def close(self):
+        self.map.close()
+
+    def load_index(self):
+        """Times and offsets of the sparse index, rebuilt by scanning if the index file is missing"""
+        try:
+            index = array('I')
+            with open(self.path + INDEX_SUFFIX, "rb") as index_file:
+                index.frombytes(index_file.read())
+            if sys.byteorder == "little":
+                index.byteswap()
+            return index[0::2].tolist(), index[1::2].tolist()
+        except (OSError, ValueError):
+            times, offsets = [], []
+            for elapsed_ms, _, offset in self.records(with_offsets=True):
+                if not times or elapsed_ms // RECORDING_INDEX_MS > times[-1] // RECORDING_INDEX_MS:
+                    times.append(elapsed_ms)
+                    offsets.append(offset)
+            return times, offsets
+
+    def records(self, offset=len(FILE_MAGIC), with_offsets=False):
+        """Yield (milliseconds, frame) of every record from a file offset on
+
+        Frames are memoryviews into the map, decode them before closing the recording.
+        """
+        data = self.map
+        view = memoryview(data)
+        size = len(data)
+        header_size = RECORD_TIME.size + FRAME_HEADER.size
+        while offset + header_size <= size:
+            elapsed_ms, = RECORD_TIME.unpack_from(data, offset)
+            _, _, length = FRAME_HEADER.unpack_from(data, offset + RECORD_TIME.size)
+            end = offset + header_size + length
+            if end > size:
+                break  # The last record was cut off
+            frame = view[offset + RECORD_TIME.size:end]
+            yield (elapsed_ms, frame, offset) if with_offsets else (elapsed_ms, frame)
+            offset = end
+
+    def events(self, start_ms=0):
+        """Yield (milliseconds, message) of the round from start_ms on, skipping the round info"""
+        position = bisect.bisect_right(self.index_times, start_ms) - 1
+        offset = self.index_offsets[position] if position >= 0 else len(FILE_MAGIC)
+        for elapsed_ms, frame in self.records(offset):
+            if elapsed_ms < start_ms:
+                continue
+            message = decode_message(frame)
+            if message["type"] != MSG_ROUND:
+                yield elapsed_ms, message
+
+    @property
+    def duration_ms(self):
+        last = self.index_times[-1] if self.index_times else 0
+        for elapsed_ms, _ in self.records(self.index_offsets[-1] if self.index_offsets else len(FILE_MAGIC)):
+            last = elapsed_ms
+        return last
+
+class Playback:
+    """Replays a recording to one client at the recorded pace times a speed factor"""
+
+    def __init__(self, recording, speed=1.0, start_ms=0):
+        self.recording = recording
+        self.speed = speed
+        self.start_ms = start_ms
+        self.events = recording.events(start_ms)
+        self.upcoming = next(self.events, None)
+        self.started = time.monotonic()
+        self.timer = None
+
+    def due(self):
+        """Messages whose time has come"""
+        position_ms = self.start_ms + (time.monotonic() - self.started) * 1000 * self.speed
+        messages = []
+        while self.upcoming is not None and self.upcoming[0] <= position_ms:
+            messages.append(self.upcoming[1])
+            self.upcoming = next(self.events, None)
+        return messages
+
+    def time_until_next(self):
+        """Seconds until the next message is due, None once the recording is over"""
+        if self.upcoming is None:
+            return None
+        position_ms = self.start_ms + (time.monotonic() - self.started) * 1000 * self.speed
+        # The bound goes first, max() keeps it if the delay is NaN
+        return max(PLAYBACK_MIN_DELAY, (self.upcoming[0] - position_ms) / 1000 / self.speed)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.events.close()
+        self.recording.close()
+
+if __name__ == "__main__":
+    # Print a recording for review
+    recording = Recording(sys.argv[1])
+    print(f"Round: {recording.info}")
+    for elapsed_ms, message in recording.events(int(float(sys.argv[2]) * 1000) if len(sys.argv) > 2 else 0):
+        print(f"{elapsed_ms / 1000:8.3f}s {message['type']} {message['data']}")
+    recording.close()
@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import logging
+from client.connection import GameConnection, EVENT_CONNECTED, EVENT_DISCONNECTED
+from server.async_server import AsyncPictionaryServer
+from server.metrics import start_metrics_server
+from server.room import Room
+from server.strokes import merge_draws
+from shared.roster import Roster
+from shared.trace import tracer
+from shared.common import *
+
+logger = logging.getLogger(__name__)
+
+class RelayRoom(Room):
+    """The one room of a relay, mirroring a room of the game server for the relay's spectators
+
+    Draw data is collected for stroke_interval seconds and sent as merged
+    polylines, and game states go out at most once per state_interval.
+    """
+
+    def __init__(self, server, room_id, stroke_interval=RELAY_STROKE_MS / 1000, state_interval=RELAY_STATE_MS / 1000):
+        super().__init__(server, room_id)
+        self.stroke_interval = stroke_interval
+        self.state_interval = state_interval
+        self.pending_draws = []  # Draw data not sent to spectators yet
+        self.draw_timer = None
+        self.state = None  # Latest game state from the game server, without the roster
+        self.upstream_roster = Roster()
+        self.state_dirty = False  # A newer state arrived while the state timer was running
+        self.state_timer = None
+
+    def handle_upstream(self, event):
+        """Mirror one message of the game server and pass it on to the spectators"""
+        msg_type = event.type
+        data = event.data
+
+        if msg_type == MSG_DRAW:
+            if not is_valid_draw(data):
+                return
+            self.strokes.add(data)
+            self.drawing_version += 1
+            if not self.stroke_interval:
+                self.broadcast(MSG_DRAW, data, droppable=True)
+                return
+            self.pending_draws.append(data)
+            if self.draw_timer is None:
+                self.draw_timer = self.schedule(self.stroke_interval, self.flush_draws)
+
+        elif msg_type == MSG_CLEAR:
+            self.pending_draws = []
+            self.reset_drawing()
+            self.broadcast(MSG_CLEAR, {})
+
+        elif msg_type == MSG_ERASE:
+            # Keep the order of strokes and erasures
+            self.flush_draws()
+            stroke_ids = data.get("strokes", [])
+            erased = self.strokes.erase(stroke_ids)
+            self.drawing_version += 1
+            if len(erased) < len(stroke_ids) and self.strokes.base is not None:
+                # Some are only part of the raster we started from, get the drawing without them
+                upstream = self.server.upstream
+                upstream.send(MSG_SYNC, {"version": upstream.drawing_version})
+            self.broadcast(MSG_ERASE, data)
+
+        elif msg_type == MSG_SNAPSHOT:
+            # We (re)joined or resynced, start over from the game server's drawing
+            self.pending_draws = []
+            self.strokes.clear()
+            raster, draws = unpack_drawing(data["drawing"])
+            if raster is not None:
+                self.strokes.load_raster(*raster)
+            for draw_data in draws:
+                self.strokes.add(draw_data)
+            self.drawing_version += 1
+            self.broadcast(MSG_SNAPSHOT, self.current_snapshot())
+
+        elif msg_type == MSG_STATE:
+            if "players" in data:
+                # The full roster after we (re)joined, pass it on right away
+                self.upstream_roster.reset(data["players"], data["roster"])
+                self.state = {key: value for key, value in data.items() if key not in ("players", "roster")}
+                self.broadcast(MSG_STATE, self.spectator_state(roster=True))
+                return
+            self.state = data
+            if not self.state_interval:
+                self.broadcast_game_state()
+            elif self.state_timer is None:
+                # Send the first state right away, later ones once the interval has passed
+                self.broadcast_game_state()
+                self.state_timer = self.schedule(self.state_interval, self.flush_state)
+            else:
+                self.state_dirty = True
+
+        elif msg_type == MSG_ROSTER:
+            if self.upstream_roster.apply(data) is None:
+                # An update went missing, ask for the whole roster again
+                upstream = self.server.upstream
+                upstream.send(MSG_SYNC, {"version": upstream.drawing_version, "roster": self.upstream_roster.version})
+            else:
+                self.broadcast(MSG_ROSTER, data)
+
+        elif msg_type in (MSG_GUESS, MSG_RESULT, MSG_COUNTDOWN):
+            # Keep the order of strokes and chat
+            self.flush_draws()
+            self.broadcast(msg_type, data)
+
+        elif msg_type == EVENT_CONNECTED:
+            logger.info("Connected to the game server at %s:%s", data["host"], data["port"])
+
+        elif msg_type == EVENT_DISCONNECTED:
+            logger.warning("Lost the game server: %s", data.get("error", "connection closed"))
+
+    def flush_draws(self):
+        """Send the collected draw data as merged polylines"""
+        if self.draw_timer is not None:
+            self.draw_timer.cancel()
+            self.draw_timer = None
+        draws, self.pending_draws = self.pending_draws, []
+        for draw_data in merge_draws(draws):
+            self.broadcast(MSG_DRAW, draw_data, droppable=True)
+
+    def flush_state(self):
+        """Send the latest game state if it changed since the last one sent"""
+        self.state_timer = None
+        if self.state_dirty:
+            self.state_dirty = False
+            self.broadcast_game_state()
+            self.state_timer = self.schedule(self.state_interval, self.flush_state)
+
+    def spectator_state(self, roster=False):
+        """The game server's state, counting our spectators instead of ourselves"""
+        state = dict(self.state, spectators=self.state.get("spectators", 1) - 1 + len(self.clients))
+        if roster:
+            state["players"] = list(self.upstream_roster)
+            state["roster"] = self.upstream_roster.version
+        return state
+
+    def idle(self):
+        """The relay keeps its room while nobody watches"""
+        return False
+
+    def welcome(self, client):
+        """Bring a spectator that joined up to date"""
+        self.send_game_state_to_client(client, roster=True, sequence=self.history.sequence)
+
+        # The snapshot includes collected draw data, send that to the others first
+        self.flush_draws()
+        self.send_snapshot(client)
+
+    def remove(self, client):
+        """Forget a spectator that left"""
+        self.clients.pop(client, None)
+
+    def update_game_state(self):
+        """The game server runs the game"""
+
+    def send_game_state_to_client(self, client, roster=False, sequence=None):
+        """Send the game server's state to one spectator"""
+        if self.state is not None:
+            self.send_message(client, MSG_STATE, self.spectator_state(roster), sequence=sequence)
+
+    def broadcast_game_state(self):
+        """Send the game state to every spectator, encoded once"""
+        if self.state is not None:
+            self.broadcast(MSG_STATE, self.spectator_state())
+
+class RelayServer(AsyncPictionaryServer):
+    """Spectator-only server fed by a single connection to the game server
+
+    The relay joins the game server as one spectator and re-broadcasts what it
+    receives to its own spectators, so the game server's fan-out does not grow
+    with the audience. All of the relay's spectators share one RelayRoom.
+    """
+
+    def __init__(self, host=HOST, port=RELAY_PORT, upstream_host=HOST, upstream_port=PORT,
+                 stroke_interval=RELAY_STROKE_MS / 1000, state_interval=RELAY_STATE_MS / 1000, upstream_room=None):
+        super().__init__(host, port)
+        self.upstream = GameConnection(upstream_host, upstream_port, role=ROLE_SPECTATOR, room=upstream_room)
+        self.room = self.rooms.add(RelayRoom(self, self.rooms.new_id(), stroke_interval, state_interval))
+        self.spectator_count = 0
+
+    async def serve(self):
+        """Follow the game server while serving spectators"""
+        self.loop = asyncio.get_running_loop()
+        upstream_task = asyncio.ensure_future(self.follow_upstream())
+        try:
+            await super().serve()
+        finally:
+            upstream_task.cancel()
+            self.upstream.close()
+
+    async def follow_upstream(self):
+        """Handle every event of the connection to the game server"""
+        async for event in self.upstream:
+            try:
+                self.room.handle_upstream(event)
+            except Exception as e:
+                logger.warning("Error relaying %s: %s", event.type, e)
+
+    def register_client(self, client, address):
+        """Add a spectator, it is brought up to date once it joins"""
+        self.spectator_count += 1
+        self.metrics.connections += 1
+        self.clients[client] = {
+            "name": f"Spectator_{self.spectator_count}",
+            "address": address,
+            "score": 0,
+            "is_drawer": False,
+            "role": ROLE_SPECTATOR,
+            "format": FORMAT_JSON,
+            "compression": None,
+            "room": None,
+            "joined": False
+        }
+
+    def choose_room(self, client, room_id=None):
+        """Every spectator watches the relayed room"""
+        return self.room
+
+    def process_message(self, client, message):
+        """Spectators can only negotiate their connection and ask for resyncs"""
+        if message["type"] in (MSG_JOIN, MSG_SYNC):
+            super().process_message(client, message)
+
+    def handle_disconnect(self, client):
+        """Forget a spectator that left, spectators keep no seat"""
+        if client in self.clients:
+            self.close_client(client)
+            self.remove_client(client)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Relay a Pictionary game to spectators")
+    parser.add_argument("--host", default=HOST, help="Address spectators connect to")
+    parser.add_argument("--port", type=int, default=RELAY_PORT, help="Port spectators connect to")
+    parser.add_argument("--upstream-host", default=HOST, help="Address of the game server")
+    parser.add_argument("--upstream-port", type=int, default=PORT, help="Port of the game server")
+    parser.add_argument("--upstream-room", type=int, help="Room of the game server to relay, the busiest one if not given")
+    parser.add_argument("--stroke-ms", type=int, default=RELAY_STROKE_MS,
+                        help="Milliseconds of draw data merged into one update, 0 to relay it unchanged")
+    parser.add_argument("--state-ms", type=int, default=RELAY_STATE_MS,
+                        help="Shortest time between two game state updates, 0 to relay every one")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics over HTTP on this local port")
+    parser.add_argument("--log-level", default=LOG_LEVEL,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper,
+                        help="Least severe log messages to show")
+    parser.add_argument("--trace", action="store_true",
+                        help="Record message handling spans, dumped on SIGUSR1 or from the metrics endpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.trace:
+        tracer.enable("relay")
+        tracer.install_signal_handler(lambda path: print(f"Trace written to {path}"))
+
+    relay = RelayServer(args.host, args.port, args.upstream_host, args.upstream_port,
+                        args.stroke_ms / 1000, args.state_ms / 1000, args.upstream_room)
+    if args.metrics_port:
+        start_metrics_server(relay.metrics, METRICS_HOST, args.metrics_port)
+    try:
+        relay.run()
+    except KeyboardInterrupt:
+        print("Relay shutting down")
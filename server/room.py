@@ -0,0 +1,734 @@
+import logging
+import math
+import os
+import random
+import time
+from server.fanout import BroadcastHistory
+from server.limits import make_buckets
+from server.recording import RoundRecorder, Playback
+from server.strokes import StrokeStore, merge_draw, DRAW_OVER_BUDGET, DRAW_STROKE_CLOSED
+from server.words import GuessMatcher, GUESS_CORRECT, GUESS_CLOSE
+from shared.roster import roster_changes
+from shared.trace import tracer
+from shared.common import *
+
+logger = logging.getLogger(__name__)
+
+class Room:
+    """One game with its members, drawing, rounds and broadcasts
+
+    The server owns the connections and hands every client that joined to a
+    room; a room only talks to its members, through the server's transport.
+    Broadcasts are encoded once and reach the room's members alone, so the
+    work per message grows with the size of the room and not with the number
+    of connections.
+    """
+
+    def __init__(self, server, room_id, size=ROOM_SIZE):
+        self.server = server
+        self.id = room_id
+        self.size = size  # Seats for players, spectators do not take one
+        self.clients = {}  # Members: client -> player info, shared with the server
+        self.metrics = server.metrics
+
+        # Game state
+        self.game_state = STATE_WAITING
+        self.drawer = None
+        self.current_word = None
+        self.current_category = None
+        self.matcher = None  # GuessMatcher for the current word
+        self.countdown_timer = None
+        self.phase_timer = None  # Next countdown tick, round time limit or delay before the next round
+        self.strokes = StrokeStore()
+        self.drawing_version = 0  # Bumped on every change to the drawing
+        self.snapshot = None  # Compressed drawing for the current version, built on demand
+
+        # Game state and roster updates, sent at most once per loop iteration
+        self.roster = {}  # Player id -> entry, as last sent to the members
+        self.roster_version = 0
+        self.state_sent = None  # Last game state sent to everyone but the drawer
+        self.drawer_state_sent = None  # Last game state sent to the drawer
+        self.state_timer = None
+
+        # Rate limits shared by the members
+        self.buckets = make_buckets(ROOM_RATE_LIMITS)
+        self.deferred_draws = []  # Draw data over the rate limit, merged into polylines
+        self.deferred_bytes = 0
+        self.deferred_timer = None
+        self.guess_digest = []  # Wrong guesses waiting to be echoed
+        self.digest_timer = None
+
+        # Round recording and replay, every room records to its own directory
+        self.recorder = None
+        if server.recording_dir:
+            self.recorder = RoundRecorder(os.path.join(server.recording_dir, f"room-{room_id}"),
+                                          writer=server.recording_writer)
+        self.recording_timer = None  # Next flush of the recording buffer
+        self.playbacks = {}  # client -> Playback of a recorded round
+
+        # Numbered broadcasts for members that resume after losing their connection
+        self.history = BroadcastHistory(RESUME_BUFFER_SIZE)
+
+    def __repr__(self):
+        return f"Room({self.id}, {len(self.clients)} members)"
+
+    def players(self):
+        """Members taking part in the game, spectators left out"""
+        return [client for client, info in self.clients.items() if info["role"] == ROLE_PLAYER and info["joined"]]
+
+    def open_seats(self):
+        """Players the room can still take"""
+        return max(self.size - len(self.players()), 0)
+
+    def idle(self):
+        """True once nobody is left and the room can be closed"""
+        return not self.clients
+
+    def join(self, client):
+        """Add a client that joined the game and send it the game so far"""
+        info = self.server.clients[client]
+        info["room"] = self
+        info["joined"] = True
+        self.clients[client] = info
+        logger.debug("Client %s joined room %s", info['name'], self.id)
+        self.server.rooms.update(self)
+        self.welcome(client)
+        self.update_game_state()
+
+    def welcome(self, client):
+        """Introduce a member that just joined to the others and send it the game so far"""
+        # Numbered as of the last broadcast, so the client can resume from here
+        self.send_game_state_to_client(client, roster=True, sequence=self.history.sequence)
+        self.send_snapshot(client)
+        self.broadcast_game_state()
+
+    def remove(self, client):
+        """Take a member that left for good out of the game"""
+        info = self.clients.pop(client, None)
+        if info is None:
+            return
+        self.stop_playback(client)
+
+        # If drawer disconnected and game was in progress, end round
+        if info["is_drawer"] and self.game_state == STATE_PLAYING:
+            self.game_state = STATE_WAITING
+            self.cancel_phase_timer()
+            self.broadcast_result({
+                "error": "Drawer disconnected",
+                "word": self.current_word
+            })
+
+        # Reset game if not enough players, otherwise count down to the next round, then update the remaining members
+        self.stop_game_if_too_few_players()
+        self.update_game_state()
+        self.broadcast_game_state()
+        self.server.rooms.update(self)
+
+    def replace(self, previous, client):
+        """Hand a member's seat to the connection that resumed its session, keeping its place in the list"""
+        self.clients = {(client if member == previous else member): player
+                        for member, player in self.clients.items()}
+        if self.drawer == previous:
+            self.drawer = client
+
+    def catch_up(self, client, sequence):
+        """Send a resumed member the broadcasts it missed, or the whole drawing if they are no longer kept"""
+        missed = self.history.since(sequence)
+        if missed is None:
+            self.send_game_state_to_client(client, roster=True)
+            self.send_snapshot(client)
+        else:
+            for number, msg_type, data in missed:
+                self.send_message(client, msg_type, data, sequence=number)
+            self.send_game_state_to_client(client)
+        self.broadcast_game_state()
+        self.update_game_state()
+
+    def close(self):
+        """Stop the timers and the recording of a room nobody is left in"""
+        for timer in (self.phase_timer, self.state_timer, self.deferred_timer, self.digest_timer,
+                      self.recording_timer):
+            if timer is not None:
+                timer.cancel()
+        for client in list(self.playbacks):
+            self.stop_playback(client)
+        self.end_recording()
+
+    def process_message(self, client, message):
+        """Handle a game message of a member"""
+        msg_type = message["type"]
+        msg_data = message["data"]
+        info = self.clients[client]
+
+        if msg_type == MSG_DRAW and info["is_drawer"]:
+            if not is_valid_draw(msg_data):
+                return
+            if self.deferred_draws or not self.server.admit(client, MSG_DRAW):
+                self.defer_draw(client, msg_data)
+                return
+            self.accept_draw(msg_data)
+
+        elif msg_type == MSG_CLEAR and info["is_drawer"]:
+            # Clear canvas for all members
+            self.reset_drawing()
+            self.record(MSG_CLEAR, {})
+            self.broadcast(MSG_CLEAR, {}, exclude=None)
+
+        elif msg_type in (MSG_UNDO, MSG_ERASE) and info["is_drawer"]:
+            stroke_ids = msg_data.get("strokes") if msg_type == MSG_ERASE else []
+            if (not isinstance(stroke_ids, list) or len(stroke_ids) > MAX_ERASE_STROKES
+                    or not all(is_valid_stroke_id(stroke_id) for stroke_id in stroke_ids)):
+                return
+            if self.deferred_draws:
+                # Strokes waiting for the rate limit come first, the one to undo may be among them
+                self.deferred_timer.cancel()
+                self.flush_deferred_draws(client)
+            if msg_type == MSG_UNDO and self.strokes.last_id() is not None:
+                stroke_ids = [self.strokes.last_id()]
+            self.erase_strokes(stroke_ids)
+
+        elif msg_type == MSG_REPLAY:
+            self.handle_replay_request(client, msg_data)
+
+        elif msg_type == MSG_SYNC:
+            # Resync a member whose drawing or roster is out of date
+            if msg_data.get("version") != self.drawing_version:
+                self.send_snapshot(client)
+            if "roster" in msg_data:
+                self.send_game_state_to_client(client, roster=True)
+
+        elif msg_type == MSG_GUESS and not info["is_drawer"] and info["role"] == ROLE_PLAYER:
+            # Handle word guess, a player repeating a guess tells nobody anything new
+            guess = msg_data["guess"].lower().strip()
+            guessed = info.setdefault("guesses", set())
+            if guess in guessed:
+                return
+            guessed.add(guess)
+            player_name = info["name"]
+            result = None
+            if self.game_state == STATE_PLAYING and self.matcher is not None:
+                self.metrics.guesses += 1
+                result = self.matcher.check(guess)
+
+            if result == GUESS_CLOSE:
+                # Only the guesser learns that they were close
+                self.send_message(client, MSG_HINT, {"guess": guess, "hint": GUESS_CLOSE})
+                return
+
+            # Echo the guess to all members, wrong ones in periodic digests
+            guess_data = {
+                "player": player_name,
+                "guess": guess
+            }
+            self.record(MSG_GUESS, guess_data)
+            if result != GUESS_CORRECT:
+                self.echo_guess(guess_data)
+                return
+
+            # The guess is correct, show it right after the wrong guesses before it
+            self.flush_guess_digest()
+            self.broadcast(MSG_GUESS, guess_data)
+
+            # Award points to guesser
+            self.metrics.correct_guesses += 1
+            info["score"] += 10
+
+            # Award points to drawer
+            if self.drawer in self.clients:
+                self.clients[self.drawer]["score"] += 5
+
+            # End round
+            self.game_state = STATE_ROUND_END
+            self.broadcast_result({
+                "winner": player_name,
+                "word": self.current_word
+            })
+
+            # Broadcast updated game state
+            self.broadcast_game_state()
+
+            # Start new round after a delay
+            self.set_phase_timer(ROUND_END_SECONDS, self.start_new_round)
+
+    def accept_draw(self, draw_data):
+        """Add draw data to the drawing and forward it to all members"""
+        # Store the drawing data, dropping it once the round's memory budget is used up
+        result = self.strokes.add(draw_data)
+        if result == DRAW_OVER_BUDGET:
+            logger.debug("Drawing memory budget reached, ignoring draw data")
+            return
+        if result == DRAW_STROKE_CLOSED:
+            logger.debug("Ignoring draw data for stroke %s, which is no longer the newest", draw_data["stroke"])
+            return
+        self.drawing_version += 1
+        self.record(MSG_DRAW, draw_data)
+
+        # Forward drawing data, a single segment or a batched polyline, to all members
+        self.broadcast(MSG_DRAW, draw_data, exclude=None, droppable=True)
+
+    def erase_strokes(self, stroke_ids):
+        """Remove strokes from the drawing and tell all members which ones to take off their canvas"""
+        erased = self.strokes.erase(stroke_ids)
+        if not erased:
+            return
+        self.drawing_version += 1
+        self.record(MSG_ERASE, {"strokes": erased})
+        self.broadcast(MSG_ERASE, {"strokes": erased}, exclude=None)
+
+    def defer_draw(self, client, draw_data):
+        """Merge draw data over the rate limit into one update sent once the limit allows it"""
+        self.metrics.limited(MSG_DRAW)
+        nbytes = (len(draw_data["points"]) if "points" in draw_data else 4) * 2
+        if self.deferred_bytes + nbytes > self.strokes.budget - self.strokes.nbytes:
+            return  # The drawing could not take it anyway
+        merge_draw(self.deferred_draws, draw_data)
+        self.deferred_bytes += nbytes
+        if self.deferred_timer is None:
+            delay = max((bucket.time_until_ready() for bucket in self.server.rate_buckets(client, MSG_DRAW)),
+                        default=0)
+            self.deferred_timer = self.schedule(delay, lambda: self.flush_deferred_draws(client))
+
+    def flush_deferred_draws(self, client):
+        """Send the merged draw data that was over the rate limit"""
+        self.deferred_timer = None
+        draws, self.deferred_draws = self.deferred_draws, []
+        self.deferred_bytes = 0
+        if client in self.clients:
+            for bucket in self.server.rate_buckets(client, MSG_DRAW):
+                bucket.consume(len(draws))
+        for draw_data in draws:
+            self.accept_draw(draw_data)
+
+    def echo_guess(self, guess_data):
+        """Show a wrong guess to everyone, batched with the others of the next GUESS_DIGEST_MS"""
+        if not GUESS_DIGEST_MS:
+            self.broadcast(MSG_GUESS, guess_data)
+            return
+        self.guess_digest.append(guess_data)
+        if self.digest_timer is None:
+            self.digest_timer = self.schedule(GUESS_DIGEST_MS / 1000, self.flush_guess_digest)
+
+    def flush_guess_digest(self):
+        """Echo the collected guesses in one message"""
+        if self.digest_timer is not None:
+            self.digest_timer.cancel()
+            self.digest_timer = None
+        digest, self.guess_digest = self.guess_digest, []
+        if len(digest) == 1:
+            self.broadcast(MSG_GUESS, digest[0])
+        elif digest:
+            self.broadcast(MSG_GUESS, {"guesses": digest})
+
+    def stop_game_if_too_few_players(self):
+        """Go back to waiting once too few players are left"""
+        if len(self.players()) < MIN_PLAYERS:
+            self.game_state = STATE_WAITING
+            self.cancel_phase_timer()
+            self.drawer = None
+            self.current_word = None
+            self.reset_drawing()
+            self.end_recording()
+
+    def send_message(self, client, msg_type, data, droppable=False, sequence=None):
+        """Send a message to one member"""
+        self.server.send_message(client, msg_type, data, droppable, sequence)
+
+    def schedule(self, delay, callback):
+        """Run a callback on the server loop after the given delay in seconds"""
+        return self.server.schedule(delay, callback)
+
+    def set_phase_timer(self, delay, callback):
+        """Schedule the next game phase change, replacing any pending one"""
+        self.cancel_phase_timer()
+        self.phase_timer = self.schedule(delay, callback)
+
+    def cancel_phase_timer(self):
+        """Drop the pending game phase change, if any"""
+        if self.phase_timer is not None:
+            self.phase_timer.cancel()
+            self.phase_timer = None
+
+    def update_game_state(self):
+        """Start the countdown once enough players are waiting"""
+        if self.game_state == STATE_WAITING and len(self.players()) >= MIN_PLAYERS:
+            # Start countdown when we have enough players
+            self.game_state = STATE_COUNTDOWN
+            self.countdown_timer = COUNTDOWN_SECONDS
+
+            # Broadcast the updated game state to all members
+            self.broadcast_game_state()
+
+            # Start the countdown
+            self.broadcast_countdown()
+
+    def broadcast_countdown(self):
+        """Broadcast countdown to all members"""
+        if self.countdown_timer > 0:
+            logger.debug("Room %s countdown: %d", self.id, self.countdown_timer)
+            self.broadcast(MSG_COUNTDOWN, {"seconds": self.countdown_timer})
+            self.countdown_timer -= 1
+
+            self.set_phase_timer(1, self.broadcast_countdown)
+        else:
+            logger.debug("Room %s countdown finished, starting game", self.id)
+            # Countdown finished, start the game
+            self.start_new_round()
+
+    def start_new_round(self):
+        """Start a new game round"""
+        self.phase_timer = None
+        if len(self.players()) < MIN_PLAYERS:
+            self.game_state = STATE_WAITING
+            self.broadcast_game_state()
+            return
+
+        logger.info("Starting new round in room %s", self.id)
+        self.metrics.rounds += 1
+
+        # Reset drawing data, replays make way for the live round
+        for client in list(self.playbacks):
+            self.stop_playback(client)
+        self.reset_drawing()
+        self.broadcast(MSG_CLEAR, {})
+
+        # Choose a random drawer and word, preferring players who are connected
+        away = self.server.away
+        self.drawer = random.choice([client for client in self.players() if client not in away] or self.players())
+        self.current_word, self.current_category = self.server.words.choose()
+        self.matcher = GuessMatcher(self.current_word, self.server.words.dictionary())
+
+        logger.debug("Selected drawer: %s", self.clients[self.drawer]['name'])
+        logger.debug("Selected word: %s", self.current_word)
+
+        # Update member roles, everyone may guess anything again
+        for client in self.clients:
+            self.clients[client]["is_drawer"] = (client == self.drawer)
+            self.clients[client]["guesses"] = set()
+
+        # Set game state to playing
+        self.game_state = STATE_PLAYING
+        if self.recorder is not None:
+            self.recorder.start_round(self.current_word, self.current_category,
+                                      self.clients[self.drawer]["name"])
+            if self.recording_timer is None:
+                self.recording_timer = self.schedule(RECORDING_FLUSH_SECONDS, self.flush_recording)
+
+        # Send game state to all members
+        self.broadcast_game_state()
+
+        # End the round if nobody guesses the word in time
+        self.set_phase_timer(ROUND_SECONDS, self.end_round_on_time)
+
+        # The drawer learns the word from its game state, see send_game_state_to_client
+
+    def end_round_on_time(self):
+        """End a round whose time limit was reached"""
+        self.phase_timer = None
+        if self.game_state != STATE_PLAYING:
+            return
+
+        logger.info("Round time is up in room %s", self.id)
+        self.game_state = STATE_ROUND_END
+        self.broadcast_result({
+            "error": "Time is up",
+            "word": self.current_word
+        })
+        self.broadcast_game_state()
+
+        self.set_phase_timer(ROUND_END_SECONDS, self.start_new_round)
+
+    def broadcast_result(self, result):
+        """Announce how a round ended and finish its recording"""
+        self.flush_guess_digest()
+        self.broadcast(MSG_RESULT, result)
+        self.record(MSG_RESULT, result)
+        if self.recorder is not None and self.recorder.recording:
+            self.recorder.save_thumbnail(self.strokes.render())
+        self.end_recording()
+
+    def record(self, msg_type, data):
+        """Add a message to the recording of the current round, if recording"""
+        if self.recorder is not None:
+            self.recorder.record(msg_type, data)
+
+    def end_recording(self):
+        """Finish the recording of the current round, if any"""
+        if self.recorder is not None:
+            self.recorder.end_round()
+
+    def flush_recording(self):
+        """Hand buffered recording data to the writer thread, every RECORDING_FLUSH_SECONDS while recording"""
+        self.recording_timer = None
+        self.recorder.flush()
+        if self.recorder.recording:
+            self.recording_timer = self.schedule(RECORDING_FLUSH_SECONDS, self.flush_recording)
+
+    def handle_replay_request(self, client, request):
+        """List the room's recorded rounds or play one back to a member"""
+        if self.recorder is None:
+            self.send_message(client, MSG_REPLAY, {"error": "Rounds are not recorded"})
+            return
+        recordings = self.recorder.list()
+
+        if request.get("list"):
+            listing = []
+            for recording_id in recordings[-REPLAY_LIST_LIMIT:]:
+                try:
+                    recording = self.recorder.open(recording_id)
+                except (OSError, ValueError):
+                    continue
+                listing.append(dict(recording.info, id=recording_id, duration=recording.duration_ms / 1000))
+                recording.close()
+            self.send_message(client, MSG_REPLAY, {"recordings": listing})
+            return
+
+        if self.game_state == STATE_PLAYING:
+            # A replay would mix with the live drawing
+            self.send_message(client, MSG_REPLAY, {"error": "Replays are only available between rounds"})
+            return
+
+        # NaN would slip through the clamping below, and the JSON decoder accepts it
+        try:
+            speed = float(request.get("speed", 1.0))
+            start = float(request.get("from", 0))
+        except (TypeError, ValueError):
+            speed = start = math.nan
+        if not (math.isfinite(speed) and math.isfinite(start)):
+            self.send_message(client, MSG_REPLAY, {"error": "Invalid replay speed or start"})
+            return
+
+        recording_id = request.get("id")
+        if recording_id == "latest" and recordings:
+            recording_id = recordings[-1]
+        try:
+            recording = self.recorder.open(recording_id)
+        except (OSError, ValueError):
+            recording = None
+        if recording is None:
+            self.send_message(client, MSG_REPLAY, {"error": "Unknown recording"})
+            return
+
+        speed = min(max(speed, 1.0), REPLAY_MAX_SPEED)
+        start_ms = max(int(start * 1000), 0)
+        self.stop_playback(client)
+        self.playbacks[client] = Playback(recording, speed, start_ms)
+
+        self.send_message(client, MSG_CLEAR, {})
+        self.send_message(client, MSG_REPLAY, dict(recording.info, id=recording.id, speed=speed, replay="started"))
+        self.play_next(client)
+
+    def play_next(self, client):
+        """Send the due messages of a member's playback and schedule the next ones"""
+        playback = self.playbacks.get(client)
+        if playback is None:
+            return
+        playback.timer = None
+        for message in playback.due():
+            self.send_message(client, message["type"], message["data"])
+
+        delay = playback.time_until_next()
+        if delay is None:
+            self.send_message(client, MSG_REPLAY, {"id": playback.recording.id, "replay": "finished"})
+            self.stop_playback(client)
+        else:
+            playback.timer = self.schedule(delay, lambda: self.play_next(client))
+
+    def stop_playback(self, client):
+        """Cancel a member's playback, if any"""
+        playback = self.playbacks.pop(client, None)
+        if playback is not None:
+            playback.stop()
+
+    def game_state_for(self, client):
+        """The game state as one member sees it, without the roster"""
+        client_is_drawer = self.clients[client]["is_drawer"] if client in self.clients else False
+
+        state_data = {
+            "state": self.game_state,
+            "room": self.id,
+            "spectators": sum(1 for player in self.clients.values()
+                              if player["role"] == ROLE_SPECTATOR and player["joined"]),
+            "is_drawer": client_is_drawer
+        }
+
+        # Everyone may know the category while a round is played
+        if self.game_state == STATE_PLAYING and self.current_category:
+            state_data["category"] = self.current_category
+
+        # Add word if this member is the drawer
+        if client_is_drawer and self.current_word:
+            state_data["word"] = self.current_word
+        return state_data
+
+    def send_game_state_to_client(self, client, roster=False, sequence=None):
+        """Send current game state to a specific member, with the full roster if asked to"""
+        state_data = self.game_state_for(client)
+        if roster:
+            # The roster as of the last update, the next ROSTER update continues from it
+            state_data["players"] = list(self.roster.values())
+            state_data["roster"] = self.roster_version
+
+        # Send the game state
+        try:
+            self.send_message(client, MSG_STATE, state_data, sequence=sequence)
+        except Exception as e:
+            logger.warning("Error sending game state: %s", e)
+            self.server.handle_disconnect(client)
+
+    def send_snapshot(self, client):
+        """Send the whole drawing to one member as a single compressed message"""
+        if client not in self.clients:
+            return
+        self.send_message(client, MSG_SNAPSHOT, self.current_snapshot())
+
+    def current_snapshot(self):
+        """The drawing as snapshot data, packed once per drawing version"""
+        if self.snapshot is None or self.snapshot["version"] != self.drawing_version:
+            self.snapshot = {"version": self.drawing_version, "drawing": self.strokes.pack()}
+        return self.snapshot
+
+    def reset_drawing(self):
+        """Discard the drawing of the current round"""
+        self.strokes.clear()
+        self.drawing_version += 1
+        self.deferred_draws = []
+        self.deferred_bytes = 0
+        if self.deferred_timer is not None:
+            self.deferred_timer.cancel()
+            self.deferred_timer = None
+
+    def broadcast_game_state(self):
+        """Send the changes to the game state and the roster to all members at the end of this loop iteration"""
+        if self.state_timer is None:
+            self.state_timer = self.schedule(0, self.flush_game_state)
+
+    def flush_game_state(self):
+        """Broadcast what changed in the roster and the game state since the last flush"""
+        self.state_timer = None
+        away = self.server.away
+
+        # Changes to the roster go out as one update, encoded once
+        roster = {}
+        for client in self.players():
+            info = self.clients[client]
+            roster[info["id"]] = {"id": info["id"], "name": info["name"], "score": info["score"],
+                                  "is_drawer": info["is_drawer"], "away": client in away}
+        changes = roster_changes(self.roster, roster)
+        if changes:
+            self.roster = roster
+            self.roster_version += 1
+            self.broadcast(MSG_ROSTER, {"version": self.roster_version, "changes": changes})
+
+        # Everyone sees the same game state, only the drawer's includes the word
+        state = self.game_state_for(None)
+        drawer = self.drawer if self.drawer in self.clients and self.drawer not in away else None
+        drawer_state = self.game_state_for(drawer) if drawer is not None else None
+        if state != self.state_sent:
+            self.state_sent = state
+            self.broadcast(MSG_STATE, state, exclude=drawer)
+            self.drawer_state_sent = None
+        if drawer_state is not None and drawer_state != self.drawer_state_sent:
+            self.drawer_state_sent = drawer_state
+            self.send_message(drawer, MSG_STATE, drawer_state)
+
+    def broadcast(self, msg_type, data, exclude=None, droppable=False):
+        """Send message to all members except excluded one"""
+        started = time.perf_counter()
+        traced = tracer.now() if tracer.enabled else 0
+        # Number the broadcast and keep it for members that resume after losing their connection
+        sequence = self.history.append(msg_type, data)
+
+        # Encode once per wire format and compression, every recipient of a context shares the same frame
+        frames = {}
+        recipients = 0
+        size = 0
+        away = self.server.away
+        send_to_client = self.server.send_to_client
+        for client, info in list(self.clients.items()):
+            if client != exclude and client not in away:
+                context = (info["format"], info["compression"])
+                frame = frames.get(context)
+                if frame is None:
+                    frame = frames[context] = memoryview(encode_message(msg_type, data, *context, sequence))
+                send_to_client(client, frame, droppable)
+                recipients += 1
+                size += frame.nbytes
+        self.metrics.sent(msg_type, size, recipients)
+        self.metrics.broadcast_time.observe(time.perf_counter() - started)
+        if traced:
+            tracer.span(f"broadcast {msg_type}", traced, data.get("trace") if msg_type == MSG_DRAW else None)
+
+class RoomRegistry:
+    """The rooms of a server by id, and the ones with open seats by how many players they have
+
+    Matchmaking fills the fullest room that still has a seat, so games reach
+    MIN_PLAYERS quickly and new rooms only open once the others are full.
+    Finding a seat looks at one bucket per possible number of players
+    instead of at every room.
+    """
+
+    def __init__(self, server, size=ROOM_SIZE, first_id=1, id_step=1):
+        self.server = server
+        self.size = size
+        self.id_step = id_step  # Workers of a supervisor each number their rooms in their own stride
+        self.rooms = {}  # Room id -> room
+        self.open = [{} for _ in range(size)]  # Number of players -> {room id: room} with open seats
+        self.indexed = {}  # Room id -> number of players it is filed under in open, absent when full
+        self.last_id = first_id - id_step
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __iter__(self):
+        return iter(list(self.rooms.values()))
+
+    def get(self, room_id):
+        return self.rooms.get(room_id)
+
+    def new_id(self):
+        self.last_id += self.id_step
+        return self.last_id
+
+    def create(self):
+        """Open a new empty room"""
+        room = Room(self.server, self.new_id(), self.size)
+        logger.info("Opened room %s", room.id)
+        return self.add(room)
+
+    def add(self, room):
+        """Register a room, returns it"""
+        self.rooms[room.id] = room
+        self.index(room)
+        return room
+
+    def update(self, room):
+        """Re-file a room after its members changed, closing it once it is idle"""
+        if room.id in self.rooms and room.idle():
+            del self.rooms[room.id]
+            self.index(room)
+            room.close()
+            logger.info("Closed room %s", room.id)
+            return
+        self.index(room)
+
+    def index(self, room):
+        """File a registered room under its current number of players, if it has an open seat"""
+        previous = self.indexed.pop(room.id, None)
+        if previous is not None:
+            del self.open[previous][room.id]
+        players = len(room.players())
+        if room.id in self.rooms and players < room.size:
+            slot = min(players, self.size - 1)
+            self.open[slot][room.id] = room
+            self.indexed[room.id] = slot
+
+    def find_open(self):
+        """The fullest room with an open seat, None if every room is full"""
+        for rooms in reversed(self.open):
+            for room in rooms.values():
+                return room
+        return None
+
+    def busiest(self):
+        """The room with the most players, for spectators who did not ask for one"""
+        return max(self.rooms.values(), key=lambda room: len(room.players()), default=None)
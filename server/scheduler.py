@@ -0,0 +1,63 @@
+import heapq
+import itertools
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+class Timer:
+    """A callback scheduled on a Scheduler"""
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the callback from running"""
+        self.cancelled = True
+
+class Scheduler:
+    """Heap of timers run by the thread that drives the server loop
+
+    Nothing runs on its own: the loop asks for the time until the next
+    deadline, waits at most that long for socket activity and then calls
+    run_due.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.timers = []  # Heap of (deadline, sequence, timer)
+        self.sequence = itertools.count()  # Keeps timers with equal deadlines in insertion order
+
+    def __len__(self):
+        return len(self.timers)
+
+    def call_later(self, delay, callback, *args):
+        """Schedule a callback after delay seconds, returns a cancellable Timer"""
+        timer = Timer(self.clock() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.deadline, next(self.sequence), timer))
+        return timer
+
+    def next_timeout(self):
+        """Seconds until the next timer is due, None when nothing is scheduled"""
+        # Cancelled timers are only dropped once they reach the top of the heap
+        while self.timers and self.timers[0][2].cancelled:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - self.clock())
+
+    def run_due(self):
+        """Run every timer whose deadline has passed"""
+        now = self.clock()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.error("Error in scheduled callback %s: %s", timer.callback.__name__, e)
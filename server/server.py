@@ -1,35 +1,74 @@
+import argparse
+import logging
 import socket
 import select
 import random
+import secrets
 import time
 import json
-import threading
+import struct
+import sys
+from collections import deque
+from server.fanout import OutboundBuffer
+from server.limits import make_buckets, take_token
+from server.metrics import ServerMetrics, start_metrics_server
+from server.recording import RecordingWriter
+from server.room import RoomRegistry
+from server.scheduler import Scheduler
+from server.words import WordBank
+from shared.trace import tracer
 from shared.common import *
 
+logger = logging.getLogger(__name__)
+
 class PictionaryServer:
-    def __init__(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((HOST, PORT))
-        self.server_socket.listen(5)
+    def __init__(self, host=HOST, port=PORT, recording_dir=RECORDING_DIR, room_size=ROOM_SIZE, listener=None):
+        # A worker process gets its connections from the supervisor through the listener instead
+        self.server_socket = listener
+        if listener is None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((host, port))
+            self.server_socket.listen(LISTEN_BACKLOG)
         
         self.clients = {}  # socket -> player info
         self.sockets = [self.server_socket]
+        self.outbound = {}  # socket -> OutboundBuffer
+        self.decoders = {}  # socket -> FrameDecoder
+        self.pending_disconnects = set()
+        self.scheduler = Scheduler()
+        self.metrics = ServerMetrics(self)
+        self.words = WordBank()  # Shared by the rooms
+        self.player_count = 0  # Players ever registered, the source of player ids
+        
+        # Round recording, every room records to its own directory through one writer thread
+        self.recording_dir = recording_dir
+        self.recording_writer = None
+        if recording_dir:
+            self.recording_writer = RecordingWriter()
+            self.recording_writer.start()
         
-        # Game state
-        self.game_state = STATE_WAITING
-        self.drawer = None
-        self.current_word = None
-        self.countdown_timer = None
-        self.drawing_data = []
+        # Rooms, and clients that joined and wait for a seat until the end of the loop iteration
+        self.rooms = RoomRegistry(self, room_size)
+        self.lobby = deque()  # (client, id of the room it asked for)
+        self.match_timer = None
         
-        print(f"Server started on {HOST}:{PORT}")
+        # Session resume
+        self.sessions = {}  # Resume token -> client
+        self.away = {}  # Client that lost its connection -> timer that gives up its seat
+        
+        if listener is None:
+            print(f"Server started on {host}:{port}")
         
     def run(self):
         """Main server loop"""
         while True:
-            # Wait for activity on sockets
-            readable, _, exceptional = select.select(self.sockets, [], self.sockets, 0.1)
+            # Wait for activity on sockets, and for room in the send buffers of lagging clients,
+            # but no longer than until the next timer is due
+            writers = [sock for sock, buffer in self.outbound.items() if buffer]
+            timeout = self.scheduler.next_timeout()
+            readable, _, exceptional = select.select(self.sockets, writers, self.sockets, timeout)
+            started = time.perf_counter()
             
             for sock in readable:
                 if sock == self.server_socket:
@@ -43,246 +82,372 @@ class PictionaryServer:
             for sock in exceptional:
                 self.handle_disconnect(sock)
             
-            # Check game state
-            self.update_game_state()
+            # Run due timers, which seat the lobby and advance the games of the rooms
+            self.scheduler.run_due()
+            
+            # Write out everything queued during this iteration
+            self.flush_outbound()
+            self.reap_disconnects()
+            self.metrics.loop_time.observe(time.perf_counter() - started)
     
     def accept_connection(self):
         """Handle new client connection"""
         client_socket, address = self.server_socket.accept()
-        print(f"New connection from {address}")
-        
+        self.add_connection(client_socket, address)
+    
+    def add_connection(self, client_socket, address):
+        """Start serving an accepted connection"""
+        logger.info("New connection from %s", address)
+        client_socket.setblocking(False)
+        self.sockets.append(client_socket)
+        self.outbound[client_socket] = OutboundBuffer(client_socket)
+        self.decoders[client_socket] = FrameDecoder()
+        self.register_client(client_socket, address)
+    
+    def register_client(self, client_socket, address):
+        """Add a connected client, it gets a room once it joins"""
+        self.metrics.connections += 1
+        self.player_count += 1
         # Add to clients with a random player name
         player_name = f"Player_{random.randint(1000, 9999)}"
         self.clients[client_socket] = {
+            "id": self.player_count,
             "name": player_name,
             "address": address,
             "score": 0,
-            "is_drawer": False
+            "is_drawer": False,
+            "role": ROLE_PLAYER,
+            "format": FORMAT_JSON,  # Until the client negotiates another one with MSG_JOIN
+            "compression": None,
+            "room": None,
+            "joined": False  # The client takes part once it sent MSG_JOIN, it may be resuming an earlier session
         }
-        self.sockets.append(client_socket)
-        
-        # Send current game state to the new client
-        self.send_game_state_to_client(client_socket)
-        
-        # Update all clients with the new player list
-        self.broadcast_game_state()
     
     def handle_client_message(self, client_socket):
         """Process messages from clients"""
+        started = time.perf_counter()
         try:
-            data = client_socket.recv(4096)
-            if data:
-                # Split received data by newline and process each message
-                messages = data.decode('utf-8').split('\n')
-                for message_str in messages:
-                    if not message_str.strip():
-                        continue  # Skip empty strings
-                        
-                    try:
-                        message = json.loads(message_str)
-                        msg_type = message["type"]
-                        msg_data = message["data"]
-                        
-                        if msg_type == MSG_DRAW and self.clients[client_socket].get("is_drawer", False):
-                            # Forward drawing data to all clients
-                            self.drawing_data.append(msg_data)
-                            self.broadcast(encode_message(MSG_DRAW, msg_data), exclude=None)
-                        
-                        elif msg_type == MSG_CLEAR and self.clients[client_socket].get("is_drawer", False):
-                            # Clear canvas for all clients
-                            self.drawing_data = []
-                            self.broadcast(encode_message(MSG_CLEAR, {}), exclude=None)
-                        
-                        elif msg_type == MSG_GUESS and not self.clients[client_socket].get("is_drawer", False):
-                            # Handle word guess
-                            guess = msg_data["guess"].lower().strip()
-                            player_name = self.clients[client_socket]["name"]
-                            
-                            # Broadcast the guess to all clients
-                            self.broadcast(encode_message(MSG_GUESS, {
-                                "player": player_name, 
-                                "guess": guess
-                            }), exclude=None)
-                            
-                            # Check if guess is correct
-                            if self.game_state == STATE_PLAYING and guess == self.current_word:
-                                # Award points to guesser
-                                self.clients[client_socket]["score"] += 10
-                                
-                                # Award points to drawer
-                                if self.drawer in self.clients:
-                                    self.clients[self.drawer]["score"] += 5
-                                
-                                # End round
-                                self.game_state = STATE_ROUND_END
-                                self.broadcast(encode_message(MSG_RESULT, {
-                                    "winner": player_name,
-                                    "word": self.current_word
-                                }))
-                                
-                                # Broadcast updated game state
-                                self.broadcast_game_state()
-                                
-                                # Start new round after a delay
-                                threading.Timer(3, self.start_new_round).start()
-                    except json.JSONDecodeError as json_err:
-                        print(f"Error decoding JSON: {json_err} - Raw data: {message_str[:50]}...")
-                    except Exception as msg_err:
-                        print(f"Error processing message: {msg_err}")
+            decoder = self.decoders[client_socket]
+            if decoder.recv_from(client_socket):
+                # Handle every complete frame, a partial frame stays buffered for the next read
+                for frame in decoder.frames():
+                    self.handle_frame(client_socket, frame)
             else:
                 # Empty data means client disconnected
                 self.handle_disconnect(client_socket)
         
+        except OSError as e:
+            logger.info("Lost connection to a client: %s", e)
+            self.handle_disconnect(client_socket)
         except Exception as e:
-            print(f"Error handling client message: {e}")
+            logger.warning("Error handling client message: %s", e)
             self.handle_disconnect(client_socket)
+        self.metrics.handle_time.observe(time.perf_counter() - started)
     
-    def handle_disconnect(self, client_socket):
-        """Handle client disconnection"""
-        if client_socket in self.clients:
-            print(f"Client {self.clients[client_socket]['name']} disconnected")
-            
-            # Check if this was the drawer
-            was_drawer = self.clients[client_socket].get("is_drawer", False)
+    def handle_frame(self, client, frame):
+        """Decode and process one received frame"""
+        try:
+            if not tracer.enabled:
+                message = decode_message(frame)
+                self.metrics.received(message["type"], len(frame))
+                self.process_message(client, message)
+                return
             
-            # Remove from collections
-            self.sockets.remove(client_socket)
-            del self.clients[client_socket]
-            client_socket.close()
+            started = tracer.now()
+            message = decode_message(frame)
+            msg_type, data = message["type"], message["data"]
+            trace_id = None
+            if msg_type == MSG_DRAW and isinstance(data, dict):
+                # Draws from clients that do not trace get an id here, so their fan-out can be followed
+                trace_id = data.setdefault("trace", tracer.new_id())
+            tracer.span(f"decode {msg_type}", started, trace_id)
+            self.metrics.received(msg_type, len(frame))
+            started = tracer.now()
+            self.process_message(client, message)
+            tracer.span(f"handle {msg_type}", started, trace_id)
+        except (json.JSONDecodeError, struct.error, ValueError) as decode_err:
+            logger.warning("Error decoding message: %s - Raw data: %r...", decode_err, bytes(frame[:50]))
+        except Exception as msg_err:
+            logger.warning("Error processing message: %s", msg_err)
+    
+    def process_message(self, client_socket, message):
+        """Negotiate a client's connection and seat it, and pass everything else on to its room"""
+        msg_type = message["type"]
+        msg_data = message["data"]
+        
+        # Draw data over the rate limit is deferred by the room, everything else over it is dropped
+        if msg_type != MSG_DRAW and not self.admit(client_socket, msg_type):
+            self.metrics.limited(msg_type)
+            return
+
+        if msg_type == MSG_JOIN:
+            # Room ids are positive numbers, a client asking for anything else is not seated
+            room_id = msg_data.get("room")
+            if room_id is not None and not is_valid_room_id(room_id):
+                self.send_message(client_socket, MSG_JOIN, {"error": "Invalid room"})
+                return
+            if self.route_join(client_socket, msg_data):
+                return
             
-            # If drawer disconnected and game was in progress, end round
-            if was_drawer and self.game_state == STATE_PLAYING:
-                self.game_state = STATE_WAITING
-                if self.clients:  # If we still have clients
-                    self.broadcast(encode_message(MSG_RESULT, {
-                        "error": "Drawer disconnected",
-                        "word": self.current_word
-                    }))
+            # Switch to the best wire format and compression both sides support, confirming them in the old ones
+            wire_format = choose_wire_format(msg_data.get("formats", []))
+            compression = choose_compression(msg_data.get("compression", []))
+            resume = msg_data.get("resume")
+            resumed = isinstance(resume, dict) and self.resume_session(client_socket, resume.get("token"))
+            info = self.clients[client_socket]
+            room = info["room"]
+            if "token" not in info:
+                info["token"] = self.new_session_token()
+                self.sessions[info["token"]] = client_socket
+            self.send_message(client_socket, MSG_JOIN, {"format": wire_format, "compression": compression,
+                                                        "token": info["token"], "resumed": resumed,
+                                                        "seq": room.history.sequence if room else None})
+            info["format"] = wire_format
+            info["compression"] = compression
             
-            # Update game state for remaining clients
-            self.broadcast_game_state()
+            if resumed:
+                room.catch_up(client_socket, resume.get("seq"))
+                return
             
-            # Reset game if not enough players
-            if len(self.clients) < MIN_PLAYERS:
-                self.game_state = STATE_WAITING
-                self.drawer = None
-                self.current_word = None
-                self.drawing_data = []
+            # Spectators watch without playing, the drawer of a running round cannot leave the game that way
+            if msg_data.get("role") == ROLE_SPECTATOR and info["role"] != ROLE_SPECTATOR and not info["is_drawer"]:
+                info["role"] = ROLE_SPECTATOR
+                if room is not None:
+                    room.stop_game_if_too_few_players()
+                    self.rooms.update(room)
+            if room is not None:
+                room.broadcast_game_state()
+            else:
+                self.lobby.append((client_socket, room_id))
+                if self.match_timer is None:
+                    self.match_timer = self.schedule(0, self.match_players)
+            return
+        
+        room = self.clients[client_socket]["room"]
+        if room is not None:
+            room.process_message(client_socket, message)
     
-    def update_game_state(self):
-        """Check and update game state as needed"""
-        if self.game_state == STATE_WAITING and len(self.clients) >= MIN_PLAYERS:
-            # Start countdown when we have enough players
-            self.game_state = STATE_COUNTDOWN
-            self.countdown_timer = COUNTDOWN_SECONDS
-            
-            # Broadcast the updated game state to all clients
-            self.broadcast_game_state()  # Add this line to notify clients
-            
-            # Start the countdown
-            self.broadcast_countdown()
+    def route_join(self, client, join):
+        """Pass a joining client on to the server process holding its session or room, True if it was"""
+        return False
     
-    def broadcast_countdown(self):
-        """Broadcast countdown to all clients"""
-        if self.countdown_timer > 0:
-            print(f"Countdown: {self.countdown_timer}")  # Add debugging
-            self.broadcast(encode_message(MSG_COUNTDOWN, {"seconds": self.countdown_timer}))
-            self.countdown_timer -= 1
-            
-            # Use a more reliable approach than threading.Timer
-            threading.Timer(1, self.broadcast_countdown).start()
+    def new_session_token(self):
+        """A resume token nobody can guess"""
+        return secrets.token_urlsafe(16)
+    
+    def match_players(self):
+        """Seat every client in the lobby, all arrivals of a loop iteration at once"""
+        self.match_timer = None
+        while self.lobby:
+            client, room_id = self.lobby.popleft()
+            if client in self.clients and self.clients[client]["room"] is None:
+                # One client that cannot be seated must not keep the rest of the lobby waiting
+                try:
+                    self.choose_room(client, room_id).join(client)
+                except Exception as e:
+                    logger.warning("Could not seat client in room %s: %s", room_id, e)
+    
+    def choose_room(self, client, room_id=None):
+        """The room a client joins: the one it asked for if it has a seat, otherwise the fullest open one"""
+        spectating = self.clients[client]["role"] == ROLE_SPECTATOR
+        room = self.rooms.get(room_id)
+        if room is not None and (spectating or room.open_seats()):
+            return room
+        if spectating:
+            room = self.rooms.busiest()
         else:
-            print("Countdown finished, starting game")  # Add debugging
-            # Countdown finished, start the game
-            self.start_new_round()
-
+            room = self.rooms.find_open()
+        return room or self.rooms.create()
     
-    def start_new_round(self):
-        """Start a new game round"""
-        if len(self.clients) < MIN_PLAYERS:
-            self.game_state = STATE_WAITING
-            self.broadcast_game_state()
+    def handle_disconnect(self, client_socket):
+        """Handle client disconnection, keeping the seat of a joined client for a while"""
+        self.pending_disconnects.discard(client_socket)
+        if client_socket not in self.clients or client_socket in self.away:
             return
+        info = self.clients[client_socket]
+        room = info["room"]
+        if room is not None:
+            room.stop_playback(client_socket)
+        self.close_client(client_socket)
         
-        print("Starting new round")  # Debug
-        
-        # Reset drawing data
-        self.drawing_data = []
-        
-        # Choose a random drawer and word
-        self.drawer = random.choice(list(self.clients.keys()))
-        self.current_word = random.choice(WORDS)
-        
-        print(f"Selected drawer: {self.clients[self.drawer]['name']}")  # Debug
-        print(f"Selected word: {self.current_word}")  # Debug
-        
-        # Update client roles
-        for client in self.clients:
-            self.clients[client]["is_drawer"] = (client == self.drawer)
-        
-        # Set game state to playing
-        self.game_state = STATE_PLAYING
+        if room is not None and RESUME_GRACE_SECONDS > 0:
+            # The player keeps their name, score and place in the game if they resume in time
+            logger.info("Client %s disconnected, keeping their seat for %s seconds", info['name'], RESUME_GRACE_SECONDS)
+            self.away[client_socket] = self.schedule(RESUME_GRACE_SECONDS, lambda: self.remove_client(client_socket))
+            room.broadcast_game_state()
+            return
+        self.remove_client(client_socket)
+    
+    def remove_client(self, client_socket):
+        """Remove a disconnected client from the server and its room for good"""
+        timer = self.away.pop(client_socket, None)
+        if timer is not None:
+            timer.cancel()
+        info = self.clients.pop(client_socket, None)
+        if info is None:
+            return
+        logger.info("Client %s left", info['name'])
+        self.sessions.pop(info.get("token"), None)
+        if info["room"] is not None:
+            info["room"].remove(client_socket)
+    
+    def resume_session(self, client_socket, token):
+        """Hand the seat of an earlier connection to a reconnected client, True if there was one"""
+        previous = self.sessions.get(token)
+        if (previous is None or previous == client_socket or self.clients[client_socket]["joined"]
+                or self.clients[previous]["room"] is None):
+            return False
         
-        # Send game state to all clients
-        self.broadcast_game_state()
+        room = self.clients[previous]["room"]
+        timer = self.away.pop(previous, None)
+        if timer is not None:
+            timer.cancel()
+        else:
+            # The earlier connection has not noticed yet that it is gone
+            room.stop_playback(previous)
+            self.close_client(previous)
         
-        # Send the word only to the drawer - THIS PART MAY BE BUGGY
-        if self.drawer in self.clients:
-            try:
-                # Instead of sending a separate message, ensure the word is included in the game state
-                # for the drawer when we call broadcast_game_state()
-                print(f"Sending word to drawer: {self.current_word}")  # Debug
-            except Exception as e:
-                print(f"Error sending word to drawer: {e}")
+        # The new connection takes over the player info, and its place in the room's player list
+        info = self.clients.pop(previous)
+        info.update(address=self.clients[client_socket]["address"], format=FORMAT_JSON, compression=None)
+        self.clients[client_socket] = info
+        self.sessions[token] = client_socket
+        room.replace(previous, client_socket)
+        logger.info("Client %s resumed their session", info['name'])
+        return True
     
-    def send_game_state_to_client(self, client):
-        """Send current game state to a specific client"""
-        client_is_drawer = self.clients[client].get("is_drawer", False)
-        
-        state_data = {
-            "state": self.game_state,
-            "players": [{"name": player["name"], "score": player["score"], 
-                        "is_drawer": player["is_drawer"]} 
-                        for player in self.clients.values()],
-            "is_drawer": client_is_drawer
-        }
+    def admit(self, client, msg_type):
+        """Take a token for a message from the client's and the room's rate limits, False if over either"""
+        if take_token(self.rate_buckets(client, msg_type)):
+            return True
+        logger.debug("Client %s is over the %s rate limit", self.clients[client]['name'], msg_type)
+        return False
+    
+    def rate_buckets(self, client, msg_type):
+        """Token buckets limiting a message type from a client"""
+        info = self.clients[client]
+        if "buckets" not in info:
+            info["buckets"] = make_buckets(CLIENT_RATE_LIMITS)
+        shared = info["room"].buckets if info["room"] is not None else {}
+        return [buckets[msg_type] for buckets in (info["buckets"], shared) if msg_type in buckets]
+    
+    def close_client(self, client_socket):
+        """Release the transport of a client that left the game"""
+        self.sockets.remove(client_socket)
+        del self.outbound[client_socket]
+        del self.decoders[client_socket]
+        self.pending_disconnects.discard(client_socket)
+        client_socket.close()
+    
+    def send_to_client(self, client, message, droppable=False):
+        """Queue an encoded message for a single client
         
-        # Add word if this client is the drawer
-        if client_is_drawer and self.current_word:
-            state_data["word"] = self.current_word
-            print(f"Including word in state for drawer: {self.current_word}")  # Debug
+        Droppable frames are skipped for clients that fell too far behind;
+        those clients get a full resync once their buffer has drained.
+        """
+        buffer = self.outbound.get(client)
+        if buffer is None or client in self.pending_disconnects:
+            return
+        if droppable and buffer.lagging:
+            return
         
-        # Send the game state
-        try:
-            client.send(encode_message(MSG_STATE, state_data))
-            print(f"Sent game state to {self.clients[client]['name']}")  # Debug
-        except Exception as e:
-            print(f"Error sending game state: {e}")
-            self.handle_disconnect(client)
+        buffer.push(message)
         
-        # Send existing drawing data
-        for draw_data in self.drawing_data:
+        if buffer.pending_bytes > CLIENT_LAG_THRESHOLD:
+            if SLOW_CLIENT_POLICY == "downgrade" and not buffer.lagging:
+                logger.info("Client %s is lagging, pausing its draw stream", self.clients[client]['name'])
+                buffer.lagging = True
+            elif SLOW_CLIENT_POLICY != "downgrade" or buffer.pending_bytes > CLIENT_LAG_LIMIT:
+                logger.warning("Client %s is too slow, disconnecting", self.clients[client]['name'])
+                self.pending_disconnects.add(client)
+    
+    def send_message(self, client, msg_type, data, droppable=False, sequence=None):
+        """Encode a message in the client's wire format and send it"""
+        info = self.clients[client]
+        message = encode_message(msg_type, data, info["format"], info["compression"], sequence)
+        self.metrics.sent(msg_type, len(message))
+        self.send_to_client(client, message, droppable)
+    
+    def flush_outbound(self):
+        """Write queued frames to every client that has some"""
+        traced = tracer.now() if tracer.enabled else 0
+        for client, buffer in list(self.outbound.items()):
+            if not buffer or client in self.pending_disconnects:
+                continue
             try:
-                client.send(encode_message(MSG_DRAW, draw_data))
-            except:
-                self.handle_disconnect(client)
+                drained = buffer.flush()
+            except OSError as e:
+                logger.info("Error sending to client: %s", e)
+                self.pending_disconnects.add(client)
+                continue
+            
+            if drained and buffer.lagging:
+                # The client caught up, bring it back in sync with the drawing
+                buffer.lagging = False
+                room = self.clients[client]["room"]
+                if room is not None:
+                    room.send_game_state_to_client(client)
+                    room.send_snapshot(client)
+        if traced:
+            tracer.span("flush", traced)
     
-    def broadcast_game_state(self):
-        """Broadcast game state to all clients"""
-        for client in self.clients:
-            self.send_game_state_to_client(client)
+    def queue_depths(self):
+        """Name and number of queued frames of every client, for the metrics endpoint"""
+        return [(self.clients[client]["name"], buffer.depth)
+                for client, buffer in list(self.outbound.items()) if client in self.clients]
     
-    def broadcast(self, message, exclude=None):
-        """Send message to all clients except excluded one"""
-        for client in self.clients:
-            if client != exclude:
-                try:
-                    client.send(message)
-                except:
-                    self.handle_disconnect(client)
+    def reap_disconnects(self):
+        """Disconnect clients that failed or fell too far behind"""
+        while self.pending_disconnects:
+            self.handle_disconnect(self.pending_disconnects.pop())
+    
+    def schedule(self, delay, callback):
+        """Run a callback on the server loop after the given delay in seconds"""
+        return self.scheduler.call_later(delay, callback)
+
+def create_server(engine=SERVER_ENGINE, host=HOST, port=PORT, recording_dir=RECORDING_DIR, room_size=ROOM_SIZE):
+    """Create a server running the requested engine"""
+    if engine == "asyncio":
+        from server.async_server import AsyncPictionaryServer
+        return AsyncPictionaryServer(host, port, recording_dir, room_size)
+    return PictionaryServer(host, port, recording_dir, room_size)
 
 if __name__ == "__main__":
-    server = PictionaryServer()
+    parser = argparse.ArgumentParser(description="Pictionary game server")
+    parser.add_argument("--engine", choices=["select", "asyncio"], default=SERVER_ENGINE,
+                        help="Network engine used to serve clients")
+    parser.add_argument("--host", default=HOST, help="Address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("--record", metavar="DIR", default=RECORDING_DIR,
+                        help="Record every round to this directory for replays")
+    parser.add_argument("--room-size", type=int, default=ROOM_SIZE, help="Players per room")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Worker processes behind a supervisor, 0 for one per CPU core")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve Prometheus metrics over HTTP on this local port")
+    parser.add_argument("--log-level", default=LOG_LEVEL,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper,
+                        help="Least severe log messages to show")
+    parser.add_argument("--trace", action="store_true",
+                        help="Record message handling spans, dumped on SIGUSR1 or from the metrics endpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.workers != 1:
+        from server.supervisor import Supervisor
+        supervisor = Supervisor(args.host, args.port, args.workers, args.engine, args.record, args.room_size,
+                                args.metrics_port, args.trace)
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            print("Server shutting down")
+        sys.exit()
+    if args.trace:
+        tracer.enable("server")
+        tracer.install_signal_handler(lambda path: print(f"Trace written to {path}"))
+    
+    server = create_server(args.engine, args.host, args.port, args.record, args.room_size)
+    if args.metrics_port:
+        start_metrics_server(server.metrics, METRICS_HOST, args.metrics_port)
     try:
         server.run()
     except KeyboardInterrupt:
@@ -0,0 +1,276 @@
+import sys
+import zlib
+from array import array
+from shared.raster import Bitmap
+from shared.common import *
+
+# Draw data results
+DRAW_STORED = "stored"
+DRAW_OVER_BUDGET = "over budget"  # The round's memory budget is used up
+DRAW_STROKE_CLOSED = "stroke closed"  # Continues a stroke that is no longer the newest
+
+class Stroke:
+    """One continuous stroke as a flat array of uint16 coordinates"""
+    __slots__ = ("id", "coords", "finished")
+
+    def __init__(self, stroke_id, points):
+        self.id = stroke_id
+        self.coords = array('H', points)
+        self.finished = False
+
+    @property
+    def nbytes(self):
+        return len(self.coords) * self.coords.itemsize
+
+    def last_point(self):
+        return self.coords[-2], self.coords[-1]
+
+    def fits(self, size):
+        """True if every point lies on a square raster of the given size"""
+        return max(self.coords) < size
+
+def simplify(coords, tolerance):
+    """Ramer-Douglas-Peucker simplification of a flat coordinate array"""
+    count = len(coords) // 2
+    if count < 3:
+        return coords
+
+    keep = bytearray(count)
+    keep[0] = keep[-1] = 1
+    tolerance_sq = tolerance * tolerance
+
+    # Iterative to stay clear of the recursion limit on long strokes
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coords[2 * first], coords[2 * first + 1]
+        dx, dy = coords[2 * last] - x1, coords[2 * last + 1] - y1
+        length_sq = dx * dx + dy * dy
+
+        farthest, farthest_dist = -1, tolerance_sq * max(length_sq, 1)
+        for i in range(first + 1, last):
+            px, py = coords[2 * i] - x1, coords[2 * i + 1] - y1
+            if length_sq:
+                # Squared distance to the line, scaled by the squared segment length
+                cross = px * dy - py * dx
+                dist = cross * cross
+            else:
+                dist = px * px + py * py
+            if dist > farthest_dist:
+                farthest, farthest_dist = i, dist
+
+        if farthest != -1:
+            keep[farthest] = 1
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+    simplified = array('H')
+    for i in range(count):
+        if keep[i]:
+            simplified.append(coords[2 * i])
+            simplified.append(coords[2 * i + 1])
+    return simplified
+
+def merge_draw(merged, draw_data):
+    """Append draw data to a list of polylines, extending the last one if it continues the same stroke"""
+    if "points" in draw_data:
+        points = list(draw_data["points"])
+        end = draw_data.get("end", False)
+    else:
+        points = [draw_data["x1"], draw_data["y1"], draw_data["x2"], draw_data["y2"]]
+        end = False
+    stroke = draw_data.get("stroke")
+
+    last = merged[-1] if merged else None
+    if (last is not None and not last.get("end") and last.get("stroke") == stroke
+            and last["points"][-2:] == points[:2]):
+        last["points"].extend(points[2:])
+    else:
+        last = {"points": points}
+        if stroke is not None:
+            last["stroke"] = stroke
+        merged.append(last)
+    if end:
+        last["end"] = True
+
+def merge_draws(draws):
+    """Join draw data that continues the previous stroke into single polylines"""
+    merged = []
+    for draw_data in draws:
+        merge_draw(merged, draw_data)
+    return merged
+
+class StrokeStore:
+    """The drawing of one round, kept as compact per-stroke coordinate arrays
+
+    Strokes are indexed by their id, so undoing or erasing one is a dictionary
+    removal. They are simplified once finished and the store refuses new points
+    once the round's memory budget is used up. For snapshots, every stroke
+    except the one still being drawn is rasterized into a bitmap of the canvas,
+    so a late joiner gets one raster and the few strokes on top of it instead
+    of the whole history of the round. Strokes that reach past the raster,
+    which clients with a bigger canvas can draw, stay points. Erasing a stroke that is already part
+    of the raster drops the raster, and the next snapshot rasterizes the
+    remaining strokes afresh.
+    """
+
+    def __init__(self, budget=ROUND_MEMORY_BUDGET, tolerance=SIMPLIFY_TOLERANCE, line_width=LINE_WIDTH):
+        self.budget = budget
+        self.tolerance = tolerance
+        self.line_width = line_width
+        self.strokes = {}  # Stroke id -> Stroke, in drawing order
+        self.pending = {}  # Stroke id -> Stroke not part of the raster, in drawing order
+        self.current = None  # Stroke still being drawn
+        self.next_id = 1  # First id to try for draw data that comes without one, ids of the drawer do not move it
+        self.nbytes = 0
+        self.base = None  # (width, height, pixels) the drawing started from, strokes of it cannot be erased
+        self.raster = None  # Bitmap of the base and the strokes not pending, None until a snapshot needs it
+        self.packed_raster = None  # (compressed raster, compressor state after it), kept until more strokes are flattened
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def clear(self):
+        """Forget every stroke"""
+        self.strokes = {}
+        self.pending = {}
+        self.current = None
+        self.next_id = 1
+        self.nbytes = 0
+        self.base = None
+        self.raster = None
+        self.packed_raster = None
+
+    def load_raster(self, width, height, pixels):
+        """Start the drawing from a raster, such as the one of a snapshot"""
+        self.base = (width, height, pixels)
+        self.raster = None
+        self.packed_raster = None
+
+    def last_id(self):
+        """Id of the newest stroke, None if there is none"""
+        return next(reversed(self.strokes), None)
+
+    def new_id(self):
+        """An unused stroke id for draw data that comes without one, counting up and wrapping within uint32"""
+        stroke_id = self.next_id
+        while stroke_id in self.strokes:
+            stroke_id = stroke_id % 0xFFFFFFFF + 1
+        self.next_id = stroke_id % 0xFFFFFFFF + 1
+        return stroke_id
+
+    def add(self, draw_data):
+        """Store a segment or polyline and set its stroke id, returns DRAW_STORED or why it was refused"""
+        if "points" in draw_data:
+            points = [clamp_coordinate(value) for value in draw_data["points"]]
+            end = draw_data.get("end", False)
+        else:
+            points = [clamp_coordinate(draw_data[key]) for key in ("x1", "y1", "x2", "y2")]
+            end = False
+
+        current = self.current
+        stroke_id = draw_data.get("stroke")
+        if stroke_id is None:
+            # Without an id, a batch that starts where the current stroke stopped continues it
+            if current is not None and current.last_point() == (points[0], points[1]):
+                stroke = current
+            else:
+                stroke, stroke_id = None, self.new_id()
+        else:
+            stroke = self.strokes.get(stroke_id)
+            if stroke is not None and stroke is not current and stroke_id != self.last_id():
+                return DRAW_STROKE_CLOSED
+        continues = stroke is not None and stroke.last_point() == (points[0], points[1])
+        new_points = points[2:] if continues else points
+
+        added = len(new_points) * array('H').itemsize
+        if self.nbytes + added > self.budget:
+            return DRAW_OVER_BUDGET
+
+        if stroke is None:
+            stroke = Stroke(stroke_id, new_points)
+            self.strokes[stroke_id] = stroke
+        else:
+            stroke.coords.extend(new_points)
+        # A stroke that grows after it was rasterized is drawn again, its old points cover the same pixels
+        self.pending[stroke.id] = stroke
+        self.current = stroke
+        self.nbytes += added
+        draw_data["stroke"] = stroke.id
+
+        if end:
+            self.finish(stroke)
+        return DRAW_STORED
+
+    def finish(self, stroke):
+        """Simplify a completed stroke"""
+        before = stroke.nbytes
+        stroke.coords = simplify(stroke.coords, self.tolerance)
+        stroke.finished = True
+        self.nbytes -= before - stroke.nbytes
+        if stroke is self.current:
+            self.current = None
+
+    def erase(self, stroke_ids):
+        """Remove strokes by id, returns the ids of the ones that were stored"""
+        erased = []
+        for stroke_id in stroke_ids:
+            stroke = self.strokes.pop(stroke_id, None)
+            if stroke is None:
+                continue
+            erased.append(stroke_id)
+            self.nbytes -= stroke.nbytes
+            if stroke is self.current:
+                self.current = None
+            if self.pending.pop(stroke_id, None) is None:
+                # Part of the raster, which cannot take it out again
+                self.raster = None
+                self.packed_raster = None
+        if self.raster is None:
+            self.pending = dict(self.strokes)
+        return erased
+
+    def flatten(self):
+        """Rasterize the strokes that can no longer change, all at once"""
+        ready = [stroke for stroke in self.pending.values()
+                 if stroke is not self.current and stroke.fits(CANVAS_SIZE)]
+        if not ready and (self.raster is not None or self.base is None):
+            return
+        if self.raster is None:
+            self.raster = Bitmap(CANVAS_SIZE, CANVAS_SIZE)
+            if self.base is not None:
+                self.raster.paste(*self.base)
+        self.raster.draw_polylines([stroke.coords for stroke in ready], self.line_width)
+        for stroke in ready:
+            del self.pending[stroke.id]
+        self.packed_raster = None
+
+    def pack(self):
+        """Compress the drawing into a snapshot: a raster frame and raw point frames of the strokes on top"""
+        self.flatten()
+        if self.packed_raster is None:
+            compressor = zlib.compressobj()
+            packed = compressor.compress(self.raster.pack()) if self.raster is not None else b""
+            self.packed_raster = (packed, compressor)
+
+        chunks = []
+        for stroke in self.pending.values():
+            coords = stroke.coords
+            if sys.byteorder == "little":
+                coords = array('H', coords)
+                coords.byteswap()
+            payload = STROKE_ID.pack(stroke.id) + coords.tobytes()
+            chunks.append(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_POINTS, len(payload)))
+            chunks.append(payload)
+        packed, compressor = self.packed_raster
+        compressor = compressor.copy()
+        return packed + compressor.compress(b"".join(chunks)) + compressor.flush()
+
+    def render(self):
+        """The whole drawing as a new bitmap"""
+        self.flatten()
+        bitmap = Bitmap(CANVAS_SIZE, CANVAS_SIZE)
+        if self.raster is not None:
+            bitmap.pixels[:] = self.raster.pixels
+        bitmap.draw_polylines([stroke.coords for stroke in self.pending.values()], self.line_width)
+        return bitmap
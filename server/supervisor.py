@@ -0,0 +1,329 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import time
+from server.async_server import AsyncPictionaryServer
+from server.metrics import start_metrics_server
+from server.room import RoomRegistry
+from server.server import PictionaryServer
+from shared.trace import tracer
+from shared.common import *
+
+logger = logging.getLogger(__name__)
+
+# Messages on the Unix socket between the supervisor and a worker, a header followed by data
+CONTROL_HEADER = struct.Struct("!BI")  # kind, value
+CONTROL_CONNECTION = 1  # To a worker: serve the passed connection, the data was already received on it
+CONTROL_LOAD = 2  # To the supervisor: value is the worker's number of clients
+CONTROL_HANDOFF = 3  # To the supervisor: pass the connection on to worker value, the data was received on it
+CONTROL_MESSAGE_SIZE = 64 * 1024  # Largest control message, bigger handoffs are served where they are
+
+class ShardServer:
+    """A game server running as one of the supervisor's worker processes
+
+    Connections arrive over the control socket instead of a listening socket.
+    Room ids and resume tokens tell which worker they belong to, so a client
+    that asks for a room or session of another worker is handed over to it
+    before it gets any reply.
+    """
+
+    def __init__(self, index, count, control, recording_dir=RECORDING_DIR, room_size=ROOM_SIZE):
+        super().__init__(recording_dir=recording_dir, room_size=room_size, listener=control)
+        self.index = index
+        self.count = count
+        self.control = control
+        self.rooms = RoomRegistry(self, room_size, first_id=index + 1, id_step=count)
+
+    def receive_connection(self):
+        """The next connection from the supervisor as (socket, data received on it), None if it closed already"""
+        message, fds, _, _ = socket.recv_fds(self.control, CONTROL_MESSAGE_SIZE, 1)
+        if not message:
+            logger.info("Worker %s lost its supervisor, exiting", self.index)
+            raise SystemExit(0)
+        if not fds:
+            return None
+        client_socket = socket.socket(fileno=fds[0])
+        kind, _ = CONTROL_HEADER.unpack_from(message)
+        if kind != CONTROL_CONNECTION:
+            client_socket.close()
+            return None
+        return client_socket, message[CONTROL_HEADER.size:]
+
+    def report_load(self):
+        """Tell the supervisor how many clients this worker serves, again every WORKER_LOAD_MS"""
+        self.control.send(CONTROL_HEADER.pack(CONTROL_LOAD, len(self.clients)))
+        self.schedule(WORKER_LOAD_MS / 1000, self.report_load)
+
+    def new_session_token(self):
+        """A resume token that starts with the index of this worker"""
+        return f"{self.index}.{super().new_session_token()}"
+
+    def worker_for(self, join):
+        """Index of the worker holding the session or room a JOIN asks for, None if any worker will do"""
+        resume = join.get("resume")
+        if isinstance(resume, dict) and isinstance(resume.get("token"), str):
+            prefix = resume["token"].partition(".")[0]
+            if prefix.isdigit() and int(prefix) < self.count:
+                return int(prefix)
+        room_id = join.get("room")
+        if is_valid_room_id(room_id):
+            return (room_id - 1) % self.count
+        return None
+
+    def route_join(self, client, join):
+        """Hand a client that joins a room or session of another worker over to it"""
+        target = self.worker_for(join)
+        if target is None or target == self.index or "token" in self.clients[client]:
+            return False
+
+        # Pass on the JOIN and everything received after it, the client never notices the move
+        decoder = self.client_decoder(client)
+        message = CONTROL_HEADER.pack(CONTROL_HANDOFF, target) + encode_message(MSG_JOIN, join)
+        if len(message) + decoder.end - decoder.start > CONTROL_MESSAGE_SIZE:
+            return False
+        message += decoder.drain()
+        try:
+            socket.send_fds(self.control, [message], [self.client_socket(client).fileno()])
+        except OSError as e:
+            logger.warning("Could not hand %s over to worker %s: %s", self.clients[client]["address"], target, e)
+            return False
+
+        logger.info("Handed %s over to worker %s", self.clients[client]["address"], target)
+        self.clients.pop(client)
+        self.close_client(client)
+        return True
+
+class WorkerServer(ShardServer, PictionaryServer):
+    """A worker process running the select engine"""
+
+    def run(self):
+        """Main server loop"""
+        self.report_load()
+        super().run()
+
+    def accept_connection(self):
+        """Serve a connection the supervisor passed on"""
+        connection = self.receive_connection()
+        if connection is None:
+            return
+        client_socket, data = connection
+        try:
+            address = client_socket.getpeername()
+        except OSError:
+            client_socket.close()  # Gone before we got to it
+            return
+        self.add_connection(client_socket, address)
+        if data:
+            decoder = self.decoders[client_socket]
+            decoder.feed(data)
+            for frame in decoder.frames():
+                self.handle_frame(client_socket, frame)
+
+    def client_decoder(self, client):
+        return self.decoders[client]
+
+    def client_socket(self, client):
+        return client
+
+class AsyncWorkerServer(ShardServer, AsyncPictionaryServer):
+    """A worker process running the asyncio engine"""
+
+    async def serve(self):
+        """Serve the connections the supervisor passes on until it goes away"""
+        self.loop = asyncio.get_running_loop()
+        self.report_load()
+        self.loop.add_reader(self.control, self.accept_connection)
+        await self.loop.create_future()
+
+    def accept_connection(self):
+        """Serve a connection the supervisor passed on"""
+        connection = self.receive_connection()
+        if connection is not None:
+            asyncio.ensure_future(self.adopt(*connection))
+
+    async def adopt(self, client_socket, data):
+        """Serve a passed connection, starting with the data already received on it"""
+        try:
+            reader, writer = await asyncio.open_connection(sock=client_socket)
+        except OSError:
+            client_socket.close()
+            return
+        await self.handle_connection(reader, writer, data)
+
+    def client_decoder(self, client):
+        # Every read takes all the stream reader buffered, so the decoder holds everything received so far
+        return client.decoder
+
+    def client_socket(self, client):
+        return client.writer.get_extra_info("socket")
+
+class WorkerProcess:
+    """The supervisor's end of a worker"""
+
+    def __init__(self, index, process, control):
+        self.index = index
+        self.process = process
+        self.control = control
+        self.load = 0  # Clients of the worker, counted up on every handoff until it reports again
+
+class Supervisor:
+    """Accepts connections and hands each to the least loaded of several worker processes
+
+    Every worker is a complete game server with its own event loop and rooms,
+    forked from the supervisor and given connections over a Unix socket. A
+    worker that exits is started again after WORKER_RESTART_SECONDS; its
+    clients lose their connection and join anew. Needs a platform with fork
+    and file descriptor passing, such as Linux.
+    """
+
+    def __init__(self, host=HOST, port=PORT, workers=WORKERS, engine=SERVER_ENGINE, recording_dir=RECORDING_DIR,
+                 room_size=ROOM_SIZE, metrics_port=METRICS_PORT, trace=False):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((host, port))
+        self.server_socket.listen(LISTEN_BACKLOG)
+
+        self.engine = engine
+        self.recording_dir = recording_dir
+        self.room_size = room_size
+        self.metrics_port = metrics_port
+        self.trace = trace
+        self.context = multiprocessing.get_context("fork")
+        self.workers = [None] * (workers or os.cpu_count() or 1)  # WorkerProcess, None while waiting for a restart
+        self.restarts = {}  # Index of an exited worker -> time it is started again
+
+        print(f"Server started on {host}:{port} with {len(self.workers)} workers")
+
+    def run(self):
+        """Start the workers and pass connections on to them until interrupted"""
+        if hasattr(signal, "SIGTERM"):
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        for index in range(len(self.workers)):
+            self.start_worker(index)
+
+        try:
+            while True:
+                controls = {worker.control: worker for worker in self.workers if worker is not None}
+                timeout = None
+                if self.restarts:
+                    timeout = max(0, min(self.restarts.values()) - time.monotonic())
+                readable, _, _ = select.select([self.server_socket, *controls], [], [], timeout)
+
+                for sock in readable:
+                    if sock is self.server_socket:
+                        self.accept_connection()
+                    else:
+                        self.handle_control(controls[sock])
+                self.restart_workers()
+        finally:
+            self.stop()
+
+    def start_worker(self, index):
+        """Fork a worker process with a fresh control socket"""
+        control, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        process = self.context.Process(target=self.run_worker, args=(index, worker_end, control),
+                                       name=f"pictionary-worker-{index}", daemon=True)
+        process.start()
+        worker_end.close()
+        control.setblocking(False)  # A stuck worker must not stall the supervisor
+        self.workers[index] = WorkerProcess(index, process, control)
+        logger.info("Started worker %s as process %s", index, process.pid)
+
+    def run_worker(self, index, control, supervisor_end):
+        """Body of a worker process"""
+        # Only the supervisor handles Ctrl+C, and the sockets of the supervisor are not the worker's to keep open
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if hasattr(signal, "SIGTERM"):
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.server_socket.close()
+        supervisor_end.close()
+        for worker in self.workers:
+            if worker is not None:
+                worker.control.close()
+
+        if self.trace:
+            tracer.enable(f"worker-{index}")
+            tracer.install_signal_handler(lambda path: print(f"Trace written to {path}"))
+        worker_class = AsyncWorkerServer if self.engine == "asyncio" else WorkerServer
+        server = worker_class(index, len(self.workers), control, self.recording_dir, self.room_size)
+        if self.metrics_port:
+            # Every worker serves its own metrics, on the ports following the first one
+            start_metrics_server(server.metrics, METRICS_HOST, self.metrics_port + index)
+        server.run()
+
+    def accept_connection(self):
+        """Hand a new connection to the least loaded worker"""
+        client_socket, address = self.server_socket.accept()
+        with client_socket:
+            self.dispatch(client_socket.fileno(), address)
+
+    def dispatch(self, fd, address, data=b"", index=None):
+        """Pass a connection on to a worker, the given one if it is running, else the least loaded one"""
+        worker = self.workers[index] if index is not None and index < len(self.workers) else None
+        if worker is None:
+            running = [worker for worker in self.workers if worker is not None]
+            if not running:
+                logger.warning("No worker to serve %s, closing the connection", address)
+                return
+            worker = min(running, key=lambda worker: worker.load)
+        try:
+            socket.send_fds(worker.control, [CONTROL_HEADER.pack(CONTROL_CONNECTION, 0) + data], [fd])
+        except OSError as e:
+            logger.warning("Could not pass %s on to worker %s: %s", address, worker.index, e)
+            return
+        worker.load += 1
+
+    def handle_control(self, worker):
+        """Handle a load report or handoff of a worker, or its exit"""
+        try:
+            message, fds, _, _ = socket.recv_fds(worker.control, CONTROL_MESSAGE_SIZE, 1)
+        except BlockingIOError:
+            return
+        except OSError:
+            message, fds = b"", []
+        if not message:
+            self.worker_exited(worker)
+            return
+
+        kind, value = CONTROL_HEADER.unpack_from(message)
+        if kind == CONTROL_LOAD:
+            worker.load = value
+        elif kind == CONTROL_HANDOFF and fds:
+            worker.load -= 1
+            self.dispatch(fds[0], f"a client of worker {worker.index}", message[CONTROL_HEADER.size:], value)
+        for fd in fds:
+            os.close(fd)  # The worker that serves it has its own copy
+
+    def worker_exited(self, worker):
+        """Forget a worker that exited and start it again after a while"""
+        worker.control.close()
+        worker.process.join(1)
+        logger.warning("Worker %s exited with code %s, restarting it in %s seconds",
+                       worker.index, worker.process.exitcode, WORKER_RESTART_SECONDS)
+        self.workers[worker.index] = None
+        self.restarts[worker.index] = time.monotonic() + WORKER_RESTART_SECONDS
+
+    def restart_workers(self):
+        """Start the workers whose restart is due"""
+        now = time.monotonic()
+        for index, due in list(self.restarts.items()):
+            if due <= now:
+                del self.restarts[index]
+                self.start_worker(index)
+
+    def stop(self):
+        """Stop every worker"""
+        for worker in self.workers:
+            if worker is not None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker is not None:
+                worker.process.join()
+                worker.control.close()
+        self.server_socket.close()
@@ -0,0 +1,123 @@
+import os
+import random
+import unicodedata
+from shared.common import *
+
+# Guess check results
+GUESS_WRONG = "wrong"
+GUESS_CLOSE = "close"
+GUESS_CORRECT = "correct"
+
+DEFAULT_WORD_LIST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "wordlists")
+
+def normalize(text):
+    """Fold case, strip diacritics and punctuation and collapse whitespace"""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    letters = "".join(char if char.isalnum() else " " for char in decomposed
+                      if not unicodedata.combining(char))
+    return " ".join(letters.split())
+
+def singular(phrase):
+    """Reduce the last word of a normalized phrase to a naive English singular"""
+    head, _, word = phrase.rpartition(" ")
+    if len(word) > 3 and word.endswith("ies"):
+        word = word[:-3] + "y"
+    elif len(word) > 3 and word.endswith(("ches", "shes", "sses", "xes", "zes")):
+        word = word[:-2]
+    elif len(word) > 2 and word.endswith("s") and not word.endswith("ss"):
+        word = word[:-1]
+    return f"{head} {word}" if head else word
+
+def deletions(word, distance):
+    """Every string reachable from word by deleting up to distance characters"""
+    variants = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {variant[:i] + variant[i + 1:] for variant in frontier for i in range(len(variant))}
+        variants |= frontier
+    return variants
+
+class WordBank:
+    """Word lists split into categories, one "<category>.txt" file per category
+
+    Files are only read when a category is first needed. Words are drawn from a
+    shuffled deck per category so nothing repeats until the deck runs out.
+    """
+
+    def __init__(self, directory=WORD_LIST_DIR, categories=WORD_CATEGORIES):
+        self.directory = directory or DEFAULT_WORD_LIST_DIR
+        self.words = {}  # category -> list of words, filled on first use
+        self.decks = {}  # category -> words not drawn yet
+        self.known = None  # Normalized forms of every word, built on first use
+
+        available = []
+        if os.path.isdir(self.directory):
+            available = sorted(name[:-4] for name in os.listdir(self.directory) if name.endswith(".txt"))
+        self.categories = [name for name in available if categories is None or name in categories]
+
+        if not self.categories:
+            # No word files, fall back to the built-in list
+            self.categories = ["default"]
+            self.words["default"] = list(WORDS)
+
+    def load(self, category):
+        """Words of a category, read from its file on first use"""
+        if category not in self.words:
+            path = os.path.join(self.directory, f"{category}.txt")
+            with open(path, encoding="utf-8") as word_file:
+                lines = (line.strip() for line in word_file)
+                self.words[category] = [line for line in lines if line and not line.startswith("#")]
+        return self.words[category]
+
+    def choose(self, category=None):
+        """Draw a word and its category, without repeats until the category is used up"""
+        if category is None:
+            category = random.choice(self.categories)
+
+        deck = self.decks.get(category)
+        if not deck:
+            deck = self.decks[category] = list(self.load(category))
+            random.shuffle(deck)
+        return deck.pop(), category
+
+    def dictionary(self):
+        """Normalized forms of every word in every category"""
+        if self.known is None:
+            known = set()
+            for category in self.categories:
+                for word in self.load(category):
+                    known.add(normalize(word))
+                    known.add(singular(normalize(word)))
+            self.known = known
+        return self.known
+
+class GuessMatcher:
+    """Checks guesses against the word of one round
+
+    The answer's deletion neighbourhood is computed once per round, so a guess
+    is matched with a handful of set lookups however large the dictionary is.
+    """
+
+    def __init__(self, answer, dictionary=frozenset(), max_distance=CLOSE_GUESS_DISTANCE):
+        self.answer = singular(normalize(answer))
+        self.dictionary = dictionary
+        self.max_distance = max_distance
+        self.neighbourhood = deletions(self.answer, max_distance)
+
+    def check(self, guess):
+        """Classify a guess as correct, close or wrong"""
+        normalized = normalize(guess)
+        if singular(normalized) == self.answer:
+            return GUESS_CORRECT
+
+        # Another real word is a wrong guess, even if it is spelled similarly
+        if not normalized or normalized in self.dictionary:
+            return GUESS_WRONG
+
+        # Two strings within the edit distance share a string reachable by deletions from both
+        guess_form = singular(normalized)
+        if abs(len(guess_form) - len(self.answer)) > self.max_distance:
+            return GUESS_WRONG
+        if self.neighbourhood.isdisjoint(deletions(guess_form, self.max_distance)):
+            return GUESS_WRONG
+        return GUESS_CLOSE
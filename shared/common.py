@@ -1,22 +1,124 @@
+import base64
 import json
+import struct
+import sys
+import zlib
+from array import array
+
+# Optional faster JSON backend
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Network settings
 HOST = "localhost"
 PORT = 5555
+RELAY_PORT = 5556  # Port spectators connect to when watching through a relay
+LISTEN_BACKLOG = 128  # Connections waiting to be accepted, enough for a burst of load test bots
 
 # Game settings
 CANVAS_SIZE = 500
+LINE_WIDTH = 2  # Brush width in pixels, of the lines on the canvas and of the server's raster of the drawing
 COUNTDOWN_SECONDS = 5
+ROUND_SECONDS = 90  # Time the guessers have before the round ends without a winner
+ROUND_END_SECONDS = 3  # Pause between the end of a round and the next one
 MIN_PLAYERS = 2
+ROOM_SIZE = 8  # Players per room, more players are matched into further rooms
+STROKE_FLUSH_MS = 25  # How often the drawer sends the points collected for the current stroke
+RENDER_FRAME_MS = 16  # How often the client applies received messages to the UI
+FLATTEN_ITEM_LIMIT = 200  # Line items on a client canvas before older strokes are flattened into an image
+MAX_ITEM_POINTS = 1024  # Points in one canvas line item before a stroke continues in a new item
+ROUND_MEMORY_BUDGET = 1024 * 1024  # Bytes of stroke coordinates the server keeps per round
+MAX_ERASE_STROKES = 256  # Strokes one ERASE message may remove
+MAX_DRAW_POINTS = 4096  # Points in one DRAW message, the drawer sends longer strokes in several
+SIMPLIFY_TOLERANCE = 1.0  # Pixels a finished stroke may deviate after simplification
+
+# Client connection settings
+RECONNECT_DELAY = 0.5  # Seconds before the first reconnect attempt, doubled after every failure
+RECONNECT_MAX_DELAY = 10  # Longest wait between reconnect attempts
+RESUME_GRACE_SECONDS = 30  # Time a disconnected player keeps their seat and score, 0 to remove them at once
+RESUME_BUFFER_SIZE = 1024  # Recent broadcasts kept for players who resume after losing their connection
+
+# Server engine settings
+SERVER_ENGINE = "select"  # "select" or "asyncio"
+OUTBOUND_QUEUE_SIZE = 256  # Messages queued per client before it is dropped
+TRANSPORT_HIGH_WATER = 64 * 1024  # Transport buffer size before messages wait in the queue
+
+# Multi-process settings
+WORKERS = 1  # Worker processes behind a supervisor, 1 to serve from a single process, 0 for one per CPU core
+WORKER_LOAD_MS = 500  # Interval at which workers report their number of clients to the supervisor
+WORKER_RESTART_SECONDS = 1  # Wait before starting a crashed worker again
+
+# Slow client handling for the select engine
+CLIENT_LAG_THRESHOLD = 256 * 1024  # Unsent bytes before a client counts as lagging
+CLIENT_LAG_LIMIT = 4 * 1024 * 1024  # Unsent bytes before a lagging client is dropped
+SLOW_CLIENT_POLICY = "downgrade"  # "downgrade" pauses drawing updates, "disconnect" drops the client
+
+# Spectator relay settings
+RELAY_STROKE_MS = 100  # Draw data a relay collects before sending it as merged polylines, 0 to pass it on at once
+RELAY_STATE_MS = 500  # Shortest time between two game states a relay sends, 0 to send every one
+
+# Monitoring settings
+METRICS_HOST = "localhost"  # The metrics endpoint is only served locally
+METRICS_PORT = None  # Port of the Prometheus metrics endpoint, None to disable it
+LOG_LEVEL = "WARNING"  # Least severe server log messages to show
+TRACE_BUFFER_SIZE = 65536  # Spans kept by the tracer, the oldest are overwritten
+TRACE_DIR = "traces"  # Directory trace dumps are written to
+
+# Receive settings
+RECV_BUFFER_SIZE = 64 * 1024  # Initial size of each connection's receive buffer
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Largest frame accepted before the connection is dropped
+
+# Wire formats, in order of preference
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+WIRE_FORMATS = [FORMAT_BINARY, FORMAT_JSON]
+
+# Frame compression, in order of preference, an empty list turns it off
+COMPRESSION_DEFLATE = "deflate"
+COMPRESSION_METHODS = [COMPRESSION_DEFLATE]
+COMPRESSION_LEVEL = 6
+COMPRESSION_WINDOW_BITS = 12  # 4 KiB window, covers the preset dictionary and typical frames
+COMPRESSION_MEM_LEVEL = 4  # Small compressor state, most of the cost of compressing a short frame is setting it up
+COMPRESS_MIN_SIZE = 48  # Smaller frames are sent uncompressed, the savings would not pay for the CPU
 
 # Message types
 MSG_JOIN = "JOIN"
 MSG_DRAW = "DRAW"
 MSG_CLEAR = "CLEAR"
+MSG_UNDO = "UNDO"
+MSG_ERASE = "ERASE"
 MSG_GUESS = "GUESS"
 MSG_STATE = "STATE"
 MSG_COUNTDOWN = "COUNTDOWN"
 MSG_RESULT = "RESULT"
+MSG_SNAPSHOT = "SNAPSHOT"
+MSG_SYNC = "SYNC"
+MSG_HINT = "HINT"
+MSG_REPLAY = "REPLAY"
+MSG_ROSTER = "ROSTER"
+
+# Rate limits as (messages per second, burst) per message type
+CLIENT_RATE_LIMITS = {  # Per connection
+    MSG_DRAW: (60, 30),  # Draw data over the limit is merged into later updates instead of being dropped
+    MSG_GUESS: (3, 5),
+    MSG_CLEAR: (2, 5),
+    MSG_UNDO: (10, 20),
+    MSG_ERASE: (10, 20),
+    MSG_JOIN: (1, 3),
+    MSG_SYNC: (2, 5),
+    MSG_REPLAY: (1, 3),
+}
+ROOM_RATE_LIMITS = {  # Shared by everyone in the game
+    MSG_DRAW: (120, 60),
+    MSG_GUESS: (30, 60),
+}
+GUESS_DIGEST_MS = 250  # Wrong guesses collected before they are echoed in one message, 0 to echo each at once
+
+# Roles
+ROLE_PLAYER = "player"
+ROLE_SPECTATOR = "spectator"  # Watches without drawing, guessing or counting as a player
 
 # Game states
 STATE_WAITING = "waiting"
@@ -24,15 +126,399 @@ STATE_COUNTDOWN = "countdown"
 STATE_PLAYING = "playing"
 STATE_ROUND_END = "round_end"
 
-# Words to guess (simplified list)
+# Round recording and replay
+RECORDING_DIR = None  # Directory to record every round to, None to disable recording
+RECORDING_FLUSH_BYTES = 64 * 1024  # Buffered recording data handed to the writer thread at once
+RECORDING_FLUSH_SECONDS = 1.0  # Longest time recorded data waits in the buffer
+RECORDING_INDEX_MS = 1000  # Round time between entries of a recording's sparse index
+THUMBNAIL_SCALE = 4  # Canvas pixels per pixel of the PNG thumbnail saved with every recorded round
+REPLAY_SPEED = 2.0  # Speed at which the client asks to replay the last round
+REPLAY_MAX_SPEED = 16.0  # Fastest replay the server allows
+REPLAY_LIST_LIMIT = 20  # Most recent recordings listed for a client
+
+# Words to guess, used when no word list files are found
 WORDS = ["apple", "house", "car", "dog", "cat", "book", "tree", "sun", "moon", "computer"]
+WORD_LIST_DIR = None  # Directory of "<category>.txt" word lists, None for the bundled lists
+WORD_CATEGORIES = None  # Categories to play with, None for all of them
+CLOSE_GUESS_DISTANCE = 1  # Edits a wrong guess may be away from the word to count as close
+
+# Binary frames start with a byte that can never start a UTF-8 JSON line,
+# so both formats can share a stream: magic, frame kind, payload length
+FRAME_MAGIC = 0xB1
+FRAME_HEADER = struct.Struct("!BBI")
+FRAME_JSON = 0  # Any message as compact JSON
+FRAME_SEGMENT = 1  # Draw segment as four uint16 coordinates
+FRAME_POLYLINE = 2  # Draw polyline as a uint16 start point and delta-encoded steps
+FRAME_SNAPSHOT = 3  # Canvas snapshot as a uint32 version and the compressed drawing
+FRAME_POINTS = 4  # Stroke as a uint32 stroke id and raw uint16 coordinates, used inside snapshots
+FRAME_DEFLATE = 5  # Another frame or JSON line, deflated with the preset dictionary
+FRAME_SEQUENCED = 6  # Another frame, prefixed with its uint32 broadcast sequence number; JSON lines carry a seq field instead
+FRAME_RASTER = 7  # Canvas raster as uint16 width and height and a palette index per pixel, used inside snapshots
+
+SEGMENT = struct.Struct("!4H")
+SNAPSHOT_VERSION = struct.Struct("!I")
+SEQUENCE = struct.Struct("!I")
+RASTER_HEADER = struct.Struct("!HH")  # width, height
+POLYLINE_HEADER = struct.Struct("!BHHH")  # flags, start x, start y, number of steps
+MAX_POLYLINE_STEPS = 0xFFFF  # Longer polylines travel as JSON frames
+POLYLINE_WIDE = 0x01  # Steps are int16 instead of int8, adding up modulo 2**16
+POLYLINE_END = 0x02  # Last polyline of a stroke
+POLYLINE_TRACED = 0x04  # A uint32 trace id follows the header
+TRACE_ID = struct.Struct("!I")
+POLYLINE_STROKE = 0x08  # A uint32 stroke id follows the header and trace id
+STROKE_ID = struct.Struct("!I")
+SEGMENT_KEYS = {"x1", "y1", "x2", "y2"}
+
+# Preset dictionary for compressed frames: snippets of typical messages, the most frequent last.
+# Both sides need the same bytes, so give the compression method a new name whenever this changes.
+COMPRESSION_DICTIONARY = b"".join([
+    b'{"type":"RESULT","data":{"error":"Time is up","word":"',
+    b'{"type":"RESULT","data":{"error":"Drawer disconnected","winner":"Player_","word":"',
+    b'{"type":"COUNTDOWN","data":{"seconds":',
+    b'{"type":"HINT","data":{"guess":"","hint":"close"}}\n',
+    b'{"type":"SNAPSHOT","data":{"version":',
+    b'{"type":"CLEAR","data":{}}\n',
+    b'{"type":"JOIN","data":{"formats":["binary","json"],"compression":["deflate"]}}\n',
+    b'{"type":"GUESS","data":{"player":"Player_","guess":"',
+    b'{"type":"STATE","data":{"state":"waiting","state":"countdown","state":"round_end",',
+    b'"state":"playing","category":"","players":[',
+    b'{"name":"Player_","score":0,"is_drawer":true},',
+    b'{"name":"Player_","score":10,"is_drawer":false},',
+    b'{"name":"Player_","score":0,"is_drawer":false}],"is_drawer":false}}\n',
+    b'{"type":"DRAW","data":{"x1":,"y1":,"x2":,"y2":}}\n',
+    b'{"type":"DRAW","data":{"points":[],"end":true}}\n',
+])
+
+def json_dumps(obj):
+    """Serialize to compact UTF-8 JSON, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode('utf-8')
 
-def encode_message(msg_type, data):
-    """Encode a message to be sent over the network"""
-    message = {"type": msg_type, "data": data}
-    # Add a newline as a message delimiter
-    return (json.dumps(message) + "\n").encode('utf-8')
+def json_loads(data):
+    """Parse UTF-8 JSON from bytes or a memoryview, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+def encode_message(msg_type, data, wire_format=FORMAT_JSON, compression=None, sequence=None):
+    """Encode a message to be sent over the network, numbered if a broadcast sequence number is given"""
+    if wire_format == FORMAT_BINARY:
+        message = encode_binary_message(msg_type, data)
+    else:
+        if msg_type == MSG_SNAPSHOT:
+            # JSON cannot carry the compressed drawing as raw bytes
+            data = dict(data, drawing=base64.b64encode(data["drawing"]).decode('ascii'))
+        
+        # A JSON line carries its sequence number as a field, so it stays plain line-delimited JSON
+        message = {"type": msg_type, "data": data}
+        if sequence is not None:
+            message["seq"] = sequence
+        
+        # Add a newline as a message delimiter
+        message = json_dumps(message) + b"\n"
+    
+    # Snapshots are compressed already
+    if compression == COMPRESSION_DEFLATE and len(message) >= COMPRESS_MIN_SIZE and msg_type != MSG_SNAPSHOT:
+        message = compress_frame(message)
+    if sequence is not None and wire_format == FORMAT_BINARY:
+        header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_SEQUENCED, SEQUENCE.size + len(message))
+        message = header + SEQUENCE.pack(sequence) + message
+    return message
 
 def decode_message(data):
     """Decode a message received from the network"""
-    return json.loads(data.decode('utf-8'))
\ No newline at end of file
+    if data[0] == FRAME_MAGIC:
+        return decode_binary_message(data)
+    
+    message = json_loads(data)
+    if message["type"] == MSG_SNAPSHOT:
+        message["data"]["drawing"] = base64.b64decode(message["data"]["drawing"])
+    return message
+
+def clamp_coordinate(value):
+    """Clamp a canvas coordinate into the uint16 range"""
+    return min(max(int(value), 0), 0xFFFF)
+
+def encode_binary_message(msg_type, data):
+    """Encode a message as a length-prefixed binary frame"""
+    if msg_type == MSG_DRAW:
+        if data.keys() == SEGMENT_KEYS:
+            payload = SEGMENT.pack(*(clamp_coordinate(data[key]) for key in ("x1", "y1", "x2", "y2")))
+            return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_SEGMENT, len(payload)) + payload
+        points = data.get("points")
+        extra = data.keys() - {"points"}
+        if points is None and data.keys() >= SEGMENT_KEYS:
+            # A segment with a stroke or trace id goes as a two-point polyline, which has room for them
+            points = [data["x1"], data["y1"], data["x2"], data["y2"]]
+            extra = data.keys() - SEGMENT_KEYS
+        if (points is not None and 2 <= len(points) <= (MAX_POLYLINE_STEPS + 1) * 2
+                and extra <= {"end", "trace", "stroke"}):
+            payload = encode_polyline(points, data.get("end", False), data.get("trace"), data.get("stroke"))
+            return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_POLYLINE, len(payload)) + payload
+    
+    if msg_type == MSG_SNAPSHOT:
+        payload = SNAPSHOT_VERSION.pack(data["version"]) + data["drawing"]
+        return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_SNAPSHOT, len(payload)) + payload
+    
+    payload = json_dumps({"type": msg_type, "data": data})
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_JSON, len(payload)) + payload
+
+def decode_binary_message(frame):
+    """Decode a complete binary frame, header included"""
+    _, kind, length = FRAME_HEADER.unpack_from(frame)
+    payload = memoryview(frame)[FRAME_HEADER.size:FRAME_HEADER.size + length]
+    
+    if kind == FRAME_SEGMENT:
+        x1, y1, x2, y2 = SEGMENT.unpack(payload)
+        return {"type": MSG_DRAW, "data": {"x1": x1, "y1": y1, "x2": x2, "y2": y2}}
+    if kind == FRAME_POLYLINE:
+        points, end, trace, stroke = decode_polyline(payload)
+        data = {"points": points}
+        if end:
+            data["end"] = True
+        if trace is not None:
+            data["trace"] = trace
+        if stroke is not None:
+            data["stroke"] = stroke
+        return {"type": MSG_DRAW, "data": data}
+    if kind == FRAME_POINTS:
+        stroke, = STROKE_ID.unpack_from(payload)
+        coords = array('H')
+        coords.frombytes(payload[STROKE_ID.size:])
+        if sys.byteorder == "little":
+            coords.byteswap()
+        return {"type": MSG_DRAW, "data": {"points": coords.tolist(), "end": True, "stroke": stroke}}
+    if kind == FRAME_SNAPSHOT:
+        version, = SNAPSHOT_VERSION.unpack_from(payload)
+        return {"type": MSG_SNAPSHOT, "data": {"version": version, "drawing": bytes(payload[SNAPSHOT_VERSION.size:])}}
+    if kind == FRAME_JSON:
+        return json_loads(payload)
+    if kind == FRAME_DEFLATE:
+        message = decompress_frame(payload)
+        if message[:1] == bytes([FRAME_MAGIC]) and message[1] in (FRAME_DEFLATE, FRAME_SEQUENCED):
+            raise ValueError("Nested compressed frame")
+        return decode_message(message)
+    if kind == FRAME_SEQUENCED:
+        sequence, = SEQUENCE.unpack_from(payload)
+        inner = payload[SEQUENCE.size:]
+        if inner[:1] == bytes([FRAME_MAGIC]) and inner[1] == FRAME_SEQUENCED:
+            raise ValueError("Nested sequenced frame")
+        message = decode_message(inner)
+        message["seq"] = sequence
+        return message
+    raise ValueError(f"Unknown frame kind {kind}")
+
+def compress_frame(message):
+    """Wrap an encoded message in a deflate frame, unless that does not make it smaller
+    
+    Every frame is compressed on its own, so a broadcast frame is compressed
+    once for all its recipients and nothing waits for later data.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -COMPRESSION_WINDOW_BITS,
+                                  COMPRESSION_MEM_LEVEL, zdict=COMPRESSION_DICTIONARY)
+    payload = compressor.compress(message) + compressor.flush()
+    if len(payload) + FRAME_HEADER.size >= len(message):
+        return message
+    return FRAME_HEADER.pack(FRAME_MAGIC, FRAME_DEFLATE, len(payload)) + payload
+
+def decompress_frame(payload):
+    """Inflate the payload of a deflate frame"""
+    # The largest window inflates frames compressed with any window size
+    decompressor = zlib.decompressobj(-15, zdict=COMPRESSION_DICTIONARY)
+    message = decompressor.decompress(payload, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Compressed frame is truncated or too large")
+    return message
+
+def encode_polyline(points, end=False, trace=None, stroke=None):
+    """Pack a flat [x0, y0, x1, y1, ...] list as a start point and coordinate deltas"""
+    coords = [clamp_coordinate(value) for value in points[:len(points) & ~1]]
+    deltas = [b - a for a, b in zip(coords, coords[2:])]
+    if len(deltas) // 2 > MAX_POLYLINE_STEPS:
+        raise ValueError("Polyline has more steps than one frame can hold")
+    
+    flags = POLYLINE_END if end else 0
+    if trace is not None:
+        flags |= POLYLINE_TRACED
+    if stroke is not None:
+        flags |= POLYLINE_STROKE
+    if all(-128 <= delta <= 127 for delta in deltas):
+        steps = array('b', deltas)
+    else:
+        flags |= POLYLINE_WIDE
+        # Coordinates wrap around at 16 bits, so every step fits an int16
+        steps = array('h', [(delta + 0x8000) % 0x10000 - 0x8000 for delta in deltas])
+        if sys.byteorder == "little":
+            steps.byteswap()
+    
+    header = POLYLINE_HEADER.pack(flags, coords[0], coords[1], len(deltas) // 2)
+    if trace is not None:
+        header += TRACE_ID.pack(trace)
+    if stroke is not None:
+        header += STROKE_ID.pack(stroke)
+    return header + steps.tobytes()
+
+def decode_polyline(payload):
+    """Unpack a delta-encoded polyline into a flat coordinate list, its end flag, its trace id and its stroke id"""
+    flags, x, y, count = POLYLINE_HEADER.unpack_from(payload)
+    offset = POLYLINE_HEADER.size
+    trace = None
+    if flags & POLYLINE_TRACED:
+        trace, = TRACE_ID.unpack_from(payload, offset)
+        offset += TRACE_ID.size
+    stroke = None
+    if flags & POLYLINE_STROKE:
+        stroke, = STROKE_ID.unpack_from(payload, offset)
+        offset += STROKE_ID.size
+    steps = array('h' if flags & POLYLINE_WIDE else 'b')
+    steps.frombytes(payload[offset:offset + count * 2 * steps.itemsize])
+    if flags & POLYLINE_WIDE and sys.byteorder == "little":
+        steps.byteswap()
+    
+    points = [x, y]
+    for i in range(0, len(steps), 2):
+        x = (x + steps[i]) & 0xFFFF
+        y = (y + steps[i + 1]) & 0xFFFF
+        points += (x, y)
+    return points, bool(flags & POLYLINE_END), trace, stroke
+
+def is_valid_stroke_id(stroke):
+    """Check that a stroke id fits in a uint32"""
+    return isinstance(stroke, int) and not isinstance(stroke, bool) and 0 <= stroke <= 0xFFFFFFFF
+
+def is_valid_room_id(room_id):
+    """Check that a room id is a positive number"""
+    return isinstance(room_id, int) and not isinstance(room_id, bool) and room_id > 0
+
+def is_valid_draw(data):
+    """Check that draw data is a segment or a polyline of whole points"""
+    trace = data.get("trace")
+    if trace is not None and not (isinstance(trace, int) and 0 <= trace <= 0xFFFFFFFF):
+        return False
+    if "stroke" in data and not is_valid_stroke_id(data["stroke"]):
+        return False
+    if "points" in data:
+        points = data["points"]
+        return isinstance(points, list) and 2 <= len(points) <= MAX_DRAW_POINTS * 2 and len(points) % 2 == 0
+    return data.keys() >= SEGMENT_KEYS
+
+class FrameDecoder:
+    """Incremental decoder for a stream of JSON lines and binary frames
+    
+    Data is received straight into a reusable bytearray and complete frames are
+    handed out as memoryviews into it, so they have to be decoded before the
+    next read.
+    """
+    
+    def __init__(self, size=RECV_BUFFER_SIZE):
+        self.buffer = bytearray(size)
+        self.start = 0  # First byte not yet handed out as part of a frame
+        self.end = 0  # End of the received data
+    
+    def recv_from(self, sock):
+        """Receive from a socket into the buffer, returns the byte count (0 once closed)"""
+        self.make_room()
+        count = sock.recv_into(memoryview(self.buffer)[self.end:])
+        self.end += count
+        return count
+    
+    def feed(self, data):
+        """Append data that was received some other way"""
+        self.make_room(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+    
+    def drain(self):
+        """Remove and return the received data not handed out as frames yet"""
+        data = bytes(self.buffer[self.start:self.end])
+        self.start = self.end
+        return data
+    
+    def make_room(self, needed=1):
+        """Move the unfinished frame to the front and grow the buffer if it still does not fit"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= needed:
+            return
+        
+        pending = self.end - self.start
+        size = len(self.buffer)
+        while size - pending < needed:
+            size *= 2
+        
+        if size > len(self.buffer):
+            if size > MAX_FRAME_SIZE + FRAME_HEADER.size:
+                raise ValueError("Frame exceeds the maximum frame size")
+            # Frames handed out earlier may still reference the old buffer, so never resize it in place
+            buffer = bytearray(size)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+        elif self.start:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start, self.end = 0, pending
+    
+    def frames(self):
+        """Yield every complete frame received so far"""
+        buffer = self.buffer
+        view = memoryview(buffer)
+        while self.start < self.end:
+            position = self.start
+            if buffer[position] == FRAME_MAGIC:
+                if self.end - position < FRAME_HEADER.size:
+                    break
+                _, _, length = FRAME_HEADER.unpack_from(buffer, position)
+                frame_end = position + FRAME_HEADER.size + length
+                if frame_end > self.end:
+                    # Make sure the rest of a large frame fits on the next read
+                    self.make_room(frame_end - self.end)
+                    break
+                self.start = frame_end
+                yield view[position:frame_end]
+            else:
+                newline = buffer.find(b"\n", position, self.end)
+                if newline == -1:
+                    if self.end - self.start > MAX_FRAME_SIZE:
+                        raise ValueError("Line exceeds the maximum frame size")
+                    break
+                self.start = newline + 1
+                if buffer[position] == ord("{") or buffer[position:newline].strip():
+                    yield view[position:newline]
+
+def encode_raster(width, height, pixels):
+    """Encode a raster of the canvas as a frame for snapshots"""
+    if len(pixels) != width * height:
+        raise ValueError("Raster size does not match its pixels")
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_RASTER, RASTER_HEADER.size + len(pixels))
+    return header + RASTER_HEADER.pack(width, height) + pixels
+
+def unpack_drawing(drawing):
+    """Expand a compressed snapshot into its raster as (width, height, pixels), None if it has none, and the draw data on top"""
+    decoder = FrameDecoder()
+    decoder.feed(zlib.decompress(drawing))
+    raster = None
+    draws = []
+    for frame in decoder.frames():
+        if frame[1] == FRAME_RASTER:
+            width, height = RASTER_HEADER.unpack_from(frame, FRAME_HEADER.size)
+            pixels = bytes(frame[FRAME_HEADER.size + RASTER_HEADER.size:])
+            if len(pixels) != width * height:
+                raise ValueError("Raster size does not match its pixels")
+            raster = (width, height, pixels)
+        else:
+            draws.append(decode_binary_message(frame)["data"])
+    return raster, draws
+
+def choose_wire_format(offered):
+    """Pick the preferred wire format that the other side also supports"""
+    for wire_format in WIRE_FORMATS:
+        if wire_format in offered:
+            return wire_format
+    return FORMAT_JSON
+
+def choose_compression(offered):
+    """Pick the preferred compression method that the other side also supports, None for none"""
+    for method in COMPRESSION_METHODS:
+        if method in offered:
+            return method
+    return None
\ No newline at end of file
@@ -0,0 +1,156 @@
+import struct
+import zlib
+from shared.common import *
+
+# Optional vectorized rasterization
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Maps stored pixels (0 = background, 1 = ink) to 8-bit grey levels
+GREY_LEVELS = bytes([255, 0]) + bytes(254)
+
+class Bitmap:
+    """Black and white raster of the canvas, one byte per pixel
+
+    Pixels are palette indexes, 0 for the background and 1 for ink. Batches of
+    strokes are rasterized with NumPy when it is installed.
+    """
+
+    def __init__(self, width=CANVAS_SIZE, height=CANVAS_SIZE):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(width * height)
+
+    def clear(self):
+        """Reset every pixel to the background"""
+        self.pixels = bytearray(self.width * self.height)
+
+    def paste(self, width, height, pixels):
+        """Copy a raster into the top left corner, clipped to the bitmap"""
+        columns = min(width, self.width)
+        for row in range(min(height, self.height)):
+            start = row * self.width
+            self.pixels[start:start + columns] = pixels[row * width:row * width + columns]
+
+    def pack(self):
+        """The bitmap as a raster frame for snapshots"""
+        return encode_raster(self.width, self.height, self.pixels)
+
+    def draw_polylines(self, polylines, line_width=1):
+        """Draw a batch of flat [x0, y0, x1, y1, ...] polylines"""
+        if numpy is None:
+            for points in polylines:
+                self.draw_polyline(points, line_width)
+            return
+
+        # Every segment becomes max(|dx|, |dy|) + 1 evenly spaced points, all computed at once
+        starts, ends = [], []
+        for points in polylines:
+            if len(points) < 2:
+                continue
+            coords = numpy.asarray(points[:len(points) // 2 * 2], dtype=numpy.int32).reshape(-1, 2)
+            if len(coords) == 1:
+                starts.append(coords)
+                ends.append(coords)
+            else:
+                starts.append(coords[:-1])
+                ends.append(coords[1:])
+        if not starts:
+            return
+        start = numpy.concatenate(starts)
+        delta = numpy.concatenate(ends) - start
+        steps = numpy.abs(delta).max(axis=1)
+        counts = steps + 1
+        segment = numpy.repeat(numpy.arange(len(start)), counts)
+        first = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        fraction = (numpy.arange(len(segment)) - first) / numpy.maximum(steps, 1)[segment]
+        xs = start[segment, 0] + numpy.rint(delta[segment, 0] * fraction).astype(numpy.int32)
+        ys = start[segment, 1] + numpy.rint(delta[segment, 1] * fraction).astype(numpy.int32)
+
+        # Stamp the same square brush as stamp(), one shifted copy of the points per brush pixel
+        grid = numpy.frombuffer(self.pixels, dtype=numpy.uint8).reshape(self.height, self.width)
+        for offset_y in range(-(line_width // 2), line_width - line_width // 2):
+            for offset_x in range(-(line_width // 2), line_width - line_width // 2):
+                x, y = xs + offset_x, ys + offset_y
+                inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+                grid[y[inside], x[inside]] = 1
+
+    def scaled(self, factor):
+        """A bitmap smaller by an integer factor, a pixel is ink if any pixel it covers is"""
+        width = -(-self.width // factor)
+        height = -(-self.height // factor)
+        small = Bitmap(width, height)
+        if numpy is not None:
+            grid = numpy.zeros((height * factor, width * factor), dtype=numpy.uint8)
+            pixels = numpy.frombuffer(self.pixels, dtype=numpy.uint8)
+            grid[:self.height, :self.width] = pixels.reshape(self.height, self.width)
+            blocks = grid.reshape(height, factor, width, factor).max(axis=(1, 3))
+            small.pixels = bytearray(blocks.tobytes())
+            return small
+        for y in range(self.height):
+            row = self.pixels[y * self.width:(y + 1) * self.width]
+            x = row.find(1)
+            while x != -1:
+                small.pixels[y // factor * width + x // factor] = 1
+                x = row.find(1, x + 1)
+        return small
+
+    def draw(self, draw_data, line_width=1):
+        """Draw a segment or polyline given as draw data"""
+        if "points" in draw_data:
+            self.draw_polyline(draw_data["points"], line_width)
+        else:
+            self.draw_line(draw_data["x1"], draw_data["y1"], draw_data["x2"], draw_data["y2"], line_width)
+
+    def draw_polyline(self, points, line_width=1):
+        """Draw a flat [x0, y0, x1, y1, ...] polyline"""
+        if len(points) == 2:
+            self.stamp(points[0], points[1], line_width)
+        for i in range(0, len(points) - 2, 2):
+            self.draw_line(points[i], points[i + 1], points[i + 2], points[i + 3], line_width)
+
+    def draw_line(self, x1, y1, x2, y2, line_width=1):
+        """Draw a line with Bresenham's algorithm, stamping a square brush"""
+        dx, dy = abs(x2 - x1), -abs(y2 - y1)
+        step_x = 1 if x1 < x2 else -1
+        step_y = 1 if y1 < y2 else -1
+        error = dx + dy
+        while True:
+            self.stamp(x1, y1, line_width)
+            if x1 == x2 and y1 == y2:
+                return
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x1 += step_x
+            if doubled <= dx:
+                error += dx
+                y1 += step_y
+
+    def stamp(self, x, y, size):
+        """Set a size x size block of pixels centred on a point, clipped to the bitmap"""
+        left = max(x - size // 2, 0)
+        right = min(x - size // 2 + size, self.width)
+        if left >= right:
+            return
+        ink = b"\x01" * (right - left)
+        for row in range(max(y - size // 2, 0), min(y - size // 2 + size, self.height)):
+            start = row * self.width
+            self.pixels[start + left:start + right] = ink
+
+    def to_png(self):
+        """Encode the bitmap as a greyscale PNG"""
+        grey = self.pixels.translate(GREY_LEVELS)
+        width = self.width
+        rows = b"".join(b"\x00" + grey[i:i + width] for i in range(0, len(grey), width))
+        header = struct.pack("!IIBBBBB", width, self.height, 8, 0, 0, 0, 0)
+        return (PNG_SIGNATURE + png_chunk(b"IHDR", header) +
+                png_chunk(b"IDAT", zlib.compress(rows)) + png_chunk(b"IEND", b""))
+
+def png_chunk(tag, data):
+    """Frame one PNG chunk with its length and checksum"""
+    return struct.pack("!I", len(data)) + tag + data + struct.pack("!I", zlib.crc32(tag + data) & 0xFFFFFFFF)
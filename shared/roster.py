@@ -0,0 +1,67 @@
+# Operations of a ROSTER update
+ROSTER_ADD = "add"
+ROSTER_REMOVE = "remove"
+ROSTER_UPDATE = "update"
+
+def roster_changes(old, new):
+    """Changes that turn one {id: player} roster into another, removals first"""
+    changes = [{"op": ROSTER_REMOVE, "id": player_id} for player_id in old.keys() - new.keys()]
+    for player_id, player in new.items():
+        previous = old.get(player_id)
+        if previous is None:
+            changes.append(dict(player, op=ROSTER_ADD))
+        elif previous != player:
+            change = {key: value for key, value in player.items() if previous.get(key) != value}
+            changes.append(dict(change, op=ROSTER_UPDATE, id=player_id))
+    return changes
+
+class Roster:
+    """The players of a game by id, kept up to date from full lists and ROSTER updates
+
+    Every ROSTER update carries the next version number; a client that sees
+    a gap asks for the full list again.
+    """
+
+    def __init__(self):
+        self.players = {}  # Player id -> player, in the order they joined
+        self.version = None
+
+    def __iter__(self):
+        return iter(self.players.values())
+
+    def __len__(self):
+        return len(self.players)
+
+    def reset(self, players, version):
+        """Replace the roster with a full list of players"""
+        self.players = {player["id"]: dict(player) for player in players}
+        self.version = version
+
+    def index(self, player_id):
+        """Position of a player in the list"""
+        return list(self.players).index(player_id)
+
+    def apply(self, update):
+        """Apply a ROSTER update, returns the changes as (op, position, player), None if updates were missed"""
+        if self.version is None or update["version"] > self.version + 1:
+            return None
+        if update["version"] <= self.version:
+            return []  # Already applied
+        self.version = update["version"]
+
+        applied = []
+        for change in update["changes"]:
+            player_id = change["id"]
+            fields = {key: value for key, value in change.items() if key != "op"}
+            if change["op"] == ROSTER_REMOVE:
+                if player_id in self.players:
+                    position = self.index(player_id)
+                    applied.append((ROSTER_REMOVE, position, self.players.pop(player_id)))
+            elif player_id in self.players:
+                player = self.players[player_id]
+                player.update(fields)
+                applied.append((ROSTER_UPDATE, self.index(player_id), player))
+            else:
+                self.players[player_id] = fields
+                applied.append((ROSTER_ADD, len(self.players) - 1, fields))
+        return applied
@@ -0,0 +1,137 @@
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from shared.common import *
+
+class Tracer:
+    """Records timed spans of message handling into a fixed-size ring buffer
+
+    Tracing is off until enable() is called, call sites check tracer.enabled
+    before taking any timestamps so a disabled tracer costs a single attribute
+    lookup. Spans are kept as plain tuples and only turned into Chrome trace
+    events when dumped. Timestamps are wall-clock microseconds, so the dumps
+    of a server and its clients line up once merged.
+    """
+
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self.enabled = False
+        self.size = size
+        self.spans = [None] * size  # (name, start, end, thread id, trace id)
+        self.count = 0  # Spans recorded so far, the next one goes to count % size
+        self.process_name = None
+        self.next_id = random.getrandbits(32)  # Random start, ids of different processes rarely collide
+
+    def enable(self, process_name):
+        """Start recording spans"""
+        self.process_name = process_name
+        self.enabled = True
+
+    @staticmethod
+    def now():
+        """Current time in microseconds"""
+        return time.time_ns() // 1000
+
+    def new_id(self):
+        """A trace id for a message that has none yet"""
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        return self.next_id
+
+    def span(self, name, start, trace_id=None):
+        """Record a span from start until now"""
+        self.spans[self.count % self.size] = (name, start, time.time_ns() // 1000, threading.get_ident(), trace_id)
+        self.count += 1
+
+    def recorded(self):
+        """The spans still in the ring, oldest first"""
+        if self.count <= self.size:
+            return self.spans[:self.count]
+        split = self.count % self.size
+        return self.spans[split:] + self.spans[:split]
+
+    def chrome_trace(self, spans=None):
+        """The recorded spans as a Chrome trace, loadable in Perfetto or chrome://tracing"""
+        pid = os.getpid()
+        events = [{"ph": "M", "name": "process_name", "pid": pid, "tid": 0,
+                   "args": {"name": self.process_name or "pictionary"}}]
+        for name, start, end, tid, trace_id in self.recorded() if spans is None else spans:
+            event = {"ph": "X", "name": name, "cat": "pictionary", "ts": start, "dur": end - start,
+                     "pid": pid, "tid": tid}
+            if trace_id is not None:
+                event["args"] = {"trace": trace_id}
+            events.append(event)
+        return {"traceEvents": add_flows(events), "displayTimeUnit": "ms"}
+
+    def dump(self, path=None, spans=None):
+        """Write the recorded spans as a Chrome trace file, returns its path"""
+        if path is None:
+            name = f"{self.process_name or 'pictionary'}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+            path = os.path.join(TRACE_DIR, name)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as trace_file:
+            json.dump(self.chrome_trace(spans), trace_file)
+        return path
+
+    def dump_in_background(self, on_done=None):
+        """Copy the ring and write it on another thread, so the caller never waits for the disk"""
+        spans = self.recorded()
+
+        def write():
+            try:
+                path = self.dump(spans=spans)
+            except OSError as e:
+                print(f"Error writing trace: {e}", file=sys.stderr)
+                return
+            if on_done is not None:
+                on_done(path)
+
+        threading.Thread(target=write, name="trace-dump", daemon=True).start()
+
+    def install_signal_handler(self, on_done=None):
+        """Dump the trace whenever the process receives SIGUSR1, where the platform has it"""
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_in_background(on_done))
+
+def add_flows(events):
+    """Link the spans of each trace id with flow arrows, in time order"""
+    by_trace = {}
+    for event in events:
+        if event["ph"] == "X" and "args" in event:
+            by_trace.setdefault(event["args"]["trace"], []).append(event)
+
+    flows = []
+    for trace_id, spans in by_trace.items():
+        if len(spans) < 2:
+            continue
+        spans.sort(key=lambda event: event["ts"])
+        for i, span in enumerate(spans):
+            phase = "s" if i == 0 else "f" if i == len(spans) - 1 else "t"
+            flow = {"ph": phase, "name": "message", "cat": "flow", "id": trace_id,
+                    "ts": span["ts"], "pid": span["pid"], "tid": span["tid"]}
+            if phase == "f":
+                flow["bp"] = "e"
+            flows.append(flow)
+    return events + flows
+
+def merge(paths):
+    """Combine the trace dumps of several processes, linking their spans by trace id"""
+    events = []
+    for path in paths:
+        with open(path) as trace_file:
+            events += [event for event in json.load(trace_file)["traceEvents"] if event.get("cat") != "flow"]
+    return {"traceEvents": add_flows(events), "displayTimeUnit": "ms"}
+
+# The process-wide tracer
+tracer = Tracer()
+
+if __name__ == "__main__":
+    # Merge dumps of the server and its clients: python -m shared.trace out.json server.json client.json ...
+    if len(sys.argv) < 3:
+        sys.exit(f"Usage: {sys.argv[0]} OUTPUT TRACE...")
+    with open(sys.argv[1], "w") as output:
+        json.dump(merge(sys.argv[2:]), output)
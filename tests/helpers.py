@@ -0,0 +1,8 @@
+import time
+
+def wait_for_writer(writer):
+    """Wait until a recording writer thread has handled every queued command"""
+    deadline = time.monotonic() + 5
+    while not writer.commands.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
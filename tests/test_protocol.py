@@ -0,0 +1,116 @@
+import json
+import struct
+import unittest
+from shared.common import *
+
+class SequenceTest(unittest.TestCase):
+
+    def test_json_broadcast_is_a_plain_json_line(self):
+        message = encode_message(MSG_GUESS, {"player": "Player_1", "guess": "cat"}, FORMAT_JSON, sequence=42)
+        self.assertNotEqual(message[0], FRAME_MAGIC)
+        self.assertTrue(message.endswith(b"\n"))
+        self.assertEqual(json.loads(message), {"type": MSG_GUESS, "data": {"player": "Player_1", "guess": "cat"},
+                                               "seq": 42})
+        self.assertEqual(decode_message(message)["seq"], 42)
+
+    def test_compressed_json_broadcast_keeps_its_sequence(self):
+        data = {"players": [{"name": f"Player_{i}", "score": 0, "is_drawer": False} for i in range(20)]}
+        message = encode_message(MSG_STATE, data, FORMAT_JSON, COMPRESSION_DEFLATE, sequence=7)
+        decoded = decode_message(message)
+        self.assertEqual((decoded["seq"], decoded["data"]), (7, data))
+
+    def test_binary_broadcast_is_wrapped(self):
+        message = encode_message(MSG_CLEAR, {}, FORMAT_BINARY, sequence=3)
+        self.assertEqual((message[0], message[1]), (FRAME_MAGIC, FRAME_SEQUENCED))
+        self.assertEqual(decode_message(message), {"type": MSG_CLEAR, "data": {}, "seq": 3})
+
+    def test_unsequenced_json_has_no_seq(self):
+        self.assertNotIn("seq", json.loads(encode_message(MSG_CLEAR, {}, FORMAT_JSON)))
+
+class DrawEncodingTest(unittest.TestCase):
+
+    def test_plain_segment_is_a_segment_frame(self):
+        message = encode_message(MSG_DRAW, {"x1": 1, "y1": 2, "x2": 3, "y2": 4}, FORMAT_BINARY)
+        self.assertEqual(message[1], FRAME_SEGMENT)
+
+    def test_segment_with_ids_stays_binary(self):
+        message = encode_message(MSG_DRAW, {"x1": 1, "y1": 2, "x2": 3, "y2": 4, "stroke": 9, "trace": 5},
+                                 FORMAT_BINARY)
+        self.assertEqual(message[1], FRAME_POLYLINE)
+        self.assertEqual(decode_message(message)["data"], {"points": [1, 2, 3, 4], "stroke": 9, "trace": 5})
+
+    def test_polyline_keeps_its_stroke_id(self):
+        data = {"points": [1, 2, 300, 4], "end": True, "stroke": 0xFFFFFFFF}
+        message = encode_message(MSG_DRAW, data, FORMAT_BINARY)
+        self.assertEqual(message[1], FRAME_POLYLINE)
+        self.assertEqual(decode_message(message)["data"], data)
+
+class PolylineTest(unittest.TestCase):
+
+    def test_round_trip_with_narrow_and_wide_steps(self):
+        points = [0, 0, 100, 100, 90, 120, 0xFFFF, 0, 0, 0xFFFF]
+        payload = encode_polyline(points, end=True, trace=3, stroke=4)
+        self.assertEqual(decode_polyline(payload), (points, True, 3, 4))
+
+    def test_longest_polyline_is_a_binary_frame(self):
+        points = [i % 2 * 200 for i in range((MAX_POLYLINE_STEPS + 1) * 2)]
+        message = encode_message(MSG_DRAW, {"points": points}, FORMAT_BINARY)
+        self.assertEqual(message[1], FRAME_POLYLINE)
+        self.assertEqual(decode_message(message)["data"]["points"], points)
+
+    def test_longer_polyline_falls_back_to_json(self):
+        points = [i % 2 * 200 for i in range((MAX_POLYLINE_STEPS + 2) * 2)]
+        message = encode_message(MSG_DRAW, {"points": points, "stroke": 1}, FORMAT_BINARY)
+        self.assertEqual(message[1], FRAME_JSON)
+        self.assertEqual(decode_message(message)["data"], {"points": points, "stroke": 1})
+        with self.assertRaises(ValueError):
+            encode_polyline(points)
+
+    def test_coordinates_are_clamped(self):
+        points, _, _, _ = decode_polyline(encode_polyline([-5, 70000, 10, 10]))
+        self.assertEqual(points, [0, 0xFFFF, 10, 10])
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def messages(self, decoder):
+        return [decode_message(frame) for frame in decoder.frames()]
+
+    def test_fragmented_frames_are_put_back_together(self):
+        stream = (encode_message(MSG_DRAW, {"points": [1, 2, 3, 4], "stroke": 1}, FORMAT_BINARY)
+                  + encode_message(MSG_GUESS, {"guess": "cat"})
+                  + encode_message(MSG_CLEAR, {}, FORMAT_BINARY, COMPRESSION_DEFLATE, sequence=5))
+        decoder = FrameDecoder(size=4)
+        messages = []
+        for i in range(len(stream)):
+            decoder.feed(stream[i:i + 1])
+            messages += self.messages(decoder)
+        self.assertEqual(messages, [
+            {"type": MSG_DRAW, "data": {"points": [1, 2, 3, 4], "stroke": 1}},
+            {"type": MSG_GUESS, "data": {"guess": "cat"}},
+            {"type": MSG_CLEAR, "data": {}, "seq": 5},
+        ])
+
+    def test_frame_larger_than_the_limit_is_refused(self):
+        decoder = FrameDecoder()
+        decoder.feed(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_JSON, MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ValueError):
+            list(decoder.frames())
+
+    def test_bad_magic_is_read_as_a_json_line_and_rejected(self):
+        decoder = FrameDecoder()
+        decoder.feed(b"\x00\x02garbage\n")
+        frames = list(decoder.frames())
+        self.assertEqual(len(frames), 1)
+        with self.assertRaises(ValueError):
+            decode_message(frames[0])
+
+    def test_unknown_frame_kind_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_message(FRAME_HEADER.pack(FRAME_MAGIC, 0x7F, 0))
+
+    def test_short_payload_is_rejected(self):
+        with self.assertRaises(struct.error):
+            decode_message(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_SEGMENT, 2) + b"\x00\x01")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import tempfile
+import unittest
+from unittest import mock
+from server.recording import RoundRecorder, Playback, PLAYBACK_MIN_DELAY
+from tests.helpers import wait_for_writer
+from shared.common import *
+
+class RoundRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_list_does_not_scan_the_directory(self):
+        recorder = RoundRecorder(self.directory.name)
+        for word in ("cat", "dog"):
+            recorder.start_round(word, "animals", "Player_1")
+            recorder.record(MSG_CLEAR, {})
+        recorder.end_round()
+        wait_for_writer(recorder.writer)
+
+        with mock.patch("os.listdir", side_effect=AssertionError("listdir on a REPLAY")):
+            recordings = recorder.list()
+            self.assertEqual(len(recordings), 2)
+            recording = recorder.open(recordings[-1])
+        self.assertEqual(recording.info["word"], "dog")
+        recording.close()
+
+    def test_recordings_of_earlier_runs_are_found(self):
+        recorder = RoundRecorder(self.directory.name)
+        recorder.start_round("cat", "animals", "Player_1")
+        recorder.end_round()
+        wait_for_writer(recorder.writer)
+
+        restarted = RoundRecorder(self.directory.name, writer=recorder.writer)
+        self.assertEqual(restarted.list(), recorder.list())
+
+    def test_unknown_recordings_are_not_opened(self):
+        recorder = RoundRecorder(self.directory.name)
+        self.assertIsNone(recorder.open("nothing"))
+        self.assertIsNone(recorder.open(["not", "an", "id"]))
+
+    def test_playback_never_asks_for_a_zero_delay(self):
+        recorder = RoundRecorder(self.directory.name)
+        recorder.start_round("cat", "animals", "Player_1")
+        recorder.record(MSG_CLEAR, {})
+        recorder.end_round()
+        wait_for_writer(recorder.writer)
+
+        playback = Playback(recorder.open(recorder.list()[-1]), speed=float("nan"))
+        self.assertGreaterEqual(playback.time_until_next(), PLAYBACK_MIN_DELAY)
+        playback.stop()
+
+if __name__ == "__main__":
+    unittest.main()
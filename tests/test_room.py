@@ -0,0 +1,92 @@
+import tempfile
+import unittest
+from unittest import mock
+from server.recording import RoundRecorder
+from bench.local import LocalServer
+from tests.helpers import wait_for_writer
+from shared.common import *
+
+class RoomTest(unittest.TestCase):
+
+    def setUp(self):
+        self.local = LocalServer(3)
+        self.addCleanup(self.local.close)
+        self.room = self.local.room
+
+    def test_round_goes_on_when_the_drawer_of_three_leaves(self):
+        self.room.start_new_round()
+        self.assertEqual(self.room.game_state, STATE_PLAYING)
+
+        self.local.leave(self.room.drawer)
+        self.assertEqual(len(self.room.players()), 2)
+        self.assertEqual(self.room.game_state, STATE_COUNTDOWN)
+        self.assertIsNotNone(self.room.phase_timer)
+
+    def test_room_waits_when_too_few_players_are_left(self):
+        self.room.start_new_round()
+        self.local.leave(self.room.drawer)
+        self.local.leave(self.room.players()[0])
+        self.assertEqual(self.room.game_state, STATE_WAITING)
+        self.assertIsNone(self.room.phase_timer)
+
+    def test_resumed_player_restarts_a_waiting_room(self):
+        self.room.cancel_phase_timer()
+        self.room.game_state = STATE_WAITING  # As after a round that found too few players
+        client = self.room.players()[0]
+        self.room.catch_up(client, self.room.history.sequence)
+        self.assertEqual(self.room.game_state, STATE_COUNTDOWN)
+
+    def test_oversized_draw_changes_nothing(self):
+        self.room.start_new_round()
+        version, sequence = self.room.drawing_version, self.room.history.sequence
+        points = [i % 400 for i in range((MAX_DRAW_POINTS + 1) * 2)]
+        self.room.process_message(self.room.drawer, {"type": MSG_DRAW, "data": {"points": points}})
+        self.assertEqual(len(self.room.strokes), 0)
+        self.assertEqual((self.room.drawing_version, self.room.history.sequence), (version, sequence))
+
+        self.room.process_message(self.room.drawer, {"type": MSG_DRAW, "data": {"points": points[:-2]}})
+        self.assertEqual(len(self.room.strokes), 1)
+
+    def test_replay_with_a_non_finite_speed_is_refused(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.room.recorder = RoundRecorder(directory.name)
+        self.room.recorder.start_round("cat", "animals", "Player_1")
+        self.room.recorder.end_round()
+        wait_for_writer(self.room.recorder.writer)
+        self.room.game_state = STATE_WAITING
+
+        client = self.room.players()[0]
+        for request in ({"id": "latest", "speed": float("nan")}, {"id": "latest", "from": float("inf")},
+                        {"id": "latest", "speed": "fast"}):
+            self.room.handle_replay_request(client, request)
+            self.assertNotIn(client, self.room.playbacks)
+
+    def test_join_for_an_invalid_room_is_refused(self):
+        server = self.local.server
+        for room_id in ([1], "1", 0, True):
+            with mock.patch.object(server, "send_message") as send:
+                client = self.local.connect(("test", room_id), {"room": room_id})
+            send.assert_called_once_with(client, MSG_JOIN, {"error": "Invalid room"})
+            server.match_players()
+            self.assertIsNone(server.clients[client]["room"])
+
+    def test_client_that_cannot_be_seated_does_not_hold_up_the_lobby(self):
+        server = self.local.server
+        first = self.local.connect(("test", "first"))
+        second = self.local.connect(("test", "second"))
+        choose_room = server.choose_room
+
+        def failing_for_first(client, room_id):
+            if client is first:
+                raise RuntimeError("no room")
+            return choose_room(client, room_id)
+
+        with mock.patch.object(server, "choose_room", side_effect=failing_for_first):
+            with self.assertLogs("server.server", "WARNING"):
+                server.match_players()
+        self.assertIsNone(server.clients[first]["room"])
+        self.assertIsNotNone(server.clients[second]["room"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+from server.strokes import StrokeStore, DRAW_STORED, DRAW_OVER_BUDGET, DRAW_STROKE_CLOSED
+from shared.common import *
+
+class StrokeStoreTest(unittest.TestCase):
+
+    def test_strokes_past_the_raster_survive_snapshots(self):
+        store = StrokeStore()
+        inside = [10, 10, 60, 60, 110, 10]
+        outside = [520, 600, 540, 640, 560, 600]
+        store.add({"points": inside, "end": True, "stroke": 1})
+        store.add({"points": outside, "end": True, "stroke": 2})
+
+        raster, draws = unpack_drawing(store.pack())
+        self.assertIsNotNone(raster)
+        self.assertEqual(draws, [{"points": outside, "end": True, "stroke": 2}])
+
+    def test_strokes_inside_the_raster_are_flattened(self):
+        store = StrokeStore()
+        store.add({"points": [10, 10, 60, 60], "end": True, "stroke": 1})
+        store.add({"points": [70, 70, 80, 80], "stroke": 2})
+        raster, draws = unpack_drawing(store.pack())
+        self.assertIsNotNone(raster)
+        self.assertEqual([draw_data["stroke"] for draw_data in draws], [2])
+
+    def test_drawer_ids_do_not_push_assigned_ids_out_of_range(self):
+        store = StrokeStore()
+        client_data = {"points": [10, 10, 20, 20], "end": True, "stroke": 0xFFFFFFFF}
+        self.assertEqual(store.add(client_data), DRAW_STORED)
+        assigned = {"points": [30, 30, 40, 40]}
+        self.assertEqual(store.add(assigned), DRAW_STORED)
+        self.assertLessEqual(assigned["stroke"], 0xFFFFFFFF)
+        encode_message(MSG_DRAW, assigned, FORMAT_BINARY)
+        unpack_drawing(store.pack())
+
+    def test_assigned_ids_skip_ids_in_use(self):
+        store = StrokeStore()
+        store.add({"points": [10, 10, 20, 20], "end": True, "stroke": 1})
+        store.add({"points": [10, 10, 20, 20], "end": True, "stroke": 2})
+        store.next_id = 0xFFFFFFFF
+        store.add({"points": [10, 10, 20, 20], "end": True, "stroke": 0xFFFFFFFF})
+        assigned = {"points": [30, 30, 40, 40]}
+        store.add(assigned)
+        self.assertEqual(assigned["stroke"], 3)
+
+    def test_refusals_say_why(self):
+        store = StrokeStore(budget=64)
+        self.assertEqual(store.add({"points": [10, 10, 20, 20], "end": True, "stroke": 1}), DRAW_STORED)
+        self.assertEqual(store.add({"points": [30, 30, 40, 40], "end": True, "stroke": 2}), DRAW_STORED)
+        self.assertEqual(store.add({"points": [20, 20, 25, 25], "stroke": 1}), DRAW_STROKE_CLOSED)
+        self.assertEqual(store.add({"points": list(range(100)), "stroke": 3}), DRAW_OVER_BUDGET)
+
+if __name__ == "__main__":
+    unittest.main()